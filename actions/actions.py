@@ -1,24 +1,29 @@
 import datetime
+import json
 import logging
 import os
 from abc import ABC, abstractmethod
 from distutils.util import strtobool
 from pprint import pformat
-from typing import Any, Text, Dict, List, Optional, Union
+from typing import Any, Text, Dict, List, Optional, Union, Callable, Awaitable, Set
 
 from rasa_sdk import Action, Tracker
 from rasa_sdk.events import SessionStarted, ActionExecuted, SlotSet, EventType, ReminderScheduled, \
-    UserUtteranceReverted, FollowupAction, ActionReverted
+    UserUtteranceReverted, FollowupAction, ActionReverted, ReminderCancelled
 from rasa_sdk.executor import CollectingDispatcher
 from rasa_sdk.interfaces import ACTION_LISTEN_NAME
 
+from actions import change_feed
 from actions import daily_co
+from actions import outbox
 from actions import rasa_callbacks
 from actions import telegram_helpers
+from actions import tick_scheduler
+from actions import timer_wheel
 from actions.rasa_callbacks import EXTERNAL_ASK_TO_JOIN_INTENT, EXTERNAL_ASK_TO_CONFIRM_INTENT
 from actions.user_state_machine import UserStateMachine, UserState, NATIVE_UNKNOWN, PARTNER_CONFIRMATION_TIMEOUT_SEC, \
     SHORT_BREAK_TIMEOUT_SEC
-from actions.user_vault import UserVault, IUserVault
+from actions.user_vault import UserVault, IUserVault, get_offerable_pool_version
 from actions.utils import stack_trace_to_str, datetime_now, get_intent_of_latest_message_reliably, SwiperError, \
     current_timestamp_int, SwiperRasaCallbackError, present_partner_name
 
@@ -29,11 +34,19 @@ SEND_ERROR_STACK_TRACE_TO_SLOT = strtobool(os.getenv('SEND_ERROR_STACK_TRACE_TO_
 CLEAR_REJECTED_LIST_WHEN_NO_ONE_FOUND = strtobool(os.getenv('CLEAR_REJECTED_LIST_WHEN_NO_ONE_FOUND', 'yes'))
 FIND_PARTNER_FREQUENCY_SEC = float(os.getenv('FIND_PARTNER_FREQUENCY_SEC', '3'))
 PARTNER_SEARCH_TIMEOUT_SEC = int(os.getenv('PARTNER_SEARCH_TIMEOUT_SEC', '116'))  # 1 minute 56 seconds
+# run search ticks on the action server's own timer wheel - Rasa only gets a reminder for the end of the search
+SEARCH_TICKS_IN_PROCESS = strtobool(os.getenv('SEARCH_TICKS_IN_PROCESS', 'no'))
+# partners are asked to join by the central matchmaker (actions/matchmaker.py) - searches only wait for the timeout
+MATCHMAKER_ENABLED = strtobool(os.getenv('MATCHMAKER_ENABLED', 'no'))
+# search ticks back off while nobody can be found (see actions/tick_scheduler.py)
+ADAPTIVE_SEARCH_TICKS = strtobool(os.getenv('ADAPTIVE_SEARCH_TICKS', 'no'))
 ROOM_DISPOSAL_REPORT_DELAY_SEC = int(os.getenv('ROOM_DISPOSAL_REPORT_DELAY_SEC', '60'))  # 1 minute
 GREETING_MAKES_USER_OK_TO_CHITCHAT = strtobool(os.getenv('GREETING_MAKES_USER_OK_TO_CHITCHAT', 'no'))
 SEARCH_CANCELLATION_TAKES_A_BREAK = strtobool(os.getenv('SEARCH_CANCELLATION_TAKES_A_BREAK', 'no'))
 WAITING_CANCELLATION_REJECTS_INVITATION = strtobool(os.getenv('WAITING_CANCELLATION_REJECTS_INVITATION', 'no'))
 
+search_tick_scheduler = tick_scheduler.AdaptiveTickScheduler(FIND_PARTNER_FREQUENCY_SEC)
+
 SWIPER_STATE_SLOT = 'swiper_state'
 SWIPER_ACTION_RESULT_SLOT = 'swiper_action_result'
 DEEPLINK_DATA_SLOT = 'deeplink_data'
@@ -52,6 +65,22 @@ EXTERNAL_EXPIRE_PARTNER_CONFIRMATION_INTENT = 'EXTERNAL_expire_partner_confirmat
 EXTERNAL_ROOM_DISPOSAL_REPORT_INTENT = 'EXTERNAL_room_disposal_report'
 EXTERNAL_ROOM_EXPIRATION_REPORT_INTENT = 'EXTERNAL_room_expiration_report'
 
+# reminders that become pointless once the user ends up in a certain state (the actions they trigger would just revert
+# themselves) => such reminders are cancelled proactively instead of letting them fire
+REMINDERS_INVALIDATED_BY_STATE = {
+    state: [
+        reminder_intent
+        for reminder_intent, relevant_state in [
+            (EXTERNAL_FIND_PARTNER_INTENT, UserState.WANTS_CHITCHAT),
+            (EXTERNAL_EXPIRE_PARTNER_CONFIRMATION_INTENT, UserState.WAITING_PARTNER_CONFIRM),
+            (EXTERNAL_ROOM_DISPOSAL_REPORT_INTENT, UserState.ROOMED),
+            (EXTERNAL_ROOM_EXPIRATION_REPORT_INTENT, UserState.ROOMED),
+        ]
+        if state != relevant_state
+    ]
+    for state in UserState.all_states
+}
+
 ACTION_DEFAULT_FALLBACK_NAME = 'action_default_fallback'
 ACTION_SESSION_START_NAME = 'action_session_start'
 ACTION_FIND_PARTNER_NAME = 'action_find_partner'
@@ -154,6 +183,23 @@ CALL_ANOTHER_PERSON_MARKUP = (
     '],"resize_keyboard":true,"one_time_keyboard":true}'
 )
 
+# exact texts of the keyboard buttons above and the intents they stand for (the Telegram channel uses the generated
+# customize_rasa/keyboard_intents.py to route button presses around NLU - see generate_keyboard_intents_module())
+KEYBOARD_BUTTON_INTENTS = {
+    'Yes': 'affirm',
+    'Yes, connect me': 'videochat',
+    'No': 'deny',
+    'No, thanks': 'deny',
+    'Not now': 'another_time',
+    'Connect me with someone else': 'someone_else',
+    'Call another person': 'someone_else',
+    'How does it work?': 'help',
+    'Share my contact info': 'share_contact',
+    '❌ Stop the call': 'stop',
+    'Cancel': 'stop',
+}
+KEYBOARD_INTENTS_MODULE_PATH = os.path.join('customize_rasa', 'keyboard_intents.py')
+
 
 class BaseSwiperAction(Action, ABC):
     @abstractmethod
@@ -174,6 +220,54 @@ class BaseSwiperAction(Action, ABC):
     ) -> List[Dict[Text, Any]]:
         raise NotImplementedError('Swiper action must implement its swipy_run method')
 
+    # noinspection PyUnusedLocal
+    def is_precondition_satisfied(self, tracker: Tracker, current_user: UserStateMachine) -> bool:
+        """
+        Checked right after the user is read and before anything is written - an action that returns False here is
+        skipped completely (only UserUtteranceReverted is returned). Meant for cheap checks that let stale reminders and
+        callbacks exit early.
+        """
+        return True
+
+    def update_user_from_tracker(self, tracker: Tracker, current_user: UserStateMachine) -> None:
+        metadata = tracker.latest_message.get('metadata') or {}
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('tracker.latest_message.metadata:\n%s', pformat(metadata))
+
+        deeplink_data = metadata.get(DEEPLINK_DATA_SLOT)
+        telegram_from = metadata.get(TELEGRAM_FROM_SLOT)
+
+        if deeplink_data:
+            current_user.deeplink_data = deeplink_data
+
+            dl_entries = deeplink_data.split('_')
+            for dl_entry in dl_entries:
+                dl_parts = dl_entry.split('-', maxsplit=1)
+                if len(dl_parts) > 1 and dl_parts[0] == 'n' and dl_parts[1]:
+                    current_user.native = dl_parts[1]
+                    break
+
+        if telegram_from:
+            current_user.telegram_from = telegram_from
+
+            teleg_lang_code = telegram_from.get('language_code')
+            if teleg_lang_code:
+                current_user.teleg_lang_code = teleg_lang_code
+
+                if current_user.native == NATIVE_UNKNOWN:
+                    current_user.native = teleg_lang_code
+
+        if self.should_update_user_activity_timestamp(tracker):
+            current_user.update_activity_timestamp()
+
+    @staticmethod
+    def defer_side_effect(coroutine_function: Callable[..., Awaitable[Any]], *args, **kwargs) -> None:
+        """
+        Non-essential outbound calls should be deferred with this method - they will be executed concurrently after the
+        action produces its response (and their errors will only be logged).
+        """
+        outbox.defer(coroutine_function, *args, **kwargs)
+
     async def run(
             self, dispatcher: CollectingDispatcher,
             tracker: Tracker,
@@ -193,55 +287,44 @@ class BaseSwiperAction(Action, ABC):
                 tracker.sender_id,
             )
 
+        if change_feed.change_feed_pump:
+            change_feed.change_feed_pump.ensure_running()
+
         user_vault = UserVault()
+        side_effect_outbox = outbox.SideEffectOutbox(self.name())
 
         # noinspection PyBroadException
         try:
-            metadata = tracker.latest_message.get('metadata') or {}
-            if logger.isEnabledFor(logging.DEBUG):
-                logger.debug('tracker.latest_message.metadata:\n%s', pformat(metadata))
-
-            deeplink_data = metadata.get(DEEPLINK_DATA_SLOT)
-            telegram_from = metadata.get(TELEGRAM_FROM_SLOT)
-
             current_user = user_vault.get_user(tracker.sender_id)
 
-            if deeplink_data:
-                current_user.deeplink_data = deeplink_data
-
-                dl_entries = deeplink_data.split('_')
-                for dl_entry in dl_entries:
-                    dl_parts = dl_entry.split('-', maxsplit=1)
-                    if len(dl_parts) > 1 and dl_parts[0] == 'n' and dl_parts[1]:
-                        current_user.native = dl_parts[1]
-                        break
-
-            if telegram_from:
-                current_user.telegram_from = telegram_from
-
-                teleg_lang_code = telegram_from.get('language_code')
-                if teleg_lang_code:
-                    current_user.teleg_lang_code = teleg_lang_code
-
-                    if current_user.native == NATIVE_UNKNOWN:
-                        current_user.native = teleg_lang_code
-
-            if self.should_update_user_activity_timestamp(tracker):
-                current_user.update_activity_timestamp()
+            if not self.is_precondition_satisfied(tracker, current_user):
+                # nothing to do (most likely a stale reminder) => don't even save the user (nor re-read it, nor touch
+                # the slots and the reminders)
+                logger.info(
+                    'PRECONDITION NOT SATISFIED: %r (CURRENT USER ID = %r)',
+                    self.name(),
+                    tracker.sender_id,
+                )
+                return [
+                    # get rid of the artificial intent so it doesn't interfere with story predictions
+                    UserUtteranceReverted(),
+                ]
 
+            self.update_user_from_tracker(tracker, current_user)
             current_user.save()
 
             if current_user.state == UserState.USER_BANNED:
                 logger.info('IGNORING BANNED USER (ID = %r)', current_user.user_id)
                 events = []
             else:
-                events = list(await self.swipy_run(
-                    dispatcher,
-                    tracker,
-                    domain,
-                    current_user,
-                    user_vault,
-                ))
+                with side_effect_outbox:
+                    events = list(await self.swipy_run(
+                        dispatcher,
+                        tracker,
+                        domain,
+                        current_user,
+                        user_vault,
+                    ))
 
         except Exception as e:
             logger.exception(self.name())
@@ -294,6 +377,8 @@ class BaseSwiperAction(Action, ABC):
                 value=current_user.partner_id,
             ))
 
+        events.extend(cancel_obsolete_reminders(tracker, current_user, events))
+
         if logger.isEnabledFor(logging.DEBUG):
             logger.debug(
                 'END ACTION RUN: %r (CURRENT USER ID = %r)\n\nRETURNED EVENTS:\n\n%s\n',
@@ -307,6 +392,8 @@ class BaseSwiperAction(Action, ABC):
                 self.name(),
                 tracker.sender_id,
             )
+
+        side_effect_outbox.flush()
         return events
 
 
@@ -593,7 +680,8 @@ class ActionStopTheCall(BaseSwiperAction):
                 partner = user_vault.get_user(current_user.partner_id)
 
                 if partner.is_still_in_the_room(current_user.latest_room_name):
-                    await rasa_callbacks.schedule_room_disposal_report(
+                    self.defer_side_effect(
+                        rasa_callbacks.schedule_room_disposal_report,
                         current_user.user_id,
                         partner,
                         current_user.latest_room_name,
@@ -669,6 +757,10 @@ class ActionRoomDisposalReport(BaseSwiperAction):
     def should_update_user_activity_timestamp(self, tracker: Tracker) -> bool:
         return False
 
+    def is_precondition_satisfied(self, tracker: Tracker, current_user: UserStateMachine) -> bool:
+        disposed_room_name = tracker.get_slot(rasa_callbacks.DISPOSED_ROOM_NAME_SLOT)
+        return current_user.is_still_in_the_room(disposed_room_name)
+
     async def swipy_run(
             self, dispatcher: CollectingDispatcher,
             tracker: Tracker,
@@ -676,12 +768,6 @@ class ActionRoomDisposalReport(BaseSwiperAction):
             current_user: UserStateMachine,
             user_vault: IUserVault,
     ) -> List[Dict[Text, Any]]:
-        disposed_room_name = tracker.get_slot(rasa_callbacks.DISPOSED_ROOM_NAME_SLOT)
-        if not current_user.is_still_in_the_room(disposed_room_name):
-            return [
-                UserUtteranceReverted(),
-            ]
-
         partner = user_vault.get_user(current_user.partner_id)
 
         dispatcher.utter_message(json_message={
@@ -711,6 +797,10 @@ class ActionRoomExpirationReport(BaseSwiperAction):
     def should_update_user_activity_timestamp(self, tracker: Tracker) -> bool:
         return False
 
+    def is_precondition_satisfied(self, tracker: Tracker, current_user: UserStateMachine) -> bool:
+        disposed_room_name = tracker.get_slot(rasa_callbacks.DISPOSED_ROOM_NAME_SLOT)
+        return current_user.is_still_in_the_room(disposed_room_name)
+
     async def swipy_run(
             self, dispatcher: CollectingDispatcher,
             tracker: Tracker,
@@ -718,12 +808,6 @@ class ActionRoomExpirationReport(BaseSwiperAction):
             current_user: UserStateMachine,
             user_vault: IUserVault,
     ) -> List[Dict[Text, Any]]:
-        disposed_room_name = tracker.get_slot(rasa_callbacks.DISPOSED_ROOM_NAME_SLOT)
-        if not current_user.is_still_in_the_room(disposed_room_name):
-            return [
-                UserUtteranceReverted(),
-            ]
-
         partner = user_vault.get_user(current_user.partner_id)
 
         dispatcher.utter_message(json_message={
@@ -762,6 +846,13 @@ class ActionFindPartner(BaseSwiperAction):
         latest_intent = get_intent_of_latest_message_reliably(tracker)
         return latest_intent == EXTERNAL_FIND_PARTNER_INTENT
 
+    def is_precondition_satisfied(self, tracker: Tracker, current_user: UserStateMachine) -> bool:
+        if self.is_triggered_by_reminder(tracker) and current_user.state != UserState.WANTS_CHITCHAT:
+            # the search was stopped for the user one way or another (user said stop, or was asked to join etc.)
+            # => don't do any partner searching and don't schedule another reminder
+            return False
+        return True
+
     async def swipy_run(
             self, dispatcher: CollectingDispatcher,
             tracker: Tracker,
@@ -776,14 +867,6 @@ class ActionFindPartner(BaseSwiperAction):
         if self.is_triggered_by_reminder(tracker):
             revert_user_utterance = True
 
-            if current_user.state != UserState.WANTS_CHITCHAT:
-                # the search was stopped for the user one way or another (user said stop, or was asked to join etc.)
-                # => don't do any partner searching and don't schedule another reminder
-                return [
-                    # get rid of the artificial reminder intent so it doesn't interfere with story predictions
-                    UserUtteranceReverted(),
-                ]
-
         else:  # user just requested chitchat
             initiate_search = True
 
@@ -795,25 +878,17 @@ class ActionFindPartner(BaseSwiperAction):
                     current_user.rejected_partner_ids = []
             current_user.save()
 
-        partner = user_vault.get_random_available_partner(current_user)
-
-        if partner:
-            user_profile_photo_id = telegram_helpers.get_user_profile_photo_file_id(current_user.user_id)
-            user_first_name = current_user.get_first_name()
-
-            await rasa_callbacks.ask_to_join(
-                current_user.user_id,
-                partner,
-                user_profile_photo_id,
-                user_first_name,
-                suppress_callback_errors=True,
-            )
+        partner_found = False
+        if not MATCHMAKER_ENABLED:
+            partner_found = self.ask_random_partner_to_join(current_user, user_vault)
 
         partner_search_start_ts = get_partner_search_start_ts(tracker)
         if initiate_search or (
                 partner_search_start_ts is not None and
                 (current_timestamp_int() - partner_search_start_ts) <= PARTNER_SEARCH_TIMEOUT_SEC
         ):
+            if initiate_search:
+                partner_search_start_ts = current_timestamp_int()
             # we still have time to look for / ask some more people => schedule another reminder
             return [
                 # get rid of the artificial reminder intent so it doesn't interfere with story predictions
@@ -828,7 +903,9 @@ class ActionFindPartner(BaseSwiperAction):
 
                 *self.schedule_find_partner_reminder(
                     current_user.user_id,
+                    delta_sec=self.get_search_tick_delay(current_user.user_id, partner_found, partner_search_start_ts),
                     initiate=initiate_search,
+                    partner_search_start_ts=partner_search_start_ts,
                 ),
             ]
 
@@ -850,12 +927,47 @@ class ActionFindPartner(BaseSwiperAction):
             ),
         ]
 
-    @staticmethod
+    @classmethod
+    def ask_random_partner_to_join(cls, current_user: UserStateMachine, user_vault: IUserVault) -> bool:
+        partner = user_vault.get_random_available_partner(current_user)
+        if not partner:
+            return False
+
+        user_profile_photo_id = telegram_helpers.get_user_profile_photo_file_id(current_user.user_id)
+        user_first_name = current_user.get_first_name()
+
+        cls.defer_side_effect(
+            rasa_callbacks.ask_to_join,
+            current_user.user_id,
+            partner,
+            user_profile_photo_id,
+            user_first_name,
+            suppress_callback_errors=True,
+        )
+        return True
+
+    @classmethod
     def schedule_find_partner_reminder(
+            cls,
             current_user_id: Text,
             delta_sec: float = FIND_PARTNER_FREQUENCY_SEC,
             initiate: bool = False,
+            partner_search_start_ts: Optional[int] = None,
     ) -> List[EventType]:
+        if initiate or partner_search_start_ts is None:
+            partner_search_start_ts = current_timestamp_int()
+
+        if SEARCH_TICKS_IN_PROCESS and not MATCHMAKER_ENABLED:
+            cls.schedule_search_tick(current_user_id, partner_search_start_ts, delta_sec)
+
+        if SEARCH_TICKS_IN_PROCESS or MATCHMAKER_ENABLED:
+            # partners are asked without Rasa's help => the reminder only fires when the search times out (in-process
+            # ticks are lost if the action server restarts, but the user still gets "no one has responded" this way)
+            delta_sec = max(
+                delta_sec,
+                partner_search_start_ts + PARTNER_SEARCH_TIMEOUT_SEC + 1 - current_timestamp_int(),
+            )
+
         events = [reschedule_reminder(
             current_user_id,
             EXTERNAL_FIND_PARTNER_INTENT,
@@ -864,10 +976,60 @@ class ActionFindPartner(BaseSwiperAction):
         if initiate:
             events.insert(0, SlotSet(
                 key=PARTNER_SEARCH_START_TS_SLOT,
-                value=str(current_timestamp_int()),
+                value=str(partner_search_start_ts),
             ))
         return events
 
+    @staticmethod
+    def get_search_tick_delay(current_user_id: Text, partner_found: bool, partner_search_start_ts: int) -> float:
+        if not ADAPTIVE_SEARCH_TICKS:
+            return FIND_PARTNER_FREQUENCY_SEC
+
+        delay_sec = search_tick_scheduler.next_delay(current_user_id, partner_found, get_offerable_pool_version())
+        # backing off should not postpone the end of the search
+        return min(delay_sec, max(
+            FIND_PARTNER_FREQUENCY_SEC,
+            partner_search_start_ts + PARTNER_SEARCH_TIMEOUT_SEC + 1 - current_timestamp_int(),
+        ))
+
+    @classmethod
+    def schedule_search_tick(
+            cls,
+            current_user_id: Text,
+            partner_search_start_ts: int,
+            delay_sec: float = FIND_PARTNER_FREQUENCY_SEC,
+    ) -> None:
+        timer_wheel.timer_wheel.schedule(
+            current_user_id,
+            delay_sec,
+            cls.run_search_tick,
+            current_user_id,
+            partner_search_start_ts,
+        )
+
+    @classmethod
+    async def run_search_tick(cls, current_user_id: Text, partner_search_start_ts: int) -> None:
+        """
+        One more attempt to find a partner without a round trip through Rasa. The ticks stop as soon as the user is not
+        searching anymore or the search times out (the timeout itself is reported by the reminder).
+        """
+        user_vault = UserVault()
+        current_user = user_vault.get_user(current_user_id)
+        if current_user.state != UserState.WANTS_CHITCHAT:
+            return
+
+        side_effect_outbox = outbox.SideEffectOutbox(ACTION_FIND_PARTNER_NAME)
+        with side_effect_outbox:
+            partner_found = cls.ask_random_partner_to_join(current_user, user_vault)
+        side_effect_outbox.flush()
+
+        if current_timestamp_int() - partner_search_start_ts < PARTNER_SEARCH_TIMEOUT_SEC:
+            cls.schedule_search_tick(
+                current_user_id,
+                partner_search_start_ts,
+                cls.get_search_tick_delay(current_user_id, partner_found, partner_search_start_ts),
+            )
+
 
 class ActionAskToJoin(BaseSwiperAction):
     def name(self) -> Text:
@@ -1131,7 +1293,8 @@ class ActionJoinRoom(BaseSwiperAction):
         expiration_reminder_delay_sec = daily_co.DAILY_CO_MEETING_DURATION_SEC
         if is_intent_external:
             # make sure room expiration reports arrive to partners at slightly different time (otherwise we seem to be
-            # hitting telegram limits sometimes - one of the partners doesn't always receive this report)
+            # hitting telegram limits sometimes - one of the partners doesn't always receive this report); reminders
+            # are fired by Rasa's own scheduler, hence actions.rate_limiter has no chance to smooth them out
             expiration_reminder_delay_sec += 1
 
         return [
@@ -1263,7 +1426,8 @@ class ActionRejectInvitation(BaseSwiperAction):
 
             if partner.is_waiting_to_be_confirmed_by(current_user.user_id):
                 # don't leave the rejected partner waiting for nothing
-                await rasa_callbacks.reject_confirmation(
+                self.defer_side_effect(
+                    rasa_callbacks.reject_confirmation,
                     current_user.user_id,
                     partner,
                     suppress_callback_errors=True,
@@ -1323,18 +1487,10 @@ class ActionExpirePartnerConfirmation(BaseSwiperAction):
     def should_update_user_activity_timestamp(self, tracker: Tracker) -> bool:
         return False
 
-    async def swipy_run(
-            self, dispatcher: CollectingDispatcher,
-            tracker: Tracker,
-            domain: Dict[Text, Any],
-            current_user: UserStateMachine,
-            user_vault: IUserVault,
-    ) -> List[Dict[Text, Any]]:
+    def is_precondition_satisfied(self, tracker: Tracker, current_user: UserStateMachine) -> bool:
         if current_user.state != UserState.WAITING_PARTNER_CONFIRM:
             # user was not waiting for anybody's confirmation anymore anyway => do nothing and cover your tracks
-            return [
-                UserUtteranceReverted(),
-            ]
+            return False
 
         latest_intent = get_intent_of_latest_message_reliably(tracker)
         if latest_intent == rasa_callbacks.EXTERNAL_PARTNER_DID_NOT_CONFIRM_INTENT:
@@ -1343,10 +1499,16 @@ class ActionExpirePartnerConfirmation(BaseSwiperAction):
 
             if not current_user.is_waiting_to_be_confirmed_by(partner_id_that_rejected):
                 # user is not waiting for this particular partner anymore anyway => ignore
-                return [
-                    UserUtteranceReverted(),
-                ]
+                return False
+        return True
 
+    async def swipy_run(
+            self, dispatcher: CollectingDispatcher,
+            tracker: Tracker,
+            domain: Dict[Text, Any],
+            current_user: UserStateMachine,
+            user_vault: IUserVault,
+    ) -> List[Dict[Text, Any]]:
         partner_id = current_user.partner_id
 
         # noinspection PyUnresolvedReferences
@@ -1462,7 +1624,103 @@ def reschedule_reminder(
         intent_name,
         trigger_date_time=date,
         entities=entities,
-        name=current_user_id + intent_name,  # unique per user and can be rescheduled for the user
+        name=get_reminder_name(current_user_id, intent_name),
         kill_on_user_message=kill_on_user_message,
     )
     return reminder
+
+
+def get_reminder_name(current_user_id: Text, intent_name: Text) -> Text:
+    return current_user_id + intent_name  # unique per user and can be rescheduled for the user
+
+
+def get_pending_reminder_names(tracker: Tracker) -> Set[Text]:
+    """
+    Names of the reminders that were scheduled and have neither fired nor been cancelled yet (according to the events
+    of the tracker).
+    """
+    pending_reminder_intents = {}
+    for event in tracker.events:
+        event_type = event.get('event')
+
+        if event_type == 'reminder':
+            pending_reminder_intents[event.get('name')] = event.get('intent')
+
+        elif event_type == 'cancel_reminder':
+            if event.get('name'):
+                pending_reminder_intents.pop(event.get('name'), None)
+            else:
+                pending_reminder_intents = {
+                    name: intent for name, intent in pending_reminder_intents.items() if intent != event.get('intent')
+                }
+
+        elif event_type == 'user':
+            # a reminder that fired shows up as a user message with the reminder's intent
+            fired_intent = ((event.get('parse_data') or {}).get('intent') or {}).get('name')
+            if fired_intent:
+                pending_reminder_intents = {
+                    name: intent for name, intent in pending_reminder_intents.items() if intent != fired_intent
+                }
+
+    return set(pending_reminder_intents.keys())
+
+
+def cancel_obsolete_reminders(
+        tracker: Tracker,
+        current_user: UserStateMachine,
+        events: List[EventType],
+) -> List[EventType]:
+    invalidated_intents = REMINDERS_INVALIDATED_BY_STATE.get(current_user.state)
+    if not invalidated_intents:
+        return []
+
+    pending_reminder_names = get_pending_reminder_names(tracker)
+    if not pending_reminder_names:
+        return []
+
+    rescheduled_reminder_names = {e.get('name') for e in events if e.get('event') == 'reminder'}
+
+    cancellations = []
+    for intent_name in invalidated_intents:
+        reminder_name = get_reminder_name(current_user.user_id, intent_name)
+        if reminder_name in pending_reminder_names and reminder_name not in rescheduled_reminder_names:
+            cancellations.append(ReminderCancelled(name=reminder_name, intent_name=intent_name))
+    return cancellations
+
+
+def get_keyboard_button_texts() -> List[Text]:
+    button_texts = []
+    for constant_name, constant_value in sorted(globals().items()):
+        if not constant_name.endswith('_MARKUP'):
+            continue
+
+        for keyboard_row in json.loads(constant_value).get('keyboard', []):
+            for button in keyboard_row:
+                if button['text'] not in button_texts:
+                    button_texts.append(button['text'])
+    return button_texts
+
+
+def generate_keyboard_intents_module() -> Text:
+    """
+    Render the source code of customize_rasa/keyboard_intents.py (Rasa containers have no access to the actions
+    package, hence the code generation).
+    """
+    keyboard_intents = {}
+    for button_text in get_keyboard_button_texts():
+        if button_text.startswith('/'):
+            continue  # commands are not processed by NLU anyway
+
+        if button_text not in KEYBOARD_BUTTON_INTENTS:
+            raise SwiperError(f"no intent is specified for keyboard button {repr(button_text)}")
+        keyboard_intents[button_text] = KEYBOARD_BUTTON_INTENTS[button_text]
+
+    lines = [
+        '# GENERATED FROM THE *_MARKUP CONSTANTS OF actions/actions.py - DO NOT EDIT MANUALLY !',
+        '# (run `python cli/swipy_cli.py generate-keyboard-intents` to regenerate)',
+        'KEYBOARD_INTENTS = {',
+    ]
+    for button_text, intent in keyboard_intents.items():
+        lines.append(f"    {repr(button_text)}: {repr(intent)},")
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
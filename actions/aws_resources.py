@@ -1,4 +1,6 @@
 import os
+import threading
+from typing import Any
 
 import boto3
 
@@ -7,3 +9,17 @@ USER_STATE_MACHINE_DDB_TABLE = os.environ['USER_STATE_MACHINE_DDB_TABLE']
 
 dynamodb = boto3.resource('dynamodb', AWS_REGION)
 user_state_machine_table = dynamodb.Table(USER_STATE_MACHINE_DDB_TABLE)
+
+_thread_local = threading.local()
+
+
+def get_thread_user_state_machine_table() -> Any:
+    """
+    boto3 resources are not thread safe - every worker thread gets its own (the module level table is for the event
+    loop thread).
+    """
+    table = getattr(_thread_local, 'user_state_machine_table', None)
+    if table is None:
+        table = boto3.resource('dynamodb', AWS_REGION).Table(USER_STATE_MACHINE_DDB_TABLE)
+        _thread_local.user_state_machine_table = table
+    return table
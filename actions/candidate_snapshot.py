@@ -0,0 +1,397 @@
+import json
+import logging
+import os
+import time
+from typing import Text, Callable, Dict, List, Iterable, Optional, Tuple, Set
+
+import numpy as np
+
+from actions.user_state_machine import UserModel, UserState, NATIVE_UNKNOWN
+from actions.utils import current_timestamp_int
+
+logger = logging.getLogger(__name__)
+
+CANDIDATE_SNAPSHOT_TTL_SEC = float(os.getenv('CANDIDATE_SNAPSHOT_TTL_SEC', '5'))
+# the snapshot counts as kept fresh by a change feed for this long after the last successful read of the feed
+CANDIDATE_SNAPSHOT_FEED_STALE_SEC = float(os.getenv('CANDIDATE_SNAPSHOT_FEED_STALE_SEC', '10'))
+# comma separated scorer_name:weight pairs (see SCORERS below)
+CANDIDATE_SCORERS = os.getenv('CANDIDATE_SCORERS', 'recency:1')
+RECENCY_HALF_SCORE_SEC = float(os.getenv('RECENCY_HALF_SCORE_SEC', '3600'))  # activity of that age scores 0.5
+# how many of the best scored candidates are re-read from the db (the snapshot might be outdated) before giving up
+CANDIDATE_SNAPSHOT_VERIFY_TOP = int(os.getenv('CANDIDATE_SNAPSHOT_VERIFY_TOP', '5'))
+# where to persist the snapshot, so a restarted action server doesn't start with a full listing (empty - don't persist)
+CANDIDATE_SNAPSHOT_FILE = os.getenv('CANDIDATE_SNAPSHOT_FILE', '')
+CANDIDATE_SNAPSHOT_SAVE_INTERVAL_SEC = float(os.getenv('CANDIDATE_SNAPSHOT_SAVE_INTERVAL_SEC', '60'))
+CANDIDATE_SNAPSHOT_FILE_MAX_AGE_SEC = int(os.getenv('CANDIDATE_SNAPSHOT_FILE_MAX_AGE_SEC', '3600'))
+
+STATE_CODES: Dict[Text, int] = {state: code for code, state in enumerate(UserState.all_states)}
+TIMEOUT_STATE_CODES = np.array([STATE_CODES[state] for state in UserState.states_with_timeouts], dtype=np.int16)
+
+# scorer(snapshot, searcher, current_timestamp) returns a score for every row of the snapshot
+Scorer = Callable[['CandidateSnapshot', UserModel, int], np.ndarray]
+
+SCORERS: Dict[Text, Scorer] = {}
+
+
+def scorer(name: Text) -> Callable[[Scorer], Scorer]:
+    def register(score: Scorer) -> Scorer:
+        if name in SCORERS:
+            raise ValueError(f"scorer {repr(name)} is already registered")
+        SCORERS[name] = score
+        return score
+
+    return register
+
+
+@scorer('recency')
+def score_recency(snapshot: 'CandidateSnapshot', searcher: UserModel, current_timestamp: int) -> np.ndarray:
+    activity_age_sec = np.maximum(current_timestamp - snapshot.activity_timestamp, 0)
+    return 1 / (1 + activity_age_sec / RECENCY_HALF_SCORE_SEC)
+
+
+@scorer('same_native')
+def score_same_native(snapshot: 'CandidateSnapshot', searcher: UserModel, current_timestamp: int) -> np.ndarray:
+    if not searcher.native or searcher.native == NATIVE_UNKNOWN or searcher.native not in snapshot.native_codes:
+        return np.zeros(len(snapshot), dtype=np.float64)
+    return (snapshot.native == snapshot.native_codes[searcher.native]).astype(np.float64)
+
+
+@scorer('newbie_veteran')
+def score_newbie_veteran(snapshot: 'CandidateSnapshot', searcher: UserModel, current_timestamp: int) -> np.ndarray:
+    return (snapshot.newbie != bool(searcher.newbie)).astype(np.float64)
+
+
+def parse_scorer_weights(spec: Text) -> Dict[Text, float]:
+    weights = {}
+    for part in spec.split(','):
+        if not part.strip():
+            continue
+        name, _, weight = part.partition(':')
+        name = name.strip()
+        if name not in SCORERS:
+            raise ValueError(f"unknown scorer {repr(name)} (known scorers: {', '.join(SCORERS)})")
+        weights[name] = float(weight) if weight.strip() else 1.0
+    return weights
+
+
+class CandidateSnapshot:
+    """
+    Offerable users laid out in NumPy columns, so candidates for a searcher could be filtered and scored with
+    vectorized masks. Exclusion lists of the candidates are turned into a reverse index (excluded user id -> rows that
+    exclude this user) at build time.
+    """
+
+    def __init__(self, users: Iterable[UserModel], watermark_ts: int = 0) -> None:
+        self.watermark_ts = watermark_ts  # the changes that happened after this moment might be missing
+
+        users = list(users)
+        self.user_ids: List[Text] = [user.user_id for user in users]
+        self.rows: Dict[Text, int] = {user_id: row for row, user_id in enumerate(self.user_ids)}
+
+        self.native_codes: Dict[Text, int] = {}
+        self.state, self.state_timeout_ts, self.activity_timestamp, self.native, self.newbie = self._to_columns(users)
+
+        self.excluded_by: Dict[Text, List[int]] = {}
+        self._excluded_ids: Dict[int, Set[Text]] = {}  # the same index the other way around (row -> excluded ids)
+        for row, user in enumerate(users):
+            self._index_exclusions(row, user)
+
+    def _to_columns(self, users: List[UserModel]) -> Tuple[np.ndarray, ...]:
+        return (
+            np.array([STATE_CODES.get(user.state, -1) for user in users], dtype=np.int16),
+            np.array([user.state_timeout_ts or 0 for user in users], dtype=np.int64),
+            np.array([user.activity_timestamp or 0 for user in users], dtype=np.int64),
+            np.array([self.native_codes.setdefault(user.native, len(self.native_codes)) for user in users],
+                     dtype=np.int32),
+            np.array([bool(user.newbie) for user in users], dtype=bool),
+        )
+
+    def _index_exclusions(self, row: int, user: UserModel) -> None:
+        # seen partners should NOT discover, BUT they should BE discoverable (hence only the candidate's seen list)
+        excluded_ids = {
+            *(user.roomed_partner_ids or []),
+            *(user.rejected_partner_ids or []),
+            *(user.seen_partner_ids or []),
+        }
+        old_excluded_ids = self._excluded_ids.get(row, set())
+        for excluded_id in old_excluded_ids - excluded_ids:
+            rows = self.excluded_by[excluded_id]
+            rows.remove(row)
+            if not rows:
+                del self.excluded_by[excluded_id]
+        for excluded_id in excluded_ids - old_excluded_ids:
+            self.excluded_by.setdefault(excluded_id, []).append(row)
+        self._excluded_ids[row] = excluded_ids
+
+    def upsert(self, users: Iterable[UserModel]) -> None:
+        """
+        Apply changed users without rebuilding the snapshot (users that are not offerable anymore simply don't pass
+        the state mask).
+        """
+        new_users = []
+        for user in users:
+            row = self.rows.get(user.user_id)
+            if row is None:
+                new_users.append(user)
+                continue
+            (self.state[row], self.state_timeout_ts[row], self.activity_timestamp[row], self.native[row],
+             self.newbie[row]) = (column[0] for column in self._to_columns([user]))
+            self._index_exclusions(row, user)
+
+        if not new_users:
+            return
+        first_new_row = len(self.user_ids)
+        for offset, user in enumerate(new_users):
+            self.user_ids.append(user.user_id)
+            self.rows[user.user_id] = first_new_row + offset
+            self._index_exclusions(first_new_row + offset, user)
+        self.state, self.state_timeout_ts, self.activity_timestamp, self.native, self.newbie = (
+            np.concatenate([old_column, new_column])
+            for old_column, new_column in zip(
+                (self.state, self.state_timeout_ts, self.activity_timestamp, self.native, self.newbie),
+                self._to_columns(new_users),
+            )
+        )
+
+    def discard(self, user_ids: Iterable[Text]) -> None:
+        """Users that are gone (their rows stay, but never pass the state mask)."""
+        for user_id in user_ids:
+            row = self.rows.get(user_id)
+            if row is not None:
+                self.state[row] = -1
+
+    def __len__(self) -> int:
+        return len(self.user_ids)
+
+    def save(self, path: Text) -> None:
+        """
+        The columns go into a NumPy file that can be memory-mapped by load(), the rest goes into a json file next to
+        it. Both are replaced atomically, one after another (load() rejects a pair that doesn't match).
+        """
+        records = np.empty(len(self), dtype=[
+            ('user_id', np.str_, max((len(user_id) for user_id in self.user_ids), default=1)),
+            ('state', self.state.dtype),
+            ('state_timeout_ts', self.state_timeout_ts.dtype),
+            ('activity_timestamp', self.activity_timestamp.dtype),
+            ('native', self.native.dtype),
+            ('newbie', self.newbie.dtype),
+        ])
+        records['user_id'] = self.user_ids
+        for column_name in records.dtype.names[1:]:
+            records[column_name] = getattr(self, column_name)
+
+        tmp_suffix = f".{os.getpid()}.tmp"
+        with open(path + tmp_suffix, 'wb') as f:
+            np.save(f, records, allow_pickle=False)
+        with open(path + '.json' + tmp_suffix, 'w', encoding='utf-8') as f:
+            json.dump({
+                'watermark_ts': self.watermark_ts,
+                'rows': len(self),
+                'state_codes': STATE_CODES,
+                'native_codes': list(self.native_codes.items()),  # natives can be None (not a valid json key)
+                'excluded_by': self.excluded_by,
+            }, f)
+        os.replace(path + tmp_suffix, path)
+        os.replace(path + '.json' + tmp_suffix, path + '.json')
+
+    @classmethod
+    def load(cls, path: Text) -> Optional['CandidateSnapshot']:
+        """
+        None if there is no usable snapshot at the path. The columns are memory-mapped copy-on-write (upserts never
+        reach the file).
+        """
+        if not os.path.exists(path) or not os.path.exists(path + '.json'):
+            return None
+        with open(path + '.json', encoding='utf-8') as f:
+            metadata = json.load(f)
+        records = np.load(path, mmap_mode='c', allow_pickle=False)
+        if len(records) != metadata['rows'] or metadata['state_codes'] != STATE_CODES:
+            # the pair was not written by the same save() or the states changed since then
+            return None
+
+        snapshot = cls([], watermark_ts=metadata['watermark_ts'])
+        snapshot.user_ids = records['user_id'].tolist()
+        snapshot.rows = {user_id: row for row, user_id in enumerate(snapshot.user_ids)}
+        snapshot.native_codes = dict(metadata['native_codes'])
+        snapshot.excluded_by = metadata['excluded_by']
+        for excluded_id, rows in snapshot.excluded_by.items():
+            for row in rows:
+                snapshot._excluded_ids.setdefault(row, set()).add(excluded_id)
+        for column_name in records.dtype.names[1:]:
+            setattr(snapshot, column_name, records[column_name])
+        return snapshot
+
+    def available_mask(self, states: Iterable[Text], current_timestamp: int) -> np.ndarray:
+        mask = np.isin(self.state, [STATE_CODES[state] for state in states])
+        mask &= ~np.isin(self.state, TIMEOUT_STATE_CODES) | (self.state_timeout_ts < current_timestamp)
+        return mask
+
+    def longest_inactive(self, states: Iterable[Text], current_timestamp: int, limit: int) -> List[Text]:
+        """Ids of at most `limit` available users, the ones that have been inactive the longest first."""
+        rows = np.flatnonzero(self.available_mask(states, current_timestamp))
+        if len(rows) > limit:
+            rows = rows[np.argpartition(self.activity_timestamp[rows], limit - 1)[:limit]]
+        rows = rows[np.argsort(self.activity_timestamp[rows], kind='stable')]
+        return [self.user_ids[row] for row in rows]
+
+    def rank(
+            self, searcher: UserModel,
+            states: Iterable[Text],
+            exclude_user_ids: Iterable[Text],
+            scorer_weights: Dict[Text, float],
+            limit: int,
+            current_timestamp: int,
+    ) -> List[Text]:
+        """Ids of the best scored available candidates for the searcher (best first)."""
+        if not len(self):
+            return []
+
+        mask = self.available_mask(states, current_timestamp)
+        mask[[self.rows[user_id] for user_id in exclude_user_ids if user_id in self.rows]] = False
+        mask[self.excluded_by.get(searcher.user_id, [])] = False
+
+        candidate_rows = np.flatnonzero(mask)
+        if not len(candidate_rows):
+            return []
+
+        scores = np.zeros(len(self), dtype=np.float64)
+        for name, weight in scorer_weights.items():
+            scores += weight * SCORERS[name](self, searcher, current_timestamp)
+        candidate_scores = scores[candidate_rows]
+
+        if len(candidate_rows) > limit:
+            top = np.argpartition(-candidate_scores, limit - 1)[:limit]
+            candidate_rows, candidate_scores = candidate_rows[top], candidate_scores[top]
+        best_first = np.argsort(-candidate_scores, kind='stable')
+        return [self.user_ids[row] for row in candidate_rows[best_first]]
+
+
+CANDIDATE_SCORER_WEIGHTS = parse_scorer_weights(CANDIDATE_SCORERS)
+
+_snapshot: Optional[CandidateSnapshot] = None
+_snapshot_built_at = 0.0
+_snapshot_saved_at: Optional[float] = None
+_feed_read_at: Optional[float] = None
+_feed_healthy_since: Optional[float] = None
+_feed_watermark_ts = 0
+
+
+def mark_fed_by_change_feed(watermark_ts: int) -> None:
+    """
+    Called after every successful read of a change feed that upserts its changes into the snapshot (even a read
+    without changes), watermark_ts - the changes made before this moment have all been upserted. While the reads
+    keep coming the snapshot does not query the db for the changes.
+    """
+    global _feed_read_at, _feed_healthy_since, _feed_watermark_ts
+    now = time.monotonic()
+    if not _is_fed(now):
+        _feed_healthy_since = now
+    _feed_read_at = now
+    _feed_watermark_ts = watermark_ts
+
+
+def mark_not_fed_by_change_feed() -> None:
+    """
+    Called when the change feed has lost some changes - the snapshot catches up on them from the db (when the feed
+    comes back, or every CANDIDATE_SNAPSHOT_TTL_SEC until then).
+    """
+    global _feed_read_at, _feed_healthy_since
+    _feed_read_at = None
+    _feed_healthy_since = None
+
+
+def _is_fed(now: float) -> bool:
+    return _feed_read_at is not None and now - _feed_read_at < CANDIDATE_SNAPSHOT_FEED_STALE_SEC
+
+
+def get_snapshot(
+        list_users: Callable[..., Iterable[UserModel]],
+        snapshot_file: Text = CANDIDATE_SNAPSHOT_FILE,
+) -> CandidateSnapshot:
+    """
+    The snapshot is shared by all the vault instances of the process. list_users(changed_since_ts=None) should list
+    the offerable users (only the ones that changed since changed_since_ts, if it is given).
+
+    The snapshot is listed in full only once - after that it catches up on the changes since its watermark. While a
+    change feed keeps the snapshot fresh (see mark_fed_by_change_feed()) it catches up only if the feed started after
+    the snapshot was built (or after the feed was down), without a change feed - every CANDIDATE_SNAPSHOT_TTL_SEC.
+
+    If there is a snapshot file, the first snapshot of the process is loaded from it (and caught up) instead of a full
+    listing, and the snapshot is saved back every CANDIDATE_SNAPSHOT_SAVE_INTERVAL_SEC. Users that have become
+    unavailable without the snapshot knowing are filtered out when the candidates are re-read.
+    """
+    global _snapshot, _snapshot_built_at, _snapshot_saved_at
+
+    now = time.monotonic()
+    if _snapshot is None and snapshot_file:
+        _snapshot = _load_snapshot_file(list_users, snapshot_file)
+        _snapshot_built_at = now
+        _snapshot_saved_at = now if _snapshot else None
+
+    if _snapshot is not None and _is_fed(now):
+        if _feed_healthy_since > _snapshot_built_at:
+            # the changes between the watermark and the start of the feed might be missing
+            _catch_up(_snapshot, list_users)
+            _snapshot_built_at = now
+        _snapshot.watermark_ts = max(_snapshot.watermark_ts, _feed_watermark_ts)
+
+    elif _snapshot is None:
+        watermark_ts = current_timestamp_int()
+        _snapshot = CandidateSnapshot(list_users(), watermark_ts=watermark_ts)
+        _snapshot_built_at = now
+
+    elif now - _snapshot_built_at >= CANDIDATE_SNAPSHOT_TTL_SEC:
+        _catch_up(_snapshot, list_users)
+        _snapshot_built_at = now
+
+    save_due = _snapshot_saved_at is None or now - _snapshot_saved_at >= CANDIDATE_SNAPSHOT_SAVE_INTERVAL_SEC
+    if snapshot_file and save_due:
+        # noinspection PyBroadException
+        try:
+            _snapshot.save(snapshot_file)
+        except Exception:
+            logger.exception('failed to save candidate snapshot to %r', snapshot_file)
+        _snapshot_saved_at = now
+    return _snapshot
+
+
+def _catch_up(snapshot: CandidateSnapshot, list_users: Callable[..., Iterable[UserModel]]) -> None:
+    watermark_ts = current_timestamp_int()
+    snapshot.upsert(list_users(changed_since_ts=snapshot.watermark_ts))
+    snapshot.watermark_ts = watermark_ts
+
+
+def _load_snapshot_file(
+        list_users: Callable[..., Iterable[UserModel]],
+        snapshot_file: Text,
+) -> Optional[CandidateSnapshot]:
+    # noinspection PyBroadException
+    try:
+        snapshot = CandidateSnapshot.load(snapshot_file)
+    except Exception:
+        logger.exception('failed to load candidate snapshot from %r', snapshot_file)
+        return None
+    if snapshot is None or current_timestamp_int() - snapshot.watermark_ts > CANDIDATE_SNAPSHOT_FILE_MAX_AGE_SEC:
+        return None
+
+    _catch_up(snapshot, list_users)
+    return snapshot
+
+
+def upsert_into_snapshot(users: Iterable[UserModel]) -> None:
+    if _snapshot is not None:
+        _snapshot.upsert(users)
+
+
+def discard_from_snapshot(user_ids: Iterable[Text]) -> None:
+    if _snapshot is not None:
+        _snapshot.discard(user_ids)
+
+
+def reset_snapshot() -> None:
+    global _snapshot, _snapshot_saved_at, _feed_read_at, _feed_healthy_since, _feed_watermark_ts
+    _snapshot = None
+    _snapshot_saved_at = None
+    _feed_read_at = None
+    _feed_healthy_since = None
+    _feed_watermark_ts = 0
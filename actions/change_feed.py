@@ -0,0 +1,368 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from dataclasses import dataclass, asdict
+from typing import Text, Any, Dict, List, Optional, Deque, Iterable
+
+from botocore.exceptions import ClientError
+
+from actions import candidate_snapshot
+from actions import user_vault
+from actions.user_state_machine import UserStateMachine, UserState, UserModel
+from actions.utils import current_timestamp_int, SwiperError
+
+logger = logging.getLogger(__name__)
+
+CHANGE_FEED = os.getenv('CHANGE_FEED', 'none')  # none | local | ddb_streams
+CHANGE_FEED_POLL_INTERVAL_SEC = float(os.getenv('CHANGE_FEED_POLL_INTERVAL_SEC', '0.5'))
+CHANGE_FEED_SHARD_REFRESH_SEC = float(os.getenv('CHANGE_FEED_SHARD_REFRESH_SEC', '30'))
+CHANGE_FEED_MAX_LOCAL_CHANGES = int(os.getenv('CHANGE_FEED_MAX_LOCAL_CHANGES', '100000'))
+# how far behind the table the records of the feed may show up (DynamoDB Streams is near real time, not real time)
+CHANGE_FEED_MAX_LAG_SEC = int(os.getenv('CHANGE_FEED_MAX_LAG_SEC', '5'))
+
+
+@dataclass
+class UserChange:
+    user_id: Text
+    old_item: Optional[Dict[Text, Any]]  # None if the user was created
+    new_item: Optional[Dict[Text, Any]]  # None if the user was deleted
+
+    @property
+    def old_state(self) -> Optional[Text]:
+        return None if self.old_item is None else self.old_item.get('state')
+
+    @property
+    def new_state(self) -> Optional[Text]:
+        return None if self.new_item is None else self.new_item.get('state')
+
+    def new_user(self) -> Optional[UserModel]:
+        if self.new_item is None:
+            return None
+        # noinspection PyProtectedMember
+        return user_vault.NaiveDdbUserVault._user_from_dict(self.new_item, UserModel)
+
+
+class IncompleteChangeFeedReadError(SwiperError):
+    """
+    Only some of the changes could be read. changes_lost=False - the rest will show up in later reads, True - some of
+    the changes are gone for good (the consumers need to catch up on them some other way).
+    """
+
+    def __init__(self, changes: List['UserChange'], changes_lost: bool) -> None:
+        super().__init__(f"incomplete change feed read ({len(changes)} changes, changes_lost={changes_lost})")
+        self.changes = changes
+        self.changes_lost = changes_lost
+
+
+class IChangeFeed(ABC):
+    @abstractmethod
+    def read_changes(self) -> List[UserChange]:
+        """
+        Changes that happened since the previous call (blocking - the pump runs it in an executor). Raises
+        IncompleteChangeFeedReadError if only some of the changes could be read.
+        """
+        raise NotImplementedError()
+
+
+class LocalChangeFeed(IChangeFeed):
+    """
+    A stand-in for DynamoDB Streams that only sees the users saved by the vaults of this process (development,
+    tests, single replica deployments).
+    """
+
+    def __init__(self, max_changes: int = CHANGE_FEED_MAX_LOCAL_CHANGES) -> None:
+        self._changes: Deque[UserChange] = deque(maxlen=max_changes)
+        self._changes_lost = False
+        self._lock = threading.Lock()
+
+    def on_user_saved(self, user: UserStateMachine, old_state: Optional[Text]) -> None:
+        # noinspection PyDataclass
+        new_item = asdict(user)
+        old_item = None if old_state is None else {'user_id': user.user_id, 'state': old_state}
+        with self._lock:
+            if len(self._changes) == self._changes.maxlen:
+                self._changes_lost = True  # the oldest change is about to be dropped
+            self._changes.append(UserChange(user_id=user.user_id, old_item=old_item, new_item=new_item))
+
+    def read_changes(self) -> List[UserChange]:
+        with self._lock:
+            changes = list(self._changes)
+            self._changes.clear()
+            changes_lost, self._changes_lost = self._changes_lost, False
+        if changes_lost:
+            raise IncompleteChangeFeedReadError(changes, changes_lost=True)
+        return changes
+
+
+class DdbStreamChangeFeed(IChangeFeed):
+    """
+    Reads the stream of the user table (StreamViewType has to be NEW_AND_OLD_IMAGES). Only the changes that happen
+    after the feed was started are read from the shards that are open at that moment, the shards that appear later
+    are read from the beginning. Shards are closed by DynamoDB every few hours, so the list of shards is refreshed
+    every CHANGE_FEED_SHARD_REFRESH_SEC.
+
+    A shard that fails doesn't stop the other shards from being read. An expired iterator is re-acquired right after
+    the last record that was read from the shard, a trimmed one - from the oldest record that is still there.
+    """
+
+    def __init__(
+            self, stream_arn: Optional[Text] = None,
+            streams_client: Any = None,
+            shard_refresh_sec: float = CHANGE_FEED_SHARD_REFRESH_SEC,
+    ) -> None:
+        if stream_arn is None or streams_client is None:
+            import boto3
+            # TODO oleksandr: is there a better way to ensure that the tests have a chance to mock boto3 ?
+            from actions.aws_resources import user_state_machine_table, AWS_REGION
+
+            stream_arn = stream_arn or user_state_machine_table.latest_stream_arn
+            streams_client = streams_client or boto3.client('dynamodbstreams', AWS_REGION)
+        from boto3.dynamodb.types import TypeDeserializer
+
+        self.stream_arn = stream_arn
+        self.streams_client = streams_client
+        self.shard_refresh_sec = shard_refresh_sec
+
+        self._deserializer = TypeDeserializer()
+        self._shard_iterators: Dict[Text, Optional[Text]] = {}  # None - the shard is finished
+        self._initial_iterator_types: Dict[Text, Text] = {}
+        self._sequence_numbers: Dict[Text, Text] = {}  # the last record that was read from the shard
+        self._changes_lost = False  # records were trimmed before they were read (not reported yet)
+        self._shards_refreshed_at: Optional[float] = None
+
+    def read_changes(self) -> List[UserChange]:
+        if self._shards_refreshed_at is None or time.monotonic() - self._shards_refreshed_at >= self.shard_refresh_sec:
+            self._refresh_shards()
+
+        changes = []
+        errors = []
+        open_shard_ids = [shard_id for shard_id, shard_iterator in self._shard_iterators.items() if shard_iterator]
+        for shard_id in open_shard_ids:
+            try:
+                changes.extend(self._read_shard(shard_id))
+            except Exception as e:
+                logger.exception('CHANGE FEED SHARD %r FAILED', shard_id)
+                errors.append(e)
+
+        if errors and len(errors) == len(open_shard_ids):
+            raise errors[0]  # nothing was read at all - let the pump know
+        if errors or self._changes_lost:
+            # the failed shards are read from the same place next time, the trimmed records are gone though
+            changes_lost, self._changes_lost = self._changes_lost, False
+            raise IncompleteChangeFeedReadError(changes, changes_lost=changes_lost)
+        return changes
+
+    def _read_shard(self, shard_id: Text) -> List[UserChange]:
+        try:
+            response = self.streams_client.get_records(ShardIterator=self._shard_iterators[shard_id])
+        except ClientError as e:
+            error_code = e.response.get('Error', {}).get('Code')
+            if error_code not in ['ExpiredIteratorException', 'TrimmedDataAccessException']:
+                raise
+            logger.warning('CHANGE FEED SHARD %r: %s - RE-ACQUIRING THE ITERATOR', shard_id, error_code)
+            trimmed = error_code == 'TrimmedDataAccessException'  # the records we haven't read yet are gone
+            if trimmed:
+                self._changes_lost = True
+            self._shard_iterators[shard_id] = self._get_shard_iterator(shard_id, trimmed=trimmed)
+            response = self.streams_client.get_records(ShardIterator=self._shard_iterators[shard_id])
+
+        records = response['Records']
+        if records:
+            self._sequence_numbers[shard_id] = records[-1]['dynamodb']['SequenceNumber']
+        # a closed shard doesn't return NextShardIterator once it was read to the end
+        self._shard_iterators[shard_id] = response.get('NextShardIterator')
+        return [self._to_change(record) for record in records]
+
+    def _get_shard_iterator(self, shard_id: Text, trimmed: bool) -> Text:
+        if trimmed:
+            iterator_kwargs = {'ShardIteratorType': 'TRIM_HORIZON'}
+        elif shard_id in self._sequence_numbers:
+            iterator_kwargs = {
+                'ShardIteratorType': 'AFTER_SEQUENCE_NUMBER',
+                'SequenceNumber': self._sequence_numbers[shard_id],
+            }
+        else:
+            iterator_kwargs = {'ShardIteratorType': self._initial_iterator_types[shard_id]}
+        return self.streams_client.get_shard_iterator(
+            StreamArn=self.stream_arn,
+            ShardId=shard_id,
+            **iterator_kwargs,
+        )['ShardIterator']
+
+    def _refresh_shards(self) -> None:
+        initial_refresh = self._shards_refreshed_at is None
+        shard_ids = []
+        describe_kwargs = {'StreamArn': self.stream_arn}
+        while True:
+            description = self.streams_client.describe_stream(**describe_kwargs)['StreamDescription']
+            shard_ids.extend(shard['ShardId'] for shard in description['Shards'])
+            if not description.get('LastEvaluatedShardId'):
+                break
+            describe_kwargs['ExclusiveStartShardId'] = description['LastEvaluatedShardId']
+
+        for shard_id in shard_ids:
+            if shard_id in self._shard_iterators:
+                continue
+            self._initial_iterator_types[shard_id] = 'LATEST' if initial_refresh else 'TRIM_HORIZON'
+            self._shard_iterators[shard_id] = self._get_shard_iterator(shard_id, trimmed=False)
+
+        # forget the finished shards that are not part of the stream anymore
+        for shard_id in [s for s, shard_iterator in self._shard_iterators.items() if shard_iterator is None]:
+            if shard_id not in shard_ids:
+                del self._shard_iterators[shard_id]
+                self._initial_iterator_types.pop(shard_id, None)
+                self._sequence_numbers.pop(shard_id, None)
+        self._shards_refreshed_at = time.monotonic()
+
+    def _to_change(self, record: Dict[Text, Any]) -> UserChange:
+        stream_record = record['dynamodb']
+        old_item = self._deserialize(stream_record.get('OldImage'))
+        new_item = self._deserialize(stream_record.get('NewImage'))
+        user_id = self._deserializer.deserialize(stream_record['Keys']['user_id'])
+        return UserChange(user_id=user_id, old_item=old_item, new_item=new_item)
+
+    def _deserialize(self, image: Optional[Dict[Text, Any]]) -> Optional[Dict[Text, Any]]:
+        if image is None:
+            return None
+        return {key: self._deserializer.deserialize(value) for key, value in image.items()}
+
+
+class IChangeConsumer(ABC):
+    @abstractmethod
+    def apply(self, changes: List[UserChange]) -> None:
+        raise NotImplementedError()
+
+    def caught_up(self, read_started_ts: int) -> None:
+        """
+        Called after every complete read of the feed (even if there were no changes) - the changes made before
+        read_started_ts (give or take CHANGE_FEED_MAX_LAG_SEC) have all been applied by now.
+        """
+
+    def changes_lost(self) -> None:
+        """Called when some of the changes are gone from the feed without ever being read."""
+
+
+class VaultCachesConsumer(IChangeConsumer):
+    """
+    Keeps the partner search caches of this process fresh with the changes made by any replica: the offerable pool
+    version (search ticks and empty pool cache) and the candidate snapshot.
+    """
+
+    def apply(self, changes: List[UserChange]) -> None:
+        became_offerable = False
+        changed_users = []
+        for change in changes:
+            if change.new_state in UserState.offerable_states and change.old_state != change.new_state:
+                became_offerable = True
+            new_user = change.new_user()
+            if new_user is not None:
+                changed_users.append(new_user)
+
+        if became_offerable:
+            user_vault.notify_offerable_pool_changed()
+        if changed_users:
+            candidate_snapshot.upsert_into_snapshot(changed_users)
+
+    def caught_up(self, read_started_ts: int) -> None:
+        candidate_snapshot.mark_fed_by_change_feed(read_started_ts - CHANGE_FEED_MAX_LAG_SEC)
+
+    def changes_lost(self) -> None:
+        # the snapshot catches up on the changes since its watermark when the feed is back to complete reads
+        candidate_snapshot.mark_not_fed_by_change_feed()
+
+
+class ChangeFeedPump:
+    """
+    Polls the feed from a single asyncio task of the action server and hands the changes over to the consumers.
+    """
+
+    def __init__(
+            self, feed: IChangeFeed,
+            consumers: Iterable[IChangeConsumer],
+            poll_interval_sec: float = CHANGE_FEED_POLL_INTERVAL_SEC,
+    ) -> None:
+        self.feed = feed
+        self.consumers = list(consumers)
+        self.poll_interval_sec = poll_interval_sec
+
+        self._task: Optional[asyncio.Future] = None
+
+    def ensure_running(self) -> None:
+        loop = asyncio.get_event_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            started_at = loop.time()
+            # noinspection PyBroadException
+            try:
+                await self.pump_once()
+            except Exception:
+                logger.exception('CHANGE FEED READ FAILED')
+
+            await asyncio.sleep(max(0.0, self.poll_interval_sec - (loop.time() - started_at)))
+
+    async def pump_once(self) -> None:
+        read_started_ts = current_timestamp_int()
+        try:
+            changes = await asyncio.get_event_loop().run_in_executor(None, self.feed.read_changes)
+        except IncompleteChangeFeedReadError as e:
+            logger.warning('%s', e)
+            # the changes that were read are good, but the consumers are not caught up
+            self.apply(e.changes)
+            if e.changes_lost:
+                self.changes_lost()
+            return
+
+        self.apply(changes)
+        self.caught_up(read_started_ts)
+
+    def apply(self, changes: List[UserChange]) -> None:
+        if not changes:
+            return
+        for consumer in self.consumers:
+            # noinspection PyBroadException
+            try:
+                consumer.apply(changes)
+            except Exception:
+                logger.exception('CHANGE CONSUMER %r FAILED', type(consumer).__name__)
+
+    def caught_up(self, read_started_ts: int) -> None:
+        for consumer in self.consumers:
+            # noinspection PyBroadException
+            try:
+                consumer.caught_up(read_started_ts)
+            except Exception:
+                logger.exception('CHANGE CONSUMER %r FAILED', type(consumer).__name__)
+
+    def changes_lost(self) -> None:
+        for consumer in self.consumers:
+            # noinspection PyBroadException
+            try:
+                consumer.changes_lost()
+            except Exception:
+                logger.exception('CHANGE CONSUMER %r FAILED', type(consumer).__name__)
+
+
+def create_change_feed_pump(change_feed: Text = CHANGE_FEED) -> Optional[ChangeFeedPump]:
+    if change_feed == 'none':
+        return None
+
+    if change_feed == 'local':
+        feed = LocalChangeFeed()
+        user_vault.save_listeners.append(feed.on_user_saved)
+    elif change_feed == 'ddb_streams':
+        feed = DdbStreamChangeFeed()
+    else:
+        raise ValueError(f"unknown change feed {repr(change_feed)} (expected none, local or ddb_streams)")
+
+    return ChangeFeedPump(feed, [VaultCachesConsumer()])
+
+
+change_feed_pump = create_change_feed_pump()
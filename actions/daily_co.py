@@ -6,6 +6,7 @@ from urllib.parse import quote as urlencode
 
 import aiohttp
 
+from actions import rate_limiter
 from actions.utils import SwiperDailyCoError, current_timestamp_int
 
 logger = logging.getLogger(__name__)
@@ -18,6 +19,8 @@ DAILY_CO_MEETING_DURATION_SEC = int(os.getenv('DAILY_CO_MEETING_DURATION_SEC', '
 
 
 async def create_room(sender_id: Text) -> Dict[Text, Any]:
+    await rate_limiter.rate_governor.daily_co_room_creation()
+
     # TODO oleksandr: do I need to reuse ClientSession instance ? what should be its lifetime ?
     async with aiohttp.ClientSession() as session:
         room_data = {
@@ -0,0 +1,197 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Text, List, Tuple, Optional, Iterable, Dict, Set
+
+from actions import candidate_snapshot
+from actions import outbox
+from actions import rasa_callbacks
+from actions import telegram_helpers
+from actions.user_state_machine import UserStateMachine, UserState
+from actions.user_vault import UserVault, IUserVault, get_offerable_tiers
+from actions.utils import current_timestamp_int
+
+logger = logging.getLogger(__name__)
+
+MATCHMAKER_INTERVAL_SEC = float(os.getenv('MATCHMAKER_INTERVAL_SEC', '3'))
+# the searchers that have been inactive the longest are paired first, the rest wait for the next pass
+MATCHMAKER_MAX_SEARCHERS_PER_PASS = int(os.getenv('MATCHMAKER_MAX_SEARCHERS_PER_PASS', '100'))
+# the best scored candidates of every searcher (per tier) that are re-read from the db and take part in the pairing
+MATCHMAKER_CANDIDATES_PER_SEARCHER = int(os.getenv('MATCHMAKER_CANDIDATES_PER_SEARCHER', '5'))
+
+# (searcher, partner who is going to be asked to join the searcher)
+Pair = Tuple[UserStateMachine, UserStateMachine]
+
+
+def are_compatible(searcher: UserStateMachine, partner: UserStateMachine) -> bool:
+    if searcher.user_id == partner.user_id:
+        return False
+    if (
+            partner.user_id in (searcher.roomed_partner_ids or []) or
+            partner.user_id in (searcher.rejected_partner_ids or [])
+    ):
+        return False
+    # seen partners should NOT discover, BUT they should BE discoverable (same as in the partner search of the vault)
+    return not (
+            searcher.user_id in (partner.roomed_partner_ids or []) or
+            searcher.user_id in (partner.rejected_partner_ids or []) or
+            searcher.user_id in (partner.seen_partner_ids or [])
+    )
+
+
+def compute_pairing(
+        searchers: Iterable[UserStateMachine],
+        candidate_tiers: List[List[UserStateMachine]],
+) -> List[Pair]:
+    """
+    Greedy global pairing in which every user takes part in at most one pair. The searchers with the fewest compatible
+    candidates choose first (the ones who have been searching the longest win the ties), so a searcher with many
+    options doesn't take away the only option of another searcher. Every searcher prefers higher tiers and, within a
+    tier, the most recently active candidates (same as the partner search of the vault).
+    """
+    candidates: List[UserStateMachine] = []
+    listed_user_ids: Set[Text] = set()
+    for tier in candidate_tiers:
+        for candidate in sorted(tier, key=lambda u: u.activity_timestamp or 0, reverse=True):
+            if candidate.user_id not in listed_user_ids:
+                listed_user_ids.add(candidate.user_id)
+                candidates.append(candidate)
+
+    searchers = list(searchers)
+    options: Dict[Text, List[UserStateMachine]] = {
+        searcher.user_id: [candidate for candidate in candidates if are_compatible(searcher, candidate)]
+        for searcher in searchers
+    }
+    searchers = sorted(searchers, key=lambda u: (len(options[u.user_id]), u.state_timestamp or 0))
+
+    paired_user_ids: Set[Text] = set()
+    pairs: List[Pair] = []
+    for searcher in searchers:
+        if searcher.user_id in paired_user_ids:
+            continue  # another searcher has already picked this one
+        partner = next((c for c in options[searcher.user_id] if c.user_id not in paired_user_ids), None)
+        if partner is None:
+            continue
+
+        paired_user_ids.add(searcher.user_id)
+        paired_user_ids.add(partner.user_id)
+        pairs.append((searcher, partner))
+    return pairs
+
+
+def _is_offerable(user: UserStateMachine, states: List[Text], current_timestamp: int) -> bool:
+    if user.state not in states:
+        return False
+    return user.state not in UserState.states_with_timeouts or (user.state_timeout_ts or 0) < current_timestamp
+
+
+def shortlist(
+        user_vault: IUserVault,
+        current_timestamp: int,
+        max_searchers: int = MATCHMAKER_MAX_SEARCHERS_PER_PASS,
+        candidates_per_searcher: int = MATCHMAKER_CANDIDATES_PER_SEARCHER,
+) -> Tuple[List[UserStateMachine], List[List[UserStateMachine]]]:
+    """
+    Searchers and candidate tiers for compute_pairing() taken from the candidate snapshot instead of listing the whole
+    pool: at most max_searchers searchers and their best scored candidates. The snapshot may be outdated, hence all of
+    them are re-read from the db (and the snapshot is updated with what was read).
+    """
+    snapshot = user_vault.get_candidate_snapshot()
+    tiers = get_offerable_tiers()
+
+    users: Dict[Text, Optional[UserStateMachine]] = {}
+
+    def read_users(user_ids: Iterable[Text]) -> None:
+        new_user_ids = [user_id for user_id in dict.fromkeys(user_ids) if user_id not in users]
+        for user_id in new_user_ids:
+            users[user_id] = user_vault.get_existing_user(user_id)
+        candidate_snapshot.discard_from_snapshot([user_id for user_id in new_user_ids if users[user_id] is None])
+        candidate_snapshot.upsert_into_snapshot([users[user_id] for user_id in new_user_ids if users[user_id]])
+
+    searcher_ids = snapshot.longest_inactive([UserState.WANTS_CHITCHAT], current_timestamp, max_searchers)
+    read_users(searcher_ids)
+    searchers = [
+        users[user_id] for user_id in searcher_ids
+        if users[user_id] and users[user_id].state == UserState.WANTS_CHITCHAT
+    ]
+
+    # the searchers themselves are candidates for each other (they have been read already anyway)
+    tier_candidate_ids: List[List[Text]] = [[searcher.user_id for searcher in searchers] for _ in tiers]
+    for searcher in searchers:
+        exclude_user_ids = [
+            searcher.user_id,
+            *(searcher.roomed_partner_ids or []),
+            *(searcher.rejected_partner_ids or []),
+        ]
+        for tier_idx, tier in enumerate(tiers):
+            tier_candidate_ids[tier_idx].extend(snapshot.rank(
+                searcher,
+                tier,
+                exclude_user_ids,
+                candidate_snapshot.CANDIDATE_SCORER_WEIGHTS,
+                candidates_per_searcher,
+                current_timestamp,
+            ))
+    read_users(user_id for candidate_ids in tier_candidate_ids for user_id in candidate_ids)
+
+    candidate_tiers = []
+    for tier, candidate_ids in zip(tiers, tier_candidate_ids):
+        candidate_tiers.append([
+            users[user_id] for user_id in dict.fromkeys(candidate_ids)
+            if users[user_id] and _is_offerable(users[user_id], tier, current_timestamp)
+        ])
+    return searchers, candidate_tiers
+
+
+async def match_once(user_vault: Optional[IUserVault] = None) -> List[Pair]:
+    user_vault = user_vault or UserVault()
+
+    searchers, candidate_tiers = shortlist(user_vault, current_timestamp_int())
+    pairs = compute_pairing(searchers, candidate_tiers)
+    if not pairs:
+        return pairs
+
+    loop = asyncio.get_event_loop()
+    photo_file_ids = await asyncio.gather(*(
+        loop.run_in_executor(None, telegram_helpers.get_user_profile_photo_file_id, searcher.user_id)
+        for searcher, _ in pairs
+    ))
+
+    side_effect_outbox = outbox.SideEffectOutbox('matchmaker')
+    for (searcher, partner), photo_file_id in zip(pairs, photo_file_ids):
+        side_effect_outbox.defer(
+            rasa_callbacks.ask_to_join,
+            searcher.user_id,
+            partner,
+            photo_file_id,
+            searcher.get_first_name(),
+            suppress_callback_errors=True,
+        )
+    await side_effect_outbox.flush()
+
+    logger.info('MATCHMAKER: %s searchers, %s pairs', len(searchers), len(pairs))
+    return pairs
+
+
+async def run_forever() -> None:
+    """
+    Pair all the searching users at once every MATCHMAKER_INTERVAL_SEC (set MATCHMAKER_ENABLED=true for the action
+    server when this job is running, so individual searches stop asking partners on their own):
+
+        python -m actions.matchmaker
+    """
+    while True:
+        started_at = time.monotonic()
+        # noinspection PyBroadException
+        try:
+            await match_once()
+        except Exception:
+            logger.exception('matchmaking failed')
+
+        await asyncio.sleep(max(0.0, MATCHMAKER_INTERVAL_SEC - (time.monotonic() - started_at)))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run_forever())
@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import os
+from contextvars import ContextVar
+from typing import Text, Callable, Awaitable, Any, List, Tuple, Dict, Set, Optional
+
+from actions.utils import SwiperError, ACTION_SERVER_WORKER_COUNT
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_MAX_CONCURRENCY = int(os.getenv('OUTBOX_MAX_CONCURRENCY', '20'))
+
+SideEffect = Tuple[Callable[..., Awaitable[Any]], Tuple[Any, ...], Dict[Text, Any]]
+
+_current_outbox = ContextVar('current_outbox', default=None)
+
+_pending_tasks: Set[asyncio.Future] = set()
+_semaphore: Optional[asyncio.Semaphore] = None
+_semaphore_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    """
+    One semaphore per event loop bounds the number of side effects that are executed concurrently across all actions.
+    """
+    global _semaphore, _semaphore_loop
+
+    loop = asyncio.get_event_loop()
+    if _semaphore is None or _semaphore_loop is not loop:
+        # OUTBOX_MAX_CONCURRENCY is for the whole action server - the worker processes of a sharded one split it
+        _semaphore = asyncio.Semaphore(max(1, OUTBOX_MAX_CONCURRENCY // ACTION_SERVER_WORKER_COUNT))
+        _semaphore_loop = loop
+    return _semaphore
+
+
+class SideEffectOutbox:
+    """
+    Collects non-essential outbound calls of an action so they could be executed (concurrently) after the action has
+    produced its response instead of delaying the response.
+    """
+
+    def __init__(self, owner_name: Text) -> None:
+        self.owner_name = owner_name
+        self._side_effects: List[SideEffect] = []
+
+    def __enter__(self) -> 'SideEffectOutbox':
+        self._context_token = _current_outbox.set(self)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        _current_outbox.reset(self._context_token)
+
+    def defer(self, coroutine_function: Callable[..., Awaitable[Any]], *args, **kwargs) -> None:
+        self._side_effects.append((coroutine_function, args, kwargs))
+
+    def flush(self) -> Optional[asyncio.Future]:
+        """Schedule all the collected side effects for execution and return without waiting for them."""
+        if not self._side_effects:
+            return None
+
+        side_effects, self._side_effects = self._side_effects, []
+
+        task = asyncio.ensure_future(self._execute_all(side_effects))
+        _pending_tasks.add(task)
+        task.add_done_callback(_pending_tasks.discard)
+        return task
+
+    async def _execute_all(self, side_effects: List[SideEffect]) -> None:
+        await asyncio.gather(*(self._execute(side_effect) for side_effect in side_effects))
+
+    async def _execute(self, side_effect: SideEffect) -> None:
+        coroutine_function, args, kwargs = side_effect
+
+        async with _get_semaphore():
+            # noinspection PyBroadException
+            try:
+                await coroutine_function(*args, **kwargs)
+            except Exception:
+                logger.exception(
+                    'DEFERRED SIDE EFFECT %r OF %r FAILED',
+                    getattr(coroutine_function, '__name__', coroutine_function),
+                    self.owner_name,
+                )
+
+
+def defer(coroutine_function: Callable[..., Awaitable[Any]], *args, **kwargs) -> None:
+    """Defer a side effect using the outbox of the action that is currently being run."""
+    outbox = _current_outbox.get()
+    if outbox is None:
+        raise SwiperError('an attempt to defer a side effect outside of SideEffectOutbox context')
+    outbox.defer(coroutine_function, *args, **kwargs)
+
+
+async def wait_for_pending_side_effects() -> None:
+    """Mostly useful for graceful shutdown and for tests."""
+    while _pending_tasks:
+        await asyncio.gather(*list(_pending_tasks))
@@ -5,6 +5,7 @@ from typing import Text, Dict, Any, Optional
 
 import aiohttp
 
+from actions import rate_limiter
 from actions.user_state_machine import UserStateMachine
 from actions.utils import SwiperRasaCallbackError
 
@@ -163,6 +164,9 @@ async def _trigger_external_rasa_intent(
         resp_json = None
         resp_exc = None
         try:
+            # every triggered intent results in a Telegram message being sent to the receiver
+            await rate_limiter.rate_governor.telegram_message(receiver.user_id)
+
             async with session.post(
                     f"{RASA_PRODUCTION_HOST}/conversations/{receiver.user_id}/trigger_intent",
                     params=params,
@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Text, Dict, Optional
+
+from actions.utils import SwiperRateLimitError, ACTION_SERVER_WORKER_COUNT
+
+logger = logging.getLogger(__name__)
+
+# https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+TELEGRAM_GLOBAL_MSG_PER_SEC = float(os.getenv('TELEGRAM_GLOBAL_MSG_PER_SEC', '25'))  # Telegram allows ~30
+TELEGRAM_PER_CHAT_MSG_PER_SEC = float(os.getenv('TELEGRAM_PER_CHAT_MSG_PER_SEC', '1'))
+TELEGRAM_PER_CHAT_MSG_BURST = int(os.getenv('TELEGRAM_PER_CHAT_MSG_BURST', '3'))
+DAILY_CO_ROOMS_PER_SEC = float(os.getenv('DAILY_CO_ROOMS_PER_SEC', '5'))
+DAILY_CO_ROOMS_BURST = int(os.getenv('DAILY_CO_ROOMS_BURST', '5'))
+RATE_LIMIT_MAX_QUEUE_SEC = float(os.getenv('RATE_LIMIT_MAX_QUEUE_SEC', '10'))
+
+MAX_IDLE_CHAT_BUCKETS = 1000
+
+
+class TokenBucket:
+    """
+    A token bucket that lets callers "borrow" tokens from the future - when the bucket is empty the caller gets a delay
+    to sleep for instead of a refusal, which effectively turns the bucket into a queue that smooths out bursts.
+    """
+
+    def __init__(self, rate_per_sec: float, burst: int = 1) -> None:
+        if rate_per_sec <= 0:
+            raise ValueError('rate_per_sec should be positive')
+        if burst < 1:
+            raise ValueError('burst should be at least 1')
+
+        self.rate_per_sec = rate_per_sec
+        self.burst = burst
+
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate_per_sec)
+        self._updated_at = now
+
+    def reserve(self, max_delay_sec: Optional[float] = None) -> Optional[float]:
+        """
+        Take one token and return how many seconds the caller should wait before it is allowed to proceed
+        (0 if a token is available right away). None is returned (and no token is taken) if the wait would
+        exceed max_delay_sec.
+        """
+        self._refill()
+
+        delay_sec = max(0.0, (1 - self._tokens) / self.rate_per_sec)
+        if max_delay_sec is not None and delay_sec > max_delay_sec:
+            return None
+
+        self._tokens -= 1
+        return delay_sec
+
+    def refund(self) -> None:
+        self._tokens = min(self.burst, self._tokens + 1)
+
+    def is_idle(self) -> bool:
+        self._refill()
+        return self._tokens >= self.burst
+
+
+class RateGovernor:
+    """
+    Smooths outgoing traffic per destination so that bursts are queued for a short while instead of being lost.
+    """
+
+    def __init__(self, worker_count: int = ACTION_SERVER_WORKER_COUNT) -> None:
+        # the global budgets are shared by all the worker processes of the action server (per-chat ones are not split:
+        # a chat is mostly talked to by the worker its user is routed to)
+        telegram_global_msg_per_sec = TELEGRAM_GLOBAL_MSG_PER_SEC / worker_count
+        self.telegram_global_bucket = TokenBucket(
+            telegram_global_msg_per_sec, burst=max(1, int(telegram_global_msg_per_sec)),
+        )
+        self.daily_co_rooms_bucket = TokenBucket(
+            DAILY_CO_ROOMS_PER_SEC / worker_count, burst=max(1, DAILY_CO_ROOMS_BURST // worker_count),
+        )
+        self._telegram_chat_buckets: Dict[Text, TokenBucket] = {}
+
+    def _get_telegram_chat_bucket(self, chat_id: Text) -> TokenBucket:
+        bucket = self._telegram_chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._telegram_chat_buckets) >= MAX_IDLE_CHAT_BUCKETS:
+                self._drop_idle_chat_buckets()
+
+            bucket = TokenBucket(TELEGRAM_PER_CHAT_MSG_PER_SEC, burst=TELEGRAM_PER_CHAT_MSG_BURST)
+            self._telegram_chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _drop_idle_chat_buckets(self) -> None:
+        # an idle bucket is a full bucket, and a full bucket is indistinguishable from a freshly created one
+        self._telegram_chat_buckets = {
+            chat_id: bucket
+            for chat_id, bucket in self._telegram_chat_buckets.items()
+            if not bucket.is_idle()
+        }
+
+    async def telegram_message(self, chat_id: Text) -> None:
+        """Wait for a slot to send one message to a Telegram chat (both global and per-chat budgets apply)."""
+        await self._acquire(
+            f"telegram chat {repr(chat_id)}",
+            self.telegram_global_bucket,
+            self._get_telegram_chat_bucket(chat_id),
+        )
+
+    async def daily_co_room_creation(self) -> None:
+        """Wait for a slot to create one Daily.co room."""
+        await self._acquire('daily.co room creation', self.daily_co_rooms_bucket)
+
+    @staticmethod
+    async def _acquire(destination: Text, *buckets: TokenBucket) -> None:
+        reserved_buckets = []
+        delay_sec = 0.0
+
+        for bucket in buckets:
+            bucket_delay_sec = bucket.reserve(max_delay_sec=RATE_LIMIT_MAX_QUEUE_SEC)
+            if bucket_delay_sec is None:
+                for reserved_bucket in reserved_buckets:
+                    reserved_bucket.refund()
+                raise SwiperRateLimitError(
+                    f"outgoing queue for {destination} is longer than {RATE_LIMIT_MAX_QUEUE_SEC} seconds"
+                )
+
+            reserved_buckets.append(bucket)
+            delay_sec = max(delay_sec, bucket_delay_sec)
+
+        if delay_sec > 0:
+            logger.info('RATE LIMIT: delaying %s by %.3f sec', destination, delay_sec)
+            await asyncio.sleep(delay_sec)
+
+
+rate_governor = RateGovernor()
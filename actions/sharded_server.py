@@ -0,0 +1,214 @@
+import argparse
+import asyncio
+import bisect
+import hashlib
+import logging
+import os
+import re
+import signal
+import subprocess
+import sys
+from typing import Text, List, Dict
+
+import aiohttp
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+ACTION_SERVER_PORT = int(os.getenv('ACTION_SERVER_PORT', '5055'))
+ACTION_SERVER_WORKERS = int(os.getenv('ACTION_SERVER_WORKERS', '0'))  # 0 - one worker per core
+ACTION_SERVER_WORKER_BASE_PORT = int(os.getenv('ACTION_SERVER_WORKER_BASE_PORT', '5100'))
+ACTION_SERVER_VIRTUAL_NODES = int(os.getenv('ACTION_SERVER_VIRTUAL_NODES', '100'))
+ACTION_SERVER_WORKER_START_TIMEOUT_SEC = float(os.getenv('ACTION_SERVER_WORKER_START_TIMEOUT_SEC', '60'))
+
+# both the request itself and the tracker inside of it carry the sender id - the value is the same
+SENDER_ID_RE = re.compile(rb'"sender_id"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+
+class ConsistentHashRing:
+    """
+    Every node owns many points on the ring (virtual nodes), a key belongs to the first point that follows the hash of
+    the key. When a node is added or removed only the keys of that node move.
+    """
+
+    def __init__(self, nodes: List[Text], virtual_nodes: int = ACTION_SERVER_VIRTUAL_NODES) -> None:
+        points = sorted(
+            (self._hash(f"{node}#{virtual_node}"), node) for node in nodes for virtual_node in range(virtual_nodes)
+        )
+        self._hashes = [point_hash for point_hash, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def get_node(self, key: Text) -> Text:
+        idx = bisect.bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._nodes[idx]
+
+    @staticmethod
+    def _hash(key: Text) -> int:
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+def extract_sender_id(body: bytes) -> Text:
+    # a regex instead of json parsing - trackers can be big and the router has only one core to parse all of them
+    match = SENDER_ID_RE.search(body)
+    return '' if match is None else match.group(1).decode('utf-8')
+
+
+def create_router_app(worker_urls: List[Text]) -> web.Application:
+    """
+    Forwards webhook requests of Rasa to the worker that owns the sender, so the process local state of a user
+    (caches, timers, in-process search ticks) always lives in the same worker. Everything else goes to the first
+    worker.
+    """
+    ring = ConsistentHashRing(worker_urls)
+    app = web.Application(client_max_size=0)
+
+    async def start_session(_app: web.Application) -> None:
+        _app['session'] = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0))
+
+    async def close_session(_app: web.Application) -> None:
+        await _app['session'].close()
+
+    async def forward(request: web.Request, worker_url: Text) -> web.Response:
+        body = await request.read()
+        headers = {'Content-Type': request.headers.get('Content-Type', 'application/json')}
+        try:
+            async with request.app['session'].request(
+                    request.method, worker_url + request.path_qs, data=body, headers=headers,
+            ) as response:
+                return web.Response(
+                    body=await response.read(),
+                    status=response.status,
+                    headers={'Content-Type': response.headers.get('Content-Type', 'application/json')},
+                )
+        except aiohttp.ClientConnectionError:
+            logger.exception('WORKER %r IS UNAVAILABLE', worker_url)
+            return web.Response(status=502)
+
+    async def handle_webhook(request: web.Request) -> web.Response:
+        body = await request.read()
+        return await forward(request, ring.get_node(extract_sender_id(body)))
+
+    async def handle_other(request: web.Request) -> web.Response:
+        return await forward(request, worker_urls[0])
+
+    app.on_startup.append(start_session)
+    app.on_cleanup.append(close_session)
+    app.router.add_post('/webhook', handle_webhook)
+    app.router.add_route('*', '/{tail:.*}', handle_other)
+    return app
+
+
+class WorkerPool:
+    """
+    One rasa_sdk action server process per worker (the whole of actions/actions.py runs on a single event loop, so
+    this is the way to use more than one core). Workers that die are restarted on the same port, so the routing of
+    users doesn't change.
+
+    NOTE: CHANGE_FEED=local only sees the saves of its own worker - use ddb_streams with more than one worker.
+    """
+
+    def __init__(self, workers: int, base_port: int, actions_module: Text) -> None:
+        self.ports = [base_port + idx for idx in range(workers)]
+        self.actions_module = actions_module
+        self._processes: Dict[int, subprocess.Popen] = {}
+
+    @property
+    def worker_urls(self) -> List[Text]:
+        return [f"http://127.0.0.1:{port}" for port in self.ports]
+
+    def start(self) -> None:
+        for idx, port in enumerate(self.ports):
+            if idx in self._processes and self._processes[idx].poll() is None:
+                continue
+            if idx in self._processes:
+                logger.warning(
+                    'WORKER %s (PORT %s) EXITED WITH %s - RESTARTING', idx, port, self._processes[idx].poll(),
+                )
+            self._processes[idx] = subprocess.Popen(
+                [sys.executable, '-m', 'rasa_sdk', '--actions', self.actions_module, '--port', str(port)],
+                env={
+                    **os.environ,
+                    'ACTION_SERVER_WORKER_INDEX': str(idx),
+                    # the global budgets (Telegram rate limits etc.) are split between the workers
+                    'ACTION_SERVER_WORKER_COUNT': str(len(self.ports)),
+                },
+            )
+
+    def stop(self) -> None:
+        for process in self._processes.values():
+            process.terminate()
+        for process in self._processes.values():
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    async def wait_until_healthy(self, timeout_sec: float = ACTION_SERVER_WORKER_START_TIMEOUT_SEC) -> None:
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout_sec
+        async with aiohttp.ClientSession() as session:
+            for worker_url in self.worker_urls:
+                while True:
+                    try:
+                        async with session.get(worker_url + '/health') as response:
+                            if response.status == 200:
+                                break
+                    except aiohttp.ClientConnectionError:
+                        pass
+                    if loop.time() > deadline:
+                        raise TimeoutError(f"worker {worker_url} didn't start in {timeout_sec} seconds")
+                    await asyncio.sleep(0.2)
+
+    async def watch(self, interval_sec: float = 1) -> None:
+        while True:
+            await asyncio.sleep(interval_sec)
+            self.start()
+
+
+async def serve(
+        port: int = ACTION_SERVER_PORT,
+        workers: int = ACTION_SERVER_WORKERS,
+        base_port: int = ACTION_SERVER_WORKER_BASE_PORT,
+        actions_module: Text = 'actions',
+) -> None:
+    # stop the workers too when the router is terminated
+    asyncio.get_event_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
+    worker_pool = WorkerPool(workers or os.cpu_count() or 1, base_port, actions_module)
+    worker_pool.start()
+    runner = web.AppRunner(create_router_app(worker_pool.worker_urls))
+    try:
+        await worker_pool.wait_until_healthy()
+
+        await runner.setup()
+        await web.TCPSite(runner, port=port).start()
+        logger.info('ROUTING PORT %s TO %s WORKERS', port, len(worker_pool.ports))
+
+        await worker_pool.watch()
+    finally:
+        await runner.cleanup()
+        worker_pool.stop()
+
+
+def main() -> None:
+    """
+    Run the action server as several worker processes behind a router (instead of `rasa run actions`):
+
+        python -m actions.sharded_server --workers 4
+    """
+    parser = argparse.ArgumentParser(description='Multi-process action server with routing by sender id')
+    parser.add_argument('--port', type=int, default=ACTION_SERVER_PORT)
+    parser.add_argument('--workers', type=int, default=ACTION_SERVER_WORKERS, help='0 - one worker per core')
+    parser.add_argument('--base-port', type=int, default=ACTION_SERVER_WORKER_BASE_PORT, help='port of worker 0')
+    parser.add_argument('--actions', default='actions', help='module (package) with the actions')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(serve(args.port, args.workers, args.base_port, args.actions))
+    except asyncio.CancelledError:
+        pass  # terminated
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import os
+import time
+from typing import Text, Dict
+
+from actions.utils import ACTION_SERVER_WORKER_COUNT
+
+SEARCH_TICK_MAX_DELAY_SEC = float(os.getenv('SEARCH_TICK_MAX_DELAY_SEC', '30'))
+SEARCH_TICK_BACKOFF_FACTOR = float(os.getenv('SEARCH_TICK_BACKOFF_FACTOR', '2'))
+# how many search ticks per second all the searchers of the action server are allowed to make together (0 - no limit),
+# the worker processes of a sharded action server split it between themselves
+SEARCH_TICKS_PER_SEC_BUDGET = float(os.getenv('SEARCH_TICKS_PER_SEC_BUDGET', '0'))
+
+
+class AdaptiveTickScheduler:
+    """
+    Decides when the next search tick of a searcher should happen: right away (base delay) while partners are being
+    found or somebody has just become offerable, exponentially later while the pool stays empty. If there is a
+    budget, the searchers share it: nobody ticks more often than (number of searchers) / (ticks per second).
+    """
+
+    def __init__(
+            self, base_delay_sec: float,
+            max_delay_sec: float = SEARCH_TICK_MAX_DELAY_SEC,
+            backoff_factor: float = SEARCH_TICK_BACKOFF_FACTOR,
+            ticks_per_sec_budget: float = SEARCH_TICKS_PER_SEC_BUDGET / ACTION_SERVER_WORKER_COUNT,
+    ) -> None:
+        self.base_delay_sec = base_delay_sec
+        self.max_delay_sec = max(max_delay_sec, base_delay_sec)
+        self.backoff_factor = backoff_factor
+        self.ticks_per_sec_budget = ticks_per_sec_budget
+
+        self._empty_streaks: Dict[Text, int] = {}
+        self._pool_versions: Dict[Text, int] = {}
+        self._active_until: Dict[Text, float] = {}
+        self._next_cleanup_at = 0.0
+
+    def next_delay(self, user_id: Text, partner_found: bool, pool_version: int) -> float:
+        now = time.monotonic()
+        self._cleanup(now)
+
+        if partner_found or self._pool_versions.get(user_id) != pool_version:
+            empty_streak = 0
+        else:
+            empty_streak = self._empty_streaks.get(user_id, 0) + 1
+        self._empty_streaks[user_id] = empty_streak
+        self._pool_versions[user_id] = pool_version
+
+        delay_sec = min(self.base_delay_sec * self.backoff_factor ** empty_streak, self.max_delay_sec)
+        if self.ticks_per_sec_budget:
+            self._active_until[user_id] = now + delay_sec
+            delay_sec = max(delay_sec, len(self._active_until) / self.ticks_per_sec_budget)
+
+        self._active_until[user_id] = now + delay_sec
+        return delay_sec
+
+    def forget(self, user_id: Text) -> None:
+        self._empty_streaks.pop(user_id, None)
+        self._pool_versions.pop(user_id, None)
+        self._active_until.pop(user_id, None)
+
+    def _cleanup(self, now: float) -> None:
+        # searchers whose ticks are long overdue are not searching anymore
+        if now < self._next_cleanup_at:
+            return
+        for user_id in [u for u, active_until in self._active_until.items() if active_until + self.max_delay_sec < now]:
+            self.forget(user_id)
+        self._next_cleanup_at = now + self.max_delay_sec
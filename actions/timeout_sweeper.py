@@ -0,0 +1,41 @@
+import logging
+import os
+import time
+from collections import Counter
+from typing import Optional
+
+from actions.user_vault import UserVault, IUserVault
+
+logger = logging.getLogger(__name__)
+
+TIMEOUT_SWEEPER_INTERVAL_SEC = float(os.getenv('TIMEOUT_SWEEPER_INTERVAL_SEC', '15'))
+
+
+def sweep_once(user_vault: Optional[IUserVault] = None) -> Counter:
+    outcomes = (user_vault or UserVault()).sweep_timed_out_users()
+    if outcomes:
+        logger.info('TIMEOUT SWEEP: %s', dict(outcomes))
+    return outcomes
+
+
+def run_forever() -> None:
+    """
+    Periodically move users whose state has timed out to OK_TO_CHITCHAT, so partner search could skip the swept states
+    altogether (set TIMEOUT_SWEEPER_ENABLED=true for the action server when this job is running):
+
+        python -m actions.timeout_sweeper
+    """
+    while True:
+        started_at = time.monotonic()
+        # noinspection PyBroadException
+        try:
+            sweep_once()
+        except Exception:
+            logger.exception('timeout sweep failed')
+
+        time.sleep(max(0.0, TIMEOUT_SWEEPER_INTERVAL_SEC - (time.monotonic() - started_at)))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    run_forever()
@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import math
+import os
+from typing import Text, Callable, Awaitable, Any, Dict, List, Set, Optional
+
+logger = logging.getLogger(__name__)
+
+TIMER_WHEEL_TICK_SEC = float(os.getenv('TIMER_WHEEL_TICK_SEC', '0.1'))
+TIMER_WHEEL_SIZE = int(os.getenv('TIMER_WHEEL_SIZE', '512'))
+
+
+class HashedTimerWheel:
+    """
+    Keyed timers driven by a single asyncio task: a timer is placed into the slot of the wheel where it is due
+    (along with the number of full rotations it has to wait), so scheduling, cancelling and advancing the wheel are
+    O(1) per timer no matter how many timers there are. Precision is one tick.
+    """
+
+    def __init__(self, tick_sec: float = TIMER_WHEEL_TICK_SEC, wheel_size: int = TIMER_WHEEL_SIZE) -> None:
+        self.tick_sec = tick_sec
+        self.wheel_size = wheel_size
+
+        # slot -> {key: [rounds_left, callback, args]}
+        self._slots: List[Dict[Text, List[Any]]] = [{} for _ in range(wheel_size)]
+        self._timer_slots: Dict[Text, int] = {}
+        self._current_slot = 0
+
+        self._task: Optional[asyncio.Future] = None
+        self._callback_tasks: Set[asyncio.Future] = set()
+
+    def __len__(self) -> int:
+        return len(self._timer_slots)
+
+    def __contains__(self, key: Text) -> bool:
+        return key in self._timer_slots
+
+    def schedule(self, key: Text, delay_sec: float, callback: Callable[..., Awaitable[Any]], *args: Any) -> None:
+        """Schedule callback(*args) to be run after delay_sec (replaces the timer that is scheduled for the key)."""
+        self.cancel(key)
+
+        ticks = max(1, math.ceil(delay_sec / self.tick_sec))
+        slot_idx = (self._current_slot + ticks) % self.wheel_size
+        rounds = (ticks - 1) // self.wheel_size
+
+        self._slots[slot_idx][key] = [rounds, callback, args]
+        self._timer_slots[key] = slot_idx
+        self._ensure_running()
+
+    def cancel(self, key: Text) -> bool:
+        slot_idx = self._timer_slots.pop(key, None)
+        if slot_idx is None:
+            return False
+        del self._slots[slot_idx][key]
+        return True
+
+    def _ensure_running(self) -> None:
+        loop = asyncio.get_event_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self) -> None:
+        loop = asyncio.get_event_loop()
+        next_tick_at = loop.time()
+
+        while self._timer_slots:
+            next_tick_at += self.tick_sec
+            await asyncio.sleep(max(0.0, next_tick_at - loop.time()))
+            self._advance()
+
+    def _advance(self) -> None:
+        self._current_slot = (self._current_slot + 1) % self.wheel_size
+        slot = self._slots[self._current_slot]
+
+        due_timers = []
+        for key, timer in list(slot.items()):
+            if timer[0] > 0:
+                timer[0] -= 1
+            else:
+                del slot[key]
+                del self._timer_slots[key]
+                due_timers.append((key, timer[1], timer[2]))
+
+        for key, callback, args in due_timers:
+            task = asyncio.ensure_future(self._fire(key, callback, args))
+            self._callback_tasks.add(task)
+            task.add_done_callback(self._callback_tasks.discard)
+
+    @staticmethod
+    async def _fire(key: Text, callback: Callable[..., Awaitable[Any]], args: Any) -> None:
+        # noinspection PyBroadException
+        try:
+            await callback(*args)
+        except Exception:
+            logger.exception('TIMER %r FAILED', key)
+
+
+timer_wheel = HashedTimerWheel()
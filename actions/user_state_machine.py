@@ -1,7 +1,7 @@
 import os
 import random
 from dataclasses import dataclass, field
-from typing import Text, Optional, Dict, Any, TYPE_CHECKING, List
+from typing import Text, Optional, Dict, Any, TYPE_CHECKING, List, Tuple
 
 from transitions import Machine, EventData
 
@@ -22,6 +22,7 @@ NUM_OF_SEEN_PARTNERS_TO_REMEMBER = int(os.getenv('NUM_OF_SEEN_PARTNERS_TO_REMEMB
 NATIVE_UNKNOWN = 'unknown'
 
 TAKE_A_SHORT_BREAK_TRIGGER = 'take_a_short_break'
+TIME_OUT_TRIGGER = 'time_out'
 
 
 class UserState:
@@ -66,6 +67,17 @@ class UserState:
         REJECTED_CONFIRM,
         TAKE_A_BREAK,
     ]
+    # states whose expiry the timeout sweeper takes care of - WAITING_PARTNER_CONFIRM is not one of them: its expiry
+    # is handled by EXTERNAL_expire_partner_confirmation reminder (with the same deadline), which also tells the
+    # partner - if the sweeper got there first the reminder would find the user in a different state and do nothing
+    states_swept_on_timeout = [
+        ASKED_TO_JOIN,
+        ASKED_TO_CONFIRM,
+        ROOMED,
+        REJECTED_JOIN,
+        REJECTED_CONFIRM,
+        TAKE_A_BREAK,
+    ]
     offerable_states = [
                            WANTS_CHITCHAT,
                            OK_TO_CHITCHAT,
@@ -76,6 +88,21 @@ class UserState:
     ]
 
 
+def get_state_timeout_range(state: Text) -> Tuple[int, int]:
+    """
+    The shortest and the longest timeout a user may get upon entering the state (see
+    UserStateMachine._update_state_timeout_ts).
+    """
+    if state == UserState.WAITING_PARTNER_CONFIRM:
+        return PARTNER_CONFIRMATION_TIMEOUT_SEC, PARTNER_CONFIRMATION_TIMEOUT_SEC
+    if state == UserState.TAKE_A_BREAK:
+        return (
+            min(SHORT_BREAK_TIMEOUT_SEC, SWIPER_STATE_MIN_TIMEOUT_SEC),
+            max(SHORT_BREAK_TIMEOUT_SEC, SWIPER_STATE_MAX_TIMEOUT_SEC),
+        )
+    return SWIPER_STATE_MIN_TIMEOUT_SEC, SWIPER_STATE_MAX_TIMEOUT_SEC
+
+
 @dataclass
 class UserModel:
     user_id: Text
@@ -279,6 +306,15 @@ class UserStateMachine(UserModel):
             dest=UserState.BOT_BLOCKED,
         )
 
+        # used by the timeout sweeper (see actions/timeout_sweeper.py); partner_id is kept intact because late replies
+        # to an invitation may still refer to it
+        # noinspection PyTypeChecker
+        self.machine.add_transition(
+            trigger=TIME_OUT_TRIGGER,
+            source=UserState.states_with_timeouts,
+            dest=UserState.OK_TO_CHITCHAT,
+        )
+
     def get_first_name(self):
         first_name = (self.telegram_from or {}).get('first_name') or None
         return first_name
@@ -1,17 +1,285 @@
+import functools
+import heapq
+import itertools
 import logging
+import os
+import random
+import threading
+import time
 from abc import ABC, abstractmethod
-from dataclasses import asdict
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from dataclasses import asdict, fields
 from decimal import Decimal
+from distutils.util import strtobool
 from pprint import pformat
-from typing import Text, Optional, List, Type, Dict, Any, Iterable, Iterator
+from typing import Text, Optional, List, Type, Dict, Any, Iterable, Iterator, Callable, Deque, Set, Tuple
 
 from boto3.dynamodb.conditions import Key, Attr
 
-from actions.user_state_machine import UserStateMachine, UserState
+from actions import candidate_snapshot
+from actions.user_state_machine import UserStateMachine, UserState, TIME_OUT_TRIGGER, UserModel, \
+    get_state_timeout_range
 from actions.utils import current_timestamp_int
 
 logger = logging.getLogger(__name__)
 
+BULK_TRANSITION_MAX_WORKERS = int(os.getenv('BULK_TRANSITION_MAX_WORKERS', '16'))
+# when the sweeper (actions/timeout_sweeper.py) runs, partner search doesn't need to look for timed out users in every
+# state with a timeout - the sweeper moves them to OK_TO_CHITCHAT (the catch: they stay invisible until the next sweep)
+TIMEOUT_SWEEPER_ENABLED = strtobool(os.getenv('TIMEOUT_SWEEPER_ENABLED', 'false'))
+# rank partners with vectorized scorers over an in-memory snapshot of users (see actions/candidate_snapshot.py)
+CANDIDATE_SNAPSHOT_ENABLED = strtobool(os.getenv('CANDIDATE_SNAPSHOT_ENABLED', 'false'))
+# most_recent, random_top_k or power_of_two (see PARTNER_SELECTION_STRATEGIES below)
+PARTNER_SELECTION_STRATEGY = os.getenv('PARTNER_SELECTION_STRATEGY', 'most_recent')
+PARTNER_SELECTION_TOP_K = int(os.getenv('PARTNER_SELECTION_TOP_K', '5'))
+PENDING_INVITATION_TTL_SEC = float(os.getenv('PENDING_INVITATION_TTL_SEC', '60'))
+# a partner chosen by a search is claimed for that many seconds, so concurrent searches don't invite the same person
+# (0 disables leases; a lease is also gone as soon as the partner is saved, i.e. when the invitation is resolved)
+PARTNER_LEASE_SEC = int(os.getenv('PARTNER_LEASE_SEC', '0'))
+PARTNER_LEASE_MAX_ATTEMPTS = int(os.getenv('PARTNER_LEASE_MAX_ATTEMPTS', '3'))
+# for how long a search that found nobody is not repeated by the same searcher (0 disables the cache); saving any user
+# into an offerable state invalidates the cache right away, but users whose state simply times out (or users saved by
+# other processes) become visible only when the ttl is over
+EMPTY_POOL_CACHE_TTL_SEC = float(os.getenv('EMPTY_POOL_CACHE_TTL_SEC', '0'))
+EMPTY_POOL_CACHE_MAX_SIZE = int(os.getenv('EMPTY_POOL_CACHE_MAX_SIZE', '10000'))
+# candidates of a search are listed once when the search starts - later ticks only walk that list and pick up users
+# that were active since the previous tick
+SEARCH_CURSOR_ENABLED = strtobool(os.getenv('SEARCH_CURSOR_ENABLED', 'false'))
+# a cursor is meant to live as long as the search itself (keep it in line with PARTNER_SEARCH_TIMEOUT_SEC of actions.py)
+SEARCH_CURSOR_TTL_SEC = int(os.getenv('SEARCH_CURSOR_TTL_SEC', '116'))  # 1 minute 56 seconds
+
+BULK_TRANSITIONED = 'transitioned'
+BULK_NOT_MATCHED = 'not_matched'
+BULK_NOT_ALLOWED = 'not_allowed'  # the trigger is not valid in user's current state
+BULK_CONFLICT = 'conflict'  # the user was changed by someone else in the meantime
+BULK_FAILED = 'failed'
+
+
+def get_offerable_tiers() -> List[List[Text]]:
+    if not TIMEOUT_SWEEPER_ENABLED:
+        return UserState.offerable_tiers
+    return [
+        [state for state in tier if state not in UserState.states_swept_on_timeout]
+        for tier in UserState.offerable_tiers
+    ]
+
+
+def _is_available_partner(
+        partner: UserModel,
+        states: List[Text],
+        current_user_id: Text,
+        current_timestamp: int,
+) -> bool:
+    if partner.state not in states:
+        return False
+    if partner.state in UserState.states_with_timeouts and (partner.state_timeout_ts or 0) >= current_timestamp:
+        return False
+    return not (
+            current_user_id in (partner.roomed_partner_ids or []) or
+            current_user_id in (partner.rejected_partner_ids or []) or
+            current_user_id in (partner.seen_partner_ids or [])
+    )
+
+
+def _lease_is_free(owner_id: Text, current_timestamp: int) -> Any:
+    return (
+            Attr('lease_expires_ts').not_exists() |
+            Attr('lease_expires_ts').lt(current_timestamp) |
+            Attr('lease_owner_id').eq(owner_id)
+    )
+
+
+@functools.lru_cache()
+def _get_field_names(model_class: Type[UserModel]) -> Set[Text]:
+    # noinspection PyDataclass
+    return {f.name for f in fields(model_class)}
+
+
+class PendingInvitations:
+    """
+    How many times every user was offered as a partner recently (by this process only).
+    """
+
+    def __init__(self, ttl_sec: float = PENDING_INVITATION_TTL_SEC) -> None:
+        self.ttl_sec = ttl_sec
+        self._offered_at: Dict[Text, Deque[float]] = {}
+
+    def add(self, user_id: Text) -> None:
+        self._offered_at.setdefault(user_id, deque()).append(time.monotonic())
+
+    def count(self, user_id: Text) -> int:
+        offered_at = self._offered_at.get(user_id)
+        if offered_at is None:
+            return 0
+
+        expired_before = time.monotonic() - self.ttl_sec
+        while offered_at and offered_at[0] < expired_before:
+            offered_at.popleft()
+        if not offered_at:
+            del self._offered_at[user_id]
+            return 0
+        return len(offered_at)
+
+
+pending_invitations = PendingInvitations()
+
+
+class EmptyPoolCache:
+    """
+    Remembers which searches (searcher, states, excluded users) found no candidates, so they wouldn't be repeated
+    until either the ttl is over or somebody becomes available.
+    """
+
+    def __init__(self, ttl_sec: float = EMPTY_POOL_CACHE_TTL_SEC, max_size: int = EMPTY_POOL_CACHE_MAX_SIZE) -> None:
+        self.ttl_sec = ttl_sec
+        self.max_size = max_size
+        self._empty_since: Dict[Tuple[Text, Tuple[Text, ...], Tuple[Text, ...]], float] = {}
+
+    def is_empty(self, current_user_id: Text, states: Iterable[Text], exclude_user_ids: Iterable[Text]) -> bool:
+        if not self.ttl_sec:
+            return False
+        empty_since = self._empty_since.get((current_user_id, tuple(states), tuple(exclude_user_ids)))
+        return empty_since is not None and time.monotonic() - empty_since < self.ttl_sec
+
+    def mark_empty(self, current_user_id: Text, states: Iterable[Text], exclude_user_ids: Iterable[Text]) -> None:
+        if not self.ttl_sec:
+            return
+        now = time.monotonic()
+        if len(self._empty_since) >= self.max_size:
+            self._empty_since = {
+                key: empty_since for key, empty_since in self._empty_since.items() if now - empty_since < self.ttl_sec
+            }
+            if len(self._empty_since) >= self.max_size:
+                self._empty_since.clear()
+        self._empty_since[(current_user_id, tuple(states), tuple(exclude_user_ids))] = now
+
+    def invalidate(self) -> None:
+        self._empty_since.clear()
+
+
+empty_pool_cache = EmptyPoolCache()
+
+
+class SearchCursor:
+    """
+    Candidates of one search session (one searcher, one state_timestamp), most recently active first. Every
+    candidate is offered at most once per session.
+    """
+
+    def __init__(self, session_key: Tuple[Text, int], candidates: Iterable[UserModel], listed_at_ts: int) -> None:
+        self.session_key = session_key
+        self.expires_at = time.monotonic() + SEARCH_CURSOR_TTL_SEC
+        self.listed_at_ts = listed_at_ts
+        self._candidates: Dict[Text, UserModel] = {}
+        self._ordered: List[UserModel] = []
+        self._offered: Set[Text] = set()
+        self.apply_delta(candidates, listed_at_ts)
+
+    def is_valid(self, session_key: Tuple[Text, int]) -> bool:
+        return self.session_key == session_key and time.monotonic() < self.expires_at
+
+    def apply_delta(self, candidates: Iterable[UserModel], listed_at_ts: int) -> None:
+        changed = False
+        for candidate in candidates:
+            self._candidates[candidate.user_id] = candidate  # newer data replaces the older one
+            changed = True
+        if changed:
+            self._ordered = sorted(self._candidates.values(), key=lambda u: u.activity_timestamp or 0, reverse=True)
+        self.listed_at_ts = listed_at_ts
+
+    def update(self, candidate: UserModel) -> None:
+        if candidate.user_id in self._candidates:
+            self.apply_delta([candidate], self.listed_at_ts)
+
+    def walk(
+            self, states: List[Text],
+            current_user_id: Text,
+            exclude_user_ids: List[Text],
+            current_timestamp: int,
+    ) -> Iterator[UserModel]:
+        exclude_user_ids = set(exclude_user_ids)
+        for candidate in self._ordered:
+            if (
+                    candidate.user_id not in self._offered and
+                    candidate.user_id not in exclude_user_ids and
+                    _is_available_partner(candidate, states, current_user_id, current_timestamp)
+            ):
+                yield candidate
+
+    def mark_offered(self, user_id: Text) -> None:
+        self._offered.add(user_id)
+
+
+_search_cursors: Dict[Text, SearchCursor] = {}
+
+_offerable_pool_version = 0
+
+# listener(user, old_state) is called for every user saved by this process (see actions/change_feed.py)
+save_listeners: List[Callable[[UserStateMachine, Optional[Text]], None]] = []
+
+
+def get_offerable_pool_version() -> int:
+    """
+    Grows every time this process saves somebody who has just moved into an offerable state.
+    """
+    return _offerable_pool_version
+
+
+def notify_offerable_pool_changed() -> None:
+    """
+    For the changes that were made by other processes.
+    """
+    _offerable_pool_changed()
+
+
+def _offerable_pool_changed() -> None:
+    global _offerable_pool_version
+
+    _offerable_pool_version += 1
+    empty_pool_cache.invalidate()
+
+
+def _activity_ts(item: Dict[Text, Any]) -> int:
+    return int(item.get('activity_timestamp') or 0)
+
+
+def _select_most_recent(items: List[Dict[Text, Any]]) -> Optional[Dict[Text, Any]]:
+    return max(items, key=_activity_ts, default=None)
+
+
+def _select_random_top_k(items: List[Dict[Text, Any]]) -> Optional[Dict[Text, Any]]:
+    top_items = heapq.nlargest(PARTNER_SELECTION_TOP_K, items, key=_activity_ts)
+    return random.choice(top_items) if top_items else None
+
+
+def _select_power_of_two(items: List[Dict[Text, Any]]) -> Optional[Dict[Text, Any]]:
+    """
+    Pick two random candidates among the most recently active ones and offer the one who was offered to others
+    less often lately (the more recently active one if it's a tie).
+    """
+    top_items = heapq.nlargest(PARTNER_SELECTION_TOP_K, items, key=_activity_ts)
+    if len(top_items) <= 1:
+        return top_items[0] if top_items else None
+
+    return min(
+        random.sample(top_items, 2),
+        key=lambda i: (pending_invitations.count(i['user_id']), -_activity_ts(i)),
+    )
+
+
+# select(candidate_items) returns the item of the partner to offer (or None if there are no candidates)
+PARTNER_SELECTION_STRATEGIES: Dict[Text, Callable[[List[Dict[Text, Any]]], Optional[Dict[Text, Any]]]] = {
+    'most_recent': _select_most_recent,  # every concurrent searcher goes after the same user
+    'random_top_k': _select_random_top_k,
+    'power_of_two': _select_power_of_two,
+}
+if PARTNER_SELECTION_STRATEGY not in PARTNER_SELECTION_STRATEGIES:
+    raise ValueError(
+        f"unknown PARTNER_SELECTION_STRATEGY {repr(PARTNER_SELECTION_STRATEGY)} "
+        f"(known strategies: {', '.join(PARTNER_SELECTION_STRATEGIES)})"
+    )
+
 
 class IUserVault(ABC):
     @abstractmethod
@@ -26,6 +294,64 @@ class IUserVault(ABC):
     def save(self, user: UserStateMachine) -> None:
         raise NotImplementedError()
 
+    @abstractmethod
+    def bulk_transition(
+            self, trigger: Text,
+            predicate: Callable[[UserStateMachine], bool],
+            *trigger_args: Any,
+    ) -> Counter:
+        """
+        Apply a state machine trigger to every user that satisfies the predicate. A user is saved only if nobody
+        changed the user's state in the meantime. Returns the number of users per outcome (BULK_* constants).
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def transition_user(
+            self, user: UserStateMachine,
+            trigger: Text,
+            predicate: Callable[[UserStateMachine], bool],
+            *trigger_args: Any,
+            table: Any = None,
+    ) -> Text:
+        """
+        Bulk transition of a single user (for callers that list the users and manage the writes themselves). table -
+        where to save the user (a throttled table, for example), the outcome is returned (BULK_* constants).
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def sweep_timed_out_users(self) -> Counter:
+        """
+        Move users whose state has timed out (UserState.states_swept_on_timeout) into the state that is discoverable
+        without a timeout check.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def list_available_users(self, states: Iterable[Text]) -> Iterator[UserStateMachine]:
+        """
+        Users in the given states that could be offered as partners right now (users in states with timeouts are
+        listed only when their state has timed out).
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def get_existing_user(self, user_id: Text) -> Optional[UserStateMachine]:
+        """
+        Unlike `get_user`, this method does not create the user (None if there is no such user) and always reads
+        the user from the db.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def get_candidate_snapshot(self) -> candidate_snapshot.CandidateSnapshot:
+        """
+        The candidate snapshot of the process (see candidate_snapshot.get_snapshot()), caught up on the changes if
+        it is due.
+        """
+        raise NotImplementedError()
+
 
 class BaseUserVault(IUserVault, ABC):
     def __init__(self) -> None:
@@ -47,6 +373,44 @@ class BaseUserVault(IUserVault, ABC):
     def _save_user(self, user: UserStateMachine) -> None:
         raise NotImplementedError()
 
+    @abstractmethod
+    def _lease_user(self, user_id: Text, owner_id: Text, lease_sec: int) -> bool:
+        """
+        Claim the user for lease_sec seconds. Fails if somebody else holds an unexpired lease on the user.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def _list_all_users(self) -> Iterator[UserStateMachine]:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def _list_timed_out_users(self) -> Iterator[UserStateMachine]:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def _list_available_users(self, states: Iterable[Text]) -> Iterator[UserStateMachine]:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def _list_offerable_users(self, changed_since_ts: Optional[int] = None) -> Iterator[UserModel]:
+        """
+        Users in the offerable states (including the ones whose state has not timed out yet) as plain models that only
+        carry the attributes candidate snapshot and search cursors need. With changed_since_ts only the users who were
+        active since then or have entered a state with a timeout since then (callbacks and reminders change states
+        without user activity) are listed.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def _save_user_if_state_unchanged(
+            self, user: UserStateMachine,
+            old_state: Text,
+            old_state_timestamp: int,
+            table: Any = None,
+    ) -> bool:
+        raise NotImplementedError()
+
     def get_user(self, user_id: Text) -> UserStateMachine:
         """
         Unlike `_get_user`, this method creates the user if the user does not exist yet
@@ -69,38 +433,226 @@ class BaseUserVault(IUserVault, ABC):
 
         return self._cache_and_bind(user)
 
-    def _get_random_available_partner_from_tiers(self, current_user: UserStateMachine) -> Optional[UserStateMachine]:
+    def _get_random_available_partner_from_tiers(
+            self, current_user: UserStateMachine,
+            also_exclude_user_ids: Iterable[Text] = (),
+    ) -> Optional[UserStateMachine]:
         exclude_user_ids = (
                 [current_user.user_id] +
                 (current_user.roomed_partner_ids or []) +
-                (current_user.rejected_partner_ids or [])
+                (current_user.rejected_partner_ids or []) +
+                list(also_exclude_user_ids)
         )
         # seen partners should NOT discover (see NaiveDdbUserVault::_get_random_available_partner_dict::filter_items),
         # BUT they should BE discoverable... hence we are NOT doing +(current_user.seen_partner_ids or []) here
 
-        for tier in UserState.offerable_tiers:
-            partner = self._get_random_available_partner(tier, current_user.user_id, exclude_user_ids)
+        if SEARCH_CURSOR_ENABLED:
+            return self._get_partner_from_search_cursor(current_user, exclude_user_ids)
+
+        for tier in get_offerable_tiers():
+            if empty_pool_cache.is_empty(current_user.user_id, tier, exclude_user_ids):
+                continue
+
+            if CANDIDATE_SNAPSHOT_ENABLED:
+                partner = self._get_best_scored_partner(tier, current_user, exclude_user_ids)
+            else:
+                partner = self._get_random_available_partner(tier, current_user.user_id, exclude_user_ids)
             if partner:
                 return partner
+
+            empty_pool_cache.mark_empty(current_user.user_id, tier, exclude_user_ids)
+        return None
+
+    def _get_best_scored_partner(
+            self, states: List[Text],
+            current_user: UserStateMachine,
+            exclude_user_ids: List[Text],
+    ) -> Optional[UserStateMachine]:
+        snapshot = self.get_candidate_snapshot()
+        current_timestamp = current_timestamp_int()
+
+        for user_id in snapshot.rank(
+                current_user,
+                states,
+                exclude_user_ids,
+                candidate_snapshot.CANDIDATE_SCORER_WEIGHTS,
+                candidate_snapshot.CANDIDATE_SNAPSHOT_VERIFY_TOP,
+                current_timestamp,
+        ):
+            # the snapshot may be outdated => the candidate is re-read to make sure they are still available
+            partner = self._get_user(user_id)
+            if not partner:
+                candidate_snapshot.discard_from_snapshot([user_id])  # the user is gone
+            elif _is_available_partner(partner, states, current_user.user_id, current_timestamp):
+                return partner
+            else:
+                candidate_snapshot.upsert_into_snapshot([partner])
+        return None
+
+    def _get_partner_from_search_cursor(
+            self, current_user: UserStateMachine,
+            exclude_user_ids: List[Text],
+    ) -> Optional[UserStateMachine]:
+        current_timestamp = current_timestamp_int()
+        session_key = (current_user.user_id, current_user.state_timestamp)
+
+        cursor = _search_cursors.get(current_user.user_id)
+        if cursor is None or not cursor.is_valid(session_key):
+            for user_id in [user_id for user_id, c in _search_cursors.items() if time.monotonic() >= c.expires_at]:
+                del _search_cursors[user_id]
+            cursor = _search_cursors[current_user.user_id] = SearchCursor(
+                session_key,
+                self._list_offerable_users(),
+                current_timestamp,
+            )
+        else:
+            # the same second once again, because activity timestamps are only accurate up to a second
+            cursor.apply_delta(self._list_offerable_users(changed_since_ts=cursor.listed_at_ts), current_timestamp)
+
+        for tier in get_offerable_tiers():
+            for candidate in cursor.walk(tier, current_user.user_id, exclude_user_ids, current_timestamp):
+                # the cursor may be outdated => the candidate is re-read to make sure they are still available
+                partner = self._get_user(candidate.user_id)
+                if not partner:
+                    cursor.mark_offered(candidate.user_id)  # the user is gone, no reason to re-read them again
+                elif _is_available_partner(partner, tier, current_user.user_id, current_timestamp):
+                    cursor.mark_offered(partner.user_id)
+                    return partner
+                else:
+                    cursor.update(partner)
         return None
 
     def get_random_available_partner(self, current_user: UserStateMachine) -> Optional[UserStateMachine]:
-        user = self._get_random_available_partner_from_tiers(current_user)
-        if not user:
+        leased_by_others = []
+        for _ in range(PARTNER_LEASE_MAX_ATTEMPTS if PARTNER_LEASE_SEC else 1):
+            user = self._get_random_available_partner_from_tiers(current_user, leased_by_others)
+            if not user:
+                return None
+
+            if not PARTNER_LEASE_SEC or self._lease_user(user.user_id, current_user.user_id, PARTNER_LEASE_SEC):
+                break
+            # a concurrent search has just claimed this partner
+            leased_by_others.append(user.user_id)
+        else:
             return None
 
+        pending_invitations.add(user.user_id)
         return self._cache_and_bind(user)
 
     def save(self, user: UserStateMachine) -> None:
+        # repeated saves of a user whose state didn't change (every action saves the current user) don't count
+        saved_state = getattr(user, '_saved_state', None)
+        became_offerable = (
+                user.state in UserState.offerable_states and
+                saved_state != (user.state, user.state_timestamp)
+        )
         self._save_user(user)
+        if became_offerable:
+            _offerable_pool_changed()
+        for listener in save_listeners:
+            listener(user, saved_state[0] if saved_state else None)
 
         self._cache_and_bind(user)
 
     def _cache_and_bind(self, user: UserStateMachine):
         user._user_vault = self
+        user._saved_state = (user.state, user.state_timestamp)
         self._user_cache[user.user_id] = user
         return user
 
+    def bulk_transition(
+            self, trigger: Text,
+            predicate: Callable[[UserStateMachine], bool],
+            *trigger_args: Any,
+    ) -> Counter:
+        return self._transition_users(self._list_all_users(), trigger, predicate, *trigger_args)
+
+    def transition_user(
+            self, user: UserStateMachine,
+            trigger: Text,
+            predicate: Callable[[UserStateMachine], bool],
+            *trigger_args: Any,
+            table: Any = None,
+    ) -> Text:
+        if not predicate(user):
+            return BULK_NOT_MATCHED
+        if trigger not in user.machine.get_triggers(user.state):
+            return BULK_NOT_ALLOWED
+        return self._apply_trigger_and_save(user, trigger, *trigger_args, table=table)
+
+    def _apply_trigger_and_save(
+            self, user: UserStateMachine,
+            trigger: Text,
+            *trigger_args: Any,
+            table: Any = None,
+    ) -> Text:
+        old_state, old_state_timestamp = user.state, user.state_timestamp
+        # going through the state machine keeps state_timestamp, state_timeout_ts etc. consistent with the state
+        getattr(user, trigger)(*trigger_args)
+        if not self._save_user_if_state_unchanged(user, old_state, old_state_timestamp, table=table):
+            return BULK_CONFLICT
+        return BULK_TRANSITIONED
+
+    def sweep_timed_out_users(self) -> Counter:
+        return self._transition_users(
+            self._list_timed_out_users(),
+            TIME_OUT_TRIGGER,
+            lambda user: user.has_become_discoverable(),
+        )
+
+    def list_available_users(self, states: Iterable[Text]) -> Iterator[UserStateMachine]:
+        # not cached - these are meant to be iterated over in bulk
+        return self._list_available_users(states)
+
+    def get_existing_user(self, user_id: Text) -> Optional[UserStateMachine]:
+        return self._get_user(user_id)
+
+    def get_candidate_snapshot(self) -> candidate_snapshot.CandidateSnapshot:
+        return candidate_snapshot.get_snapshot(self._list_offerable_users)
+
+    def _transition_users(
+            self, users: Iterable[UserStateMachine],
+            trigger: Text,
+            predicate: Callable[[UserStateMachine], bool],
+            *trigger_args: Any,
+    ) -> Counter:
+        outcomes = Counter()
+
+        def transition_safely(user: UserStateMachine) -> Text:
+            # noinspection PyBroadException
+            try:
+                return self._apply_trigger_and_save(user, trigger, *trigger_args)
+            except Exception:
+                logger.exception('bulk transition %r failed for user %r', trigger, user.user_id)
+                return BULK_FAILED
+
+        # the listing is consumed only as fast as the users get saved (no need to hold the whole table in memory)
+        in_flight = threading.BoundedSemaphore(BULK_TRANSITION_MAX_WORKERS * 4)
+        outcomes_lock = threading.Lock()
+
+        def count_outcome(future: Future) -> None:
+            with outcomes_lock:
+                outcomes[future.result()] += 1
+            in_flight.release()
+
+        with ThreadPoolExecutor(max_workers=BULK_TRANSITION_MAX_WORKERS) as executor:
+            for user in users:
+                if not predicate(user):
+                    with outcomes_lock:
+                        outcomes[BULK_NOT_MATCHED] += 1
+                elif trigger not in user.machine.get_triggers(user.state):
+                    with outcomes_lock:
+                        outcomes[BULK_NOT_ALLOWED] += 1
+                else:
+                    in_flight.acquire()
+                    executor.submit(transition_safely, user).add_done_callback(count_outcome)
+
+        # users in the first level cache may be outdated now
+        self._user_cache.clear()
+        if outcomes[BULK_TRANSITIONED]:
+            _offerable_pool_changed()
+        return outcomes
+
 
 class NaiveDdbUserVault(BaseUserVault):
     def _get_user(self, user_id: Text) -> Optional[UserStateMachine]:
@@ -138,9 +690,158 @@ class NaiveDdbUserVault(BaseUserVault):
         # https://stackoverflow.com/a/43672209/2040370
         user_state_machine_table.put_item(Item=user_dict)
 
+    def _lease_user(self, user_id: Text, owner_id: Text, lease_sec: int) -> bool:
+        # TODO oleksandr: is there a better way to ensure that the tests have a chance to mock boto3 ?
+        from actions.aws_resources import user_state_machine_table
+
+        current_timestamp = current_timestamp_int()
+        try:
+            # the lease lives outside of UserModel, hence put_item() in _save_user() releases it
+            user_state_machine_table.update_item(
+                Key={'user_id': user_id},
+                UpdateExpression='SET lease_owner_id = :owner_id, lease_expires_ts = :expires_ts',
+                ConditionExpression=Attr('user_id').exists() & _lease_is_free(owner_id, current_timestamp),
+                ExpressionAttributeValues={':owner_id': owner_id, ':expires_ts': current_timestamp + lease_sec},
+            )
+        except user_state_machine_table.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def _list_all_users(self) -> Iterator[UserStateMachine]:
+        # TODO oleksandr: is there a better way to ensure that the tests have a chance to mock boto3 ?
+        from actions.aws_resources import user_state_machine_table
+
+        scan_kwargs = {}
+        while True:
+            ddb_resp = user_state_machine_table.scan(**scan_kwargs)
+            for item in ddb_resp['Items']:
+                yield self._user_from_dict(item)
+
+            if not ddb_resp.get('LastEvaluatedKey'):
+                break
+            scan_kwargs['ExclusiveStartKey'] = ddb_resp['LastEvaluatedKey']
+
+    def _list_timed_out_users(self) -> Iterator[UserStateMachine]:
+        # TODO oleksandr: is there a better way to ensure that the tests have a chance to mock boto3 ?
+        from actions.aws_resources import user_state_machine_table
+
+        current_timestamp = current_timestamp_int()
+
+        for state in UserState.states_swept_on_timeout:
+            query_kwargs = {
+                'IndexName': 'by_state_and_timeout_ts',
+                'KeyConditionExpression': Key('state').eq(state) & Key('state_timeout_ts').lt(current_timestamp),
+            }
+            while True:
+                ddb_resp = user_state_machine_table.query(**query_kwargs)
+                for item in ddb_resp['Items']:
+                    yield self._user_from_dict(item)
+
+                if not ddb_resp.get('LastEvaluatedKey'):
+                    break
+                query_kwargs['ExclusiveStartKey'] = ddb_resp['LastEvaluatedKey']
+
+    def _list_available_users(self, states: Iterable[Text]) -> Iterator[UserStateMachine]:
+        # TODO oleksandr: is there a better way to ensure that the tests have a chance to mock boto3 ?
+        from actions.aws_resources import user_state_machine_table
+
+        current_timestamp = current_timestamp_int()
+
+        for state in states:
+            if state in UserState.states_with_timeouts:
+                query_kwargs = {
+                    'IndexName': 'by_state_and_timeout_ts',
+                    'KeyConditionExpression': Key('state').eq(state) & Key('state_timeout_ts').lt(current_timestamp),
+                }
+            else:
+                query_kwargs = {
+                    'IndexName': 'by_state_and_activity_ts',
+                    'KeyConditionExpression': Key('state').eq(state),
+                }
+            while True:
+                ddb_resp = user_state_machine_table.query(**query_kwargs)
+                for item in ddb_resp['Items']:
+                    yield self._user_from_dict(item)
+
+                if not ddb_resp.get('LastEvaluatedKey'):
+                    break
+                query_kwargs['ExclusiveStartKey'] = ddb_resp['LastEvaluatedKey']
+
+    def _list_offerable_users(self, changed_since_ts: Optional[int] = None) -> Iterator[UserModel]:
+        # TODO oleksandr: is there a better way to ensure that the tests have a chance to mock boto3 ?
+        from actions.aws_resources import user_state_machine_table
+
+        current_timestamp = current_timestamp_int()
+
+        queries = []
+        for state in UserState.offerable_states:
+            key_condition = Key('state').eq(state)
+            if changed_since_ts is not None:
+                key_condition &= Key('activity_timestamp').gte(changed_since_ts)
+            queries.append({'IndexName': 'by_state_and_activity_ts', 'KeyConditionExpression': key_condition})
+
+            if changed_since_ts is not None and state in UserState.states_with_timeouts:
+                # entered the state (without any activity, by a callback for example) after changed_since_ts => the
+                # timeout is somewhere between changed_since_ts + the shortest and now + the longest timeout
+                min_timeout, max_timeout = get_state_timeout_range(state)
+                queries.append({
+                    'IndexName': 'by_state_and_timeout_ts',
+                    'KeyConditionExpression': Key('state').eq(state) & Key('state_timeout_ts').between(
+                        changed_since_ts + min_timeout, current_timestamp + max_timeout,
+                    ),
+                    # the range is exact only for the states with a fixed timeout
+                    'FilterExpression': Attr('state_timestamp').gte(changed_since_ts),
+                })
+
+        listed_user_ids = set()
+        for query_kwargs in queries:
+            query_kwargs = {
+                **query_kwargs,
+                'ProjectionExpression': 'user_id, #state, state_timeout_ts, activity_timestamp, native, newbie, '
+                                        'roomed_partner_ids, rejected_partner_ids, seen_partner_ids',
+                'ExpressionAttributeNames': {'#state': 'state'},  # reserved word
+            }
+            while True:
+                ddb_resp = user_state_machine_table.query(**query_kwargs)
+                for item in ddb_resp['Items']:
+                    if item['user_id'] not in listed_user_ids:
+                        listed_user_ids.add(item['user_id'])
+                        yield self._user_from_dict(item, UserModel)
+
+                if not ddb_resp.get('LastEvaluatedKey'):
+                    break
+                query_kwargs['ExclusiveStartKey'] = ddb_resp['LastEvaluatedKey']
+
+    def _save_user_if_state_unchanged(
+            self, user: UserStateMachine,
+            old_state: Text,
+            old_state_timestamp: int,
+            table: Any = None,
+    ) -> bool:
+        # TODO oleksandr: is there a better way to ensure that the tests have a chance to mock boto3 ?
+        from actions.aws_resources import get_thread_user_state_machine_table
+
+        # conditional writes can't be batched (BatchWriteItem doesn't support conditions and a transaction would fail
+        # as a whole because of a single conflict), hence individual put_item calls from a pool of threads
+        user_state_machine_table = table or get_thread_user_state_machine_table()
+        condition = Attr('state').eq(old_state)
+        if old_state_timestamp:
+            condition &= Attr('state_timestamp').eq(old_state_timestamp)
+        else:
+            condition &= Attr('state_timestamp').not_exists() | Attr('state_timestamp').eq(0)
+
+        try:
+            # noinspection PyDataclass
+            user_state_machine_table.put_item(Item=asdict(user), ConditionExpression=condition)
+        except user_state_machine_table.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
     @staticmethod
-    def _user_from_dict(user_dict):
-        user = UserStateMachine(**user_dict)
+    def _user_from_dict(user_dict, user_class=UserStateMachine):
+        # items may carry attributes that are not part of the model (leases, for example)
+        field_names = _get_field_names(user_class)
+        user = user_class(**{key: value for key, value in user_dict.items() if key in field_names})
 
         if isinstance(user.state_timestamp, Decimal):
             user.state_timestamp = int(user.state_timestamp)
@@ -161,9 +862,13 @@ class NaiveDdbUserVault(BaseUserVault):
         from actions.aws_resources import user_state_machine_table
 
         current_timestamp = current_timestamp_int()
+        # the strategies other than most_recent choose among several of the most recently active candidates
+        candidates_per_state = 1 if PARTNER_SELECTION_STRATEGY == 'most_recent' else PARTNER_SELECTION_TOP_K
 
-        def timestamp_extractor(item: Dict[Text, Any]) -> int:
-            return int(item.get('activity_timestamp') or 0)
+        filter_expression = ~Attr('user_id').is_in(exclude_user_ids)
+        if PARTNER_LEASE_SEC:
+            # partners claimed by concurrent searches are skipped until their leases expire
+            filter_expression &= _lease_is_free(current_user_id, current_timestamp)
 
         def filter_items(items: Iterable[Dict[Text, Any]]) -> Iterator[Dict[Text, Any]]:
             """
@@ -188,27 +893,23 @@ class NaiveDdbUserVault(BaseUserVault):
                     ddb_resp = user_state_machine_table.query(
                         IndexName='by_state_and_timeout_ts',
                         KeyConditionExpression=Key('state').eq(state) & Key('state_timeout_ts').lt(current_timestamp),
-                        FilterExpression=~Attr('user_id').is_in(exclude_user_ids),
+                        FilterExpression=filter_expression,
                         ScanIndexForward=False,  # this should reduce the need to worry about truncated DDB output
                     )
                     items = ddb_resp.get('Items') or []
-                    item = max(filter_items(items), key=timestamp_extractor, default=None)
-                    if item:
-                        yield item
+                    yield from heapq.nlargest(candidates_per_state, filter_items(items), key=_activity_ts)
 
                 else:
                     ddb_resp = user_state_machine_table.query(
                         IndexName='by_state_and_activity_ts',
                         KeyConditionExpression=Key('state').eq(state),
-                        FilterExpression=~Attr('user_id').is_in(exclude_user_ids),
+                        FilterExpression=filter_expression,
                         ScanIndexForward=False,
                     )
                     items = ddb_resp.get('Items') or []
-                    item = next(filter_items(items), None)
-                    if item:
-                        yield item
+                    yield from itertools.islice(filter_items(items), candidates_per_state)
 
-        return max(item_generator(), key=timestamp_extractor, default=None)
+        return PARTNER_SELECTION_STRATEGIES[PARTNER_SELECTION_STRATEGY](list(item_generator()))
 
 
 UserVault: Type[IUserVault] = NaiveDdbUserVault
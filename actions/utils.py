@@ -1,4 +1,5 @@
 import html
+import os
 import time
 import traceback
 from datetime import datetime
@@ -6,6 +7,10 @@ from typing import Text, Optional, Union, Any, List, Tuple
 
 from rasa_sdk import Tracker
 
+# set by the sharded action server (see sharded_server.py) for its worker processes - the budgets of the whole action
+# server (Telegram rate limits etc.) are split evenly between the workers
+ACTION_SERVER_WORKER_COUNT = int(os.getenv('ACTION_SERVER_WORKER_COUNT', '1'))
+
 
 def present_partner_name(first_name: Text, placeholder: Text) -> Text:
     if first_name:
@@ -80,3 +85,7 @@ class SwiperRasaCallbackError(SwiperExternalCallError):
 
 class SwiperDailyCoError(SwiperExternalCallError):
     ...
+
+
+class SwiperRateLimitError(SwiperExternalCallError):
+    ...
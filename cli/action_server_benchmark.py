@@ -0,0 +1,115 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Text, List, Tuple
+
+import aiohttp
+import click
+
+
+def _webhook_payload(sender_id: Text) -> bytes:
+    return json.dumps({
+        'next_action': 'action_benchmark_busy',
+        'sender_id': sender_id,
+        'tracker': {
+            'sender_id': sender_id,
+            'slots': {},
+            'latest_message': {'intent': {}, 'entities': [], 'text': None},
+            'events': [],
+            'paused': False,
+            'followup_action': None,
+            'active_loop': {},
+            'latest_action_name': None,
+        },
+        'domain': {},
+        'version': '2.7.1',
+    }).encode('utf-8')
+
+
+async def _wait_until_healthy(url: Text, process: subprocess.Popen, timeout_sec: float = 120) -> None:
+    deadline = time.monotonic() + timeout_sec
+    async with aiohttp.ClientSession() as session:
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f"action server exited with {process.poll()}")
+            try:
+                async with session.get(url + '/health') as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientConnectionError:
+                pass
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"{url} didn't start in {timeout_sec} seconds")
+            await asyncio.sleep(0.2)
+
+
+async def _generate_load(url: Text, requests: int, concurrency: int, users: int) -> float:
+    """Requests per second."""
+    payloads = [_webhook_payload(f"benchmark_user_{user_idx}") for user_idx in range(users)]
+    next_request = 0
+
+    async def run_user_queue(session: aiohttp.ClientSession) -> None:
+        nonlocal next_request
+        while next_request < requests:
+            payload = payloads[next_request % users]
+            next_request += 1
+            async with session.post(url + '/webhook', data=payload,
+                                    headers={'Content-Type': 'application/json'}) as response:
+                await response.read()
+                if response.status != 200:
+                    raise RuntimeError(f"webhook responded with {response.status}")
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        started_at = time.perf_counter()
+        await asyncio.gather(*(run_user_queue(session) for _ in range(concurrency)))
+        return requests / (time.perf_counter() - started_at)
+
+
+def _measure(workers: int, port: int, requests: int, concurrency: int, users: int) -> float:
+    process = subprocess.Popen([
+        sys.executable, '-m', 'actions.sharded_server',
+        '--workers', str(workers),
+        '--port', str(port),
+        '--base-port', str(port + 1),
+        '--actions', 'cli.benchmark_actions',
+    ])
+    url = f"http://127.0.0.1:{port}"
+    try:
+        asyncio.run(_wait_until_healthy(url, process))
+        asyncio.run(_generate_load(url, min(requests, concurrency * 4), concurrency, users))  # warm up
+        return asyncio.run(_generate_load(url, requests, concurrency, users))
+    finally:
+        process.terminate()
+        process.wait()
+
+
+@click.command()
+@click.option('--max-workers', default=os.cpu_count() or 1, show_default=True)
+@click.option('--requests', default=2000, show_default=True, help='Requests per measurement')
+@click.option('--concurrency', default=64, show_default=True, help='Requests in flight')
+@click.option('--users', default=1000, show_default=True, help='Distinct sender ids')
+@click.option('--port', default=5055, show_default=True, help='Port of the router (workers take the next ones)')
+def benchmark(max_workers: int, requests: int, concurrency: int, users: int, port: int) -> None:
+    """
+    Throughput of actions.sharded_server with 1, 2, 4 ... max_workers workers (a CPU bound action from
+    cli/benchmark_actions.py, see BENCHMARK_ACTION_CPU_MS). How the throughput grows with the number of workers has
+    not been measured on a multi-core host yet - run this on the target host before relying on it (the router is a
+    single process too, so at some point it becomes the bottleneck, and workers beyond the number of cores only
+    compete for the same cores):
+
+        python -m cli.action_server_benchmark --max-workers 8
+    """
+    worker_counts = sorted({min(2 ** power, max_workers) for power in range(max_workers.bit_length() + 1)})
+    results: List[Tuple[int, float]] = []
+    for workers in worker_counts:
+        requests_per_sec = _measure(workers, port, requests, concurrency, users)
+        results.append((workers, requests_per_sec))
+        click.echo(f"workers: {workers:3}   requests/sec: {requests_per_sec:8.1f}   "
+                   f"speedup: {requests_per_sec / results[0][1]:5.2f}x")
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,24 @@
+import os
+import time
+from typing import Any, Text, Dict, List
+
+from rasa_sdk import Action, Tracker
+from rasa_sdk.executor import CollectingDispatcher
+
+BENCHMARK_ACTION_CPU_MS = float(os.getenv('BENCHMARK_ACTION_CPU_MS', '20'))
+
+
+class ActionBenchmarkBusy(Action):
+    """
+    Keeps the event loop of the worker busy for BENCHMARK_ACTION_CPU_MS (the way a heavy action of actions/actions.py
+    does), without needing DynamoDB or Telegram.
+    """
+
+    def name(self) -> Text:
+        return 'action_benchmark_busy'
+
+    async def run(self, dispatcher: CollectingDispatcher, tracker: Tracker, domain: Dict[Text, Any]) -> List[Dict]:
+        busy_until = time.perf_counter() + BENCHMARK_ACTION_CPU_MS / 1000
+        while time.perf_counter() < busy_until:
+            pass
+        return []
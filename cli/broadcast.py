@@ -0,0 +1,121 @@
+import asyncio
+import os
+from collections import Counter
+from typing import Text, Any, Dict, Callable, Awaitable, Set, Optional, Iterator
+
+from actions.rate_limiter import TokenBucket
+from actions.user_state_machine import UserStateMachine
+
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '20'))
+# live traffic of the bot shares the same Telegram limits (~30 msg/sec globally), hence the lower default
+BROADCAST_MAX_PER_SEC = float(os.getenv('BROADCAST_MAX_PER_SEC', '15'))
+BROADCAST_PROGRESS_EVERY = int(os.getenv('BROADCAST_PROGRESS_EVERY', '100'))
+
+DELIVERED = 'delivered'
+FAILED = 'failed'
+
+# send_to_user(user) raises an exception if the delivery failed
+SendToUser = Callable[[UserStateMachine], Awaitable[Any]]
+
+
+class BroadcastCheckpoint:
+    """
+    An append-only file of "user_id<TAB>status" lines. Users that were already delivered to are skipped when a
+    broadcast is resumed (the ones that failed are retried).
+    """
+
+    def __init__(self, path: Optional[Text]) -> None:
+        self.path = path
+        self.delivered_user_ids: Set[Text] = set()
+        self._file = None
+
+        if path and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    user_id, _, status = line.rstrip('\n').partition('\t')
+                    if status == DELIVERED:
+                        self.delivered_user_ids.add(user_id)
+
+    def __enter__(self) -> 'BroadcastCheckpoint':
+        if self.path:
+            self._file = open(self.path, 'a', encoding='utf-8')
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        if self._file:
+            self._file.close()
+
+    def record(self, user_id: Text, status: Text) -> None:
+        if self._file:
+            self._file.write(f"{user_id}\t{status}\n")
+            self._file.flush()
+
+
+async def broadcast(
+        items: Iterator[Dict[Text, Any]],
+        item_to_user: Callable[[Dict[Text, Any]], Optional[UserStateMachine]],
+        send_to_user: SendToUser,
+        checkpoint_path: Optional[Text] = None,
+        concurrency: int = BROADCAST_CONCURRENCY,
+        max_per_sec: float = BROADCAST_MAX_PER_SEC,
+) -> Counter:
+    """
+    Deliver to every user produced by items (a blocking iterator, e.g. a paginated scan, which is consumed in
+    an executor) with at most `concurrency` deliveries in flight and at most `max_per_sec` deliveries started per
+    second. item_to_user may return None to skip an item. Returns the delivery report.
+    """
+    loop = asyncio.get_event_loop()
+    report = Counter()
+    failures = Counter()
+    bucket = TokenBucket(max_per_sec, burst=max(1, int(max_per_sec)))
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = set()
+    items_exhausted = object()
+
+    with BroadcastCheckpoint(checkpoint_path) as checkpoint:
+        async def deliver(user: UserStateMachine) -> None:
+            try:
+                await send_to_user(user)
+                report[DELIVERED] += 1
+                checkpoint.record(user.user_id, DELIVERED)
+            except Exception as e:
+                report[FAILED] += 1
+                failures[type(e).__name__] += 1
+                checkpoint.record(user.user_id, FAILED)
+                print('FAILED FOR', user.user_id, '-', repr(e))
+            finally:
+                semaphore.release()
+
+            if sum(report.values()) % BROADCAST_PROGRESS_EVERY == 0:
+                print(dict(report))
+
+        while True:
+            item = await loop.run_in_executor(None, next, items, items_exhausted)
+            if item is items_exhausted:
+                break
+
+            user = item_to_user(item)
+            if user is None:
+                report['skipped'] += 1
+                continue
+            if user.user_id in checkpoint.delivered_user_ids:
+                report['already_delivered'] += 1
+                continue
+
+            await semaphore.acquire()
+            await asyncio.sleep(bucket.reserve())
+
+            task = asyncio.ensure_future(deliver(user))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if tasks:
+            await asyncio.gather(*list(tasks))
+
+    print()
+    print('BROADCAST REPORT:', dict(report))
+    if failures:
+        print('FAILURES BY TYPE:', dict(failures))
+    if report[FAILED] and checkpoint_path:
+        print(f"run the command again with the same checkpoint file ({checkpoint_path}) to retry the failed ones")
+    return report
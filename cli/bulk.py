@@ -0,0 +1,313 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Text, Any, Dict, Callable, Optional, Iterator, Tuple, List, Iterable
+
+import boto3
+from botocore.exceptions import ClientError
+
+from actions.rate_limiter import TokenBucket
+
+AWS_REGION = os.environ['AWS_REGION']
+
+BULK_TOTAL_SEGMENTS = int(os.getenv('BULK_TOTAL_SEGMENTS', '8'))
+BULK_MAX_WORKERS = int(os.getenv('BULK_MAX_WORKERS', '16'))
+BULK_MAX_WRITES_PER_SEC = float(os.getenv('BULK_MAX_WRITES_PER_SEC', '100'))  # keep it below table's provisioned WCU
+BULK_PROGRESS_INTERVAL_SEC = float(os.getenv('BULK_PROGRESS_INTERVAL_SEC', '2'))
+BULK_SCAN_QUEUE_SIZE = int(os.getenv('BULK_SCAN_QUEUE_SIZE', '1000'))  # in pages
+BULK_MAX_RETRIES = int(os.getenv('BULK_MAX_RETRIES', '10'))
+BULK_RETRY_BASE_DELAY_SEC = float(os.getenv('BULK_RETRY_BASE_DELAY_SEC', '0.05'))
+BULK_RETRY_MAX_DELAY_SEC = float(os.getenv('BULK_RETRY_MAX_DELAY_SEC', '5'))
+
+# process_item(table, item) returns False if the item was skipped
+ProcessItem = Callable[[Any, Dict[Text, Any]], Optional[bool]]
+# (segment, items of the page, LastEvaluatedKey of the page or None if it is the last page of the segment)
+ScanPage = Tuple[int, List[Dict[Text, Any]], Optional[Dict[Text, Any]]]
+
+_thread_local = threading.local()
+
+
+def get_thread_table(table_name: Text) -> Any:
+    """
+    boto3 resources are not thread safe - every thread gets its own.
+    """
+    tables = getattr(_thread_local, 'tables', None)
+    if tables is None:
+        tables = _thread_local.tables = {}
+
+    table = tables.get(table_name)
+    if table is None:
+        table = tables[table_name] = boto3.session.Session().resource('dynamodb', AWS_REGION).Table(table_name)
+    return table
+
+
+class ThreadSafeThrottle:
+    def __init__(self, max_per_sec: Optional[float]) -> None:
+        self._bucket = TokenBucket(max_per_sec, burst=max(1, int(max_per_sec))) if max_per_sec else None
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        if self._bucket is None:
+            return
+        with self._lock:
+            delay_sec = self._bucket.reserve()
+        if delay_sec:
+            time.sleep(delay_sec)
+
+
+class ThrottledTable:
+    """
+    Waits for the throttle before every write, so reads and skipped items don't consume the write budget.
+    """
+    WRITE_METHODS = {'put_item', 'update_item', 'delete_item'}
+
+    def __init__(self, table: Any, throttle: ThreadSafeThrottle) -> None:
+        self._table = table
+        self._throttle = throttle
+
+    def __getattr__(self, name: Text) -> Any:
+        attr = getattr(self._table, name)
+        if name not in self.WRITE_METHODS:
+            return attr
+
+        def throttled_write(*args: Any, **kwargs: Any) -> Any:
+            self._throttle.wait()
+            return attr(*args, **kwargs)
+
+        return throttled_write
+
+
+class AdaptiveThrottle:
+    """
+    Additive increase / multiplicative decrease: the rate grows slowly while writes succeed and is halved every time
+    DDB reports that provisioned throughput was exceeded.
+    """
+
+    def __init__(self, max_per_sec: Optional[float], min_per_sec: float = 1.0) -> None:
+        # no max_per_sec (or 0) - no throttling at all (only the retries of call_with_retries back off then)
+        self.max_per_sec = max_per_sec or None
+        self.min_per_sec = min(min_per_sec, max_per_sec) if max_per_sec else min_per_sec
+        self.rate_per_sec = self.max_per_sec
+        self._next_slot_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        if self.max_per_sec is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot_at = max(now, self._next_slot_at)
+            self._next_slot_at = slot_at + 1 / self.rate_per_sec
+        if slot_at > now:
+            time.sleep(slot_at - now)
+
+    def on_success(self) -> None:
+        if self.max_per_sec is None:
+            return
+        with self._lock:
+            self.rate_per_sec = min(self.max_per_sec, self.rate_per_sec + self.max_per_sec / 100)
+
+    def on_throttled(self) -> None:
+        if self.max_per_sec is None:
+            return
+        with self._lock:
+            self.rate_per_sec = max(self.min_per_sec, self.rate_per_sec / 2)
+            print(f"THROUGHPUT EXCEEDED - slowing down to {self.rate_per_sec:.1f} writes/sec")
+
+
+def is_throughput_exceeded(e: Exception) -> bool:
+    return isinstance(e, ClientError) and e.response.get('Error', {}).get('Code') in [
+        'ProvisionedThroughputExceededException',
+        'ThrottlingException',
+        'RequestLimitExceeded',
+    ]
+
+
+def call_with_retries(
+        call: Callable[[], Any],
+        throttle: Optional[AdaptiveThrottle] = None,
+        max_retries: int = BULK_MAX_RETRIES,
+) -> Any:
+    """
+    Retry the call (with exponential backoff) for as long as DDB reports that provisioned throughput was exceeded.
+    """
+    for attempt in range(max_retries):
+        if throttle:
+            throttle.wait()
+        try:
+            result = call()
+        except Exception as e:
+            if not is_throughput_exceeded(e) or attempt + 1 >= max_retries:
+                raise
+            if throttle:
+                throttle.on_throttled()
+            time.sleep(min(BULK_RETRY_BASE_DELAY_SEC * 2 ** attempt, BULK_RETRY_MAX_DELAY_SEC))
+            continue
+
+        if throttle:
+            throttle.on_success()
+        return result
+    raise ValueError(f"max_retries should be positive (got {max_retries})")
+
+
+@dataclass
+class BulkStats:
+    scanned: int = 0
+    processed: int = 0
+    skipped: int = 0
+    failed: int = 0
+    started_at: float = field(default_factory=time.monotonic)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add(self, **counters: int) -> None:
+        with self._lock:
+            for counter_name, value in counters.items():
+                setattr(self, counter_name, getattr(self, counter_name) + value)
+
+    def __str__(self) -> Text:
+        elapsed_sec = max(time.monotonic() - self.started_at, 1e-9)
+        return (
+            f"scanned: {self.scanned}, processed: {self.processed}, skipped: {self.skipped}, failed: {self.failed} "
+            f"({self.processed / elapsed_sec:.1f} items/sec, {elapsed_sec:.1f} sec)"
+        )
+
+
+def _scan_pages(
+        table_name: Text,
+        segment: int,
+        total_segments: int,
+        scan_kwargs: Dict[Text, Any],
+        exclusive_start_key: Optional[Dict[Text, Any]] = None,
+) -> Iterator[ScanPage]:
+    table = get_thread_table(table_name)
+    kwargs = dict(scan_kwargs, Segment=segment, TotalSegments=total_segments)
+    if exclusive_start_key:
+        kwargs['ExclusiveStartKey'] = exclusive_start_key
+
+    while True:
+        page = call_with_retries(lambda: table.scan(**kwargs))
+        last_evaluated_key = page.get('LastEvaluatedKey')
+        yield segment, page['Items'], last_evaluated_key
+
+        if not last_evaluated_key:
+            break
+        kwargs['ExclusiveStartKey'] = last_evaluated_key
+
+
+def parallel_scan_pages(
+        table_name: Text,
+        total_segments: int = BULK_TOTAL_SEGMENTS,
+        segments: Optional[Iterable[int]] = None,
+        exclusive_start_keys: Optional[Dict[int, Dict[Text, Any]]] = None,
+        **scan_kwargs: Any,
+) -> Iterator[ScanPage]:
+    """
+    Scan the table with one thread per segment and yield the pages as they arrive (the pages of a segment arrive in
+    order). Only the given segments are scanned (all of them by default), each one from its exclusive start key if
+    there is one. If the consumer stops early (break or exception), the scanning threads stop too.
+    """
+    segments = list(range(total_segments) if segments is None else segments)
+    exclusive_start_keys = exclusive_start_keys or {}
+    pages = queue.Queue(maxsize=BULK_SCAN_QUEUE_SIZE)
+    segment_done = object()
+    errors = []
+    stop = threading.Event()
+
+    def put(page: Any) -> bool:
+        while not stop.is_set():
+            try:
+                pages.put(page, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def scan_segment(segment: int) -> None:
+        try:
+            for page in _scan_pages(
+                    table_name, segment, total_segments, scan_kwargs, exclusive_start_keys.get(segment),
+            ):
+                if not put(page):
+                    return
+        except Exception as e:
+            errors.append(e)
+        finally:
+            put(segment_done)
+
+    if not segments:
+        return
+    with ThreadPoolExecutor(max_workers=len(segments), thread_name_prefix='scan') as executor:
+        for segment in segments:
+            executor.submit(scan_segment, segment)
+
+        try:
+            segments_left = len(segments)
+            while segments_left:
+                page = pages.get()
+                if page is segment_done:
+                    segments_left -= 1
+                else:
+                    yield page
+        finally:
+            stop.set()  # the executor waits for the threads on exit - don't let them block on the full queue
+
+    if errors:
+        raise errors[0]
+
+
+def parallel_scan(
+        table_name: Text,
+        total_segments: int = BULK_TOTAL_SEGMENTS,
+        **scan_kwargs: Any,
+) -> Iterator[Dict[Text, Any]]:
+    """
+    Scan the whole table (every page of every segment) with one thread per segment.
+    """
+    for _, items, _ in parallel_scan_pages(table_name, total_segments=total_segments, **scan_kwargs):
+        yield from items
+
+
+def bulk_process(
+        table_name: Text,
+        process_item: ProcessItem,
+        total_segments: int = BULK_TOTAL_SEGMENTS,
+        max_workers: int = BULK_MAX_WORKERS,
+        max_writes_per_sec: Optional[float] = BULK_MAX_WRITES_PER_SEC,
+        **scan_kwargs: Any,
+) -> BulkStats:
+    """
+    Apply process_item to every item of the table using a pool of workers, with the writes of process_item limited by
+    max_writes_per_sec. Failures of individual items are reported and counted but do not stop the run.
+    """
+    stats = BulkStats()
+    throttle = ThreadSafeThrottle(max_writes_per_sec)
+    in_flight = threading.BoundedSemaphore(max_workers * 4)  # don't let the scan run too far ahead of the workers
+    reported_at = time.monotonic()
+
+    def process(item: Dict[Text, Any]) -> None:
+        try:
+            if process_item(ThrottledTable(get_thread_table(table_name), throttle), item) is False:
+                stats.add(skipped=1)
+            else:
+                stats.add(processed=1)
+        except Exception as e:
+            stats.add(failed=1)
+            print('FAILED FOR', item.get('user_id'), '-', repr(e))
+        finally:
+            in_flight.release()
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='bulk') as executor:
+        for item in parallel_scan(table_name, total_segments=total_segments, **scan_kwargs):
+            stats.add(scanned=1)
+            in_flight.acquire()
+            executor.submit(process, item)
+
+            if time.monotonic() - reported_at >= BULK_PROGRESS_INTERVAL_SEC:
+                print(stats)
+                reported_at = time.monotonic()
+
+    print('DONE -', stats)
+    return stats
@@ -0,0 +1,185 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from dataclasses import dataclass, field
+from typing import Text, Any, Dict, Callable, Optional, List, Deque
+
+from cli import bulk
+
+MIGRATION_MAX_RETRIES = int(os.getenv('MIGRATION_MAX_RETRIES', '10'))
+
+# migrate(item) returns kwargs for table.update_item() (without Key) or None if the item doesn't need to be migrated
+# (this is what makes migrations idempotent - an item that was migrated already should produce None)
+MigrateItem = Callable[[Dict[Text, Any]], Optional[Dict[Text, Any]]]
+
+MIGRATIONS: Dict[Text, MigrateItem] = {}
+
+
+def migration(name: Text) -> Callable[[MigrateItem], MigrateItem]:
+    def register(migrate_item: MigrateItem) -> MigrateItem:
+        if name in MIGRATIONS:
+            raise ValueError(f"migration {repr(name)} is already registered")
+        MIGRATIONS[name] = migrate_item
+        return migrate_item
+
+    return register
+
+
+@migration('remove_obsolete_attributes')
+def remove_obsolete_attributes(item: Dict[Text, Any]) -> Optional[Dict[Text, Any]]:
+    if 'exclude_partner_ids' not in item:
+        return None
+    return {
+        'UpdateExpression': 'REMOVE #exclude_list',
+        'ExpressionAttributeNames': {'#exclude_list': 'exclude_partner_ids'},
+    }
+
+
+@dataclass
+class MigrationCheckpoint:
+    """
+    Per segment progress of a migration: the key to resume the scan from (updated only after the whole page was
+    migrated) and whether the segment is finished.
+    """
+    path: Optional[Text]
+    migration_name: Text
+    total_segments: int
+    segments: Dict[Text, Dict[Text, Any]] = field(default_factory=dict)
+    counters: Dict[Text, int] = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    @classmethod
+    def load(cls, path: Optional[Text], migration_name: Text, total_segments: int) -> 'MigrationCheckpoint':
+        checkpoint = cls(path=path, migration_name=migration_name, total_segments=total_segments)
+        if not path or not os.path.exists(path):
+            return checkpoint
+
+        with open(path, encoding='utf-8') as f:
+            checkpoint_dict = json.load(f)
+        if checkpoint_dict['migration_name'] != migration_name or checkpoint_dict['total_segments'] != total_segments:
+            raise ValueError(
+                f"checkpoint {repr(path)} belongs to {repr(checkpoint_dict['migration_name'])} migration "
+                f"with {checkpoint_dict['total_segments']} segments"
+            )
+        checkpoint.segments = checkpoint_dict['segments']
+        checkpoint.counters = checkpoint_dict['counters']
+        return checkpoint
+
+    def segment_progress(self, segment: int) -> Dict[Text, Any]:
+        return self.segments.setdefault(str(segment), {'exclusive_start_key': None, 'done': False})
+
+    def page_done(self, segment: int, last_evaluated_key: Optional[Dict[Text, Any]], **counters: int) -> None:
+        with self._lock:
+            progress = self.segment_progress(segment)
+            progress['exclusive_start_key'] = last_evaluated_key
+            progress['done'] = not last_evaluated_key
+            for counter_name, value in counters.items():
+                self.counters[counter_name] = self.counters.get(counter_name, 0) + value
+            self._save()
+
+    def _save(self) -> None:
+        if not self.path:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'migration_name': self.migration_name,
+                'total_segments': self.total_segments,
+                'segments': self.segments,
+                'counters': self.counters,
+            }, f, indent=2, default=str)
+        os.replace(tmp_path, self.path)  # atomic - a crash never leaves a half-written checkpoint
+
+
+@dataclass
+class _PendingPage:
+    segment: int
+    last_evaluated_key: Optional[Dict[Text, Any]]
+    counters: Dict[Text, int]
+    futures: List[Future] = field(default_factory=list)
+
+
+def run_migration(
+        table_name: Text,
+        migration_name: Text,
+        checkpoint_path: Optional[Text],
+        dry_run: bool = False,
+        total_segments: int = bulk.BULK_TOTAL_SEGMENTS,
+        max_writes_per_sec: float = bulk.BULK_MAX_WRITES_PER_SEC,
+        max_workers: int = bulk.BULK_MAX_WORKERS,
+) -> Dict[Text, int]:
+    """
+    Apply a registered migration to every item (parallel scan of bulk, the writes go to a pool of worker threads).
+    A page is marked as done in the checkpoint only after all of its writes (and all of the pages before it in the
+    same segment) succeeded, so an interrupted migration continues where it stopped. In dry-run mode nothing is
+    written (not even the checkpoint) and only the counts are reported.
+    """
+    migrate_item = MIGRATIONS[migration_name]
+    checkpoint = MigrationCheckpoint.load(None if dry_run else checkpoint_path, migration_name, total_segments)
+    throttle = bulk.AdaptiveThrottle(max_writes_per_sec)
+    in_flight = threading.BoundedSemaphore(max_workers * 4)
+    pending_pages: Dict[int, Deque[_PendingPage]] = {}
+    failed_segments: Dict[int, BaseException] = {}
+    started_at = time.monotonic()
+
+    def update_item(key: Dict[Text, Any], update_kwargs: Dict[Text, Any]) -> None:
+        try:
+            table = bulk.get_thread_table(table_name)
+            bulk.call_with_retries(
+                lambda: table.update_item(Key=key, **update_kwargs), throttle, max_retries=MIGRATION_MAX_RETRIES,
+            )
+        finally:
+            in_flight.release()
+
+    def checkpoint_finished_pages(segment: int, wait: bool = False) -> None:
+        pages = pending_pages[segment]
+        while pages and segment not in failed_segments:
+            page = pages[0]
+            if not wait and not all(future.done() for future in page.futures):
+                return
+            for future in page.futures:
+                error = future.exception()
+                if error is not None:
+                    # the failed page and the pages after it will be migrated again when the migration is resumed
+                    failed_segments[segment] = error
+                    return
+            pages.popleft()
+            checkpoint.page_done(segment, page.last_evaluated_key, **page.counters)
+            print(f"segment {segment}: {checkpoint.counters} ({time.monotonic() - started_at:.1f} sec)")
+
+    segments = [segment for segment in range(total_segments) if not checkpoint.segment_progress(segment)['done']]
+    exclusive_start_keys = {
+        segment: checkpoint.segment_progress(segment)['exclusive_start_key'] for segment in segments
+    }
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='migrate') as executor:
+        for segment, items, last_evaluated_key in bulk.parallel_scan_pages(
+                table_name,
+                total_segments=total_segments,
+                segments=segments,
+                exclusive_start_keys=exclusive_start_keys,
+        ):
+            page = _PendingPage(segment, last_evaluated_key, {'scanned': len(items), 'migrated': 0, 'up_to_date': 0})
+            for item in items:
+                update_kwargs = migrate_item(item)
+                if update_kwargs is None:
+                    page.counters['up_to_date'] += 1
+                    continue
+                if not dry_run and segment not in failed_segments:
+                    in_flight.acquire()
+                    page.futures.append(executor.submit(update_item, {'user_id': item['user_id']}, update_kwargs))
+                page.counters['migrated'] += 1
+
+            pending_pages.setdefault(segment, deque()).append(page)
+            checkpoint_finished_pages(segment)
+
+        for segment in pending_pages:
+            checkpoint_finished_pages(segment, wait=True)
+
+    if failed_segments:
+        raise next(iter(failed_segments.values()))  # the other segments still got to finish
+
+    print('DRY RUN -' if dry_run else 'DONE -', checkpoint.counters)
+    return checkpoint.counters
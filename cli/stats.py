@@ -0,0 +1,135 @@
+import json
+from collections import Counter
+from typing import Text, Any, Dict, List, Tuple, Iterable
+
+from actions.utils import current_timestamp_int
+
+# (upper bound in seconds, label)
+AGE_BUCKETS: List[Tuple[float, Text]] = [
+    (60, '< 1 min'),
+    (60 * 10, '< 10 min'),
+    (60 * 60, '< 1 hour'),
+    (60 * 60 * 24, '< 1 day'),
+    (60 * 60 * 24 * 7, '< 1 week'),
+    (60 * 60 * 24 * 30, '< 30 days'),
+    (float('inf'), '>= 30 days'),
+]
+LIST_SIZE_BUCKETS: List[Tuple[float, Text]] = [
+    (1, '0'),
+    (6, '1-5'),
+    (21, '6-20'),
+    (51, '21-50'),
+    (float('inf'), '> 50'),
+]
+EXCLUSION_LISTS = ['roomed_partner_ids', 'rejected_partner_ids', 'seen_partner_ids']
+
+
+def _bucket(value: float, buckets: List[Tuple[float, Text]]) -> Text:
+    for upper_bound, label in buckets:
+        if value < upper_bound:
+            return label
+    raise ValueError(f"no bucket for {value}")  # should not happen with inf as the last upper bound
+
+
+class PopulationStats:
+    """
+    Aggregates are updated item by item and never hold the items themselves, hence memory stays constant no matter
+    how big the table is.
+    """
+
+    def __init__(self) -> None:
+        self.now_ts = current_timestamp_int()
+        self.total = 0
+        self.newbies = 0
+        self.by_state = Counter()
+        self.by_native = Counter()
+        self.by_teleg_lang_code = Counter()
+        self.activity_age = Counter()
+        self.timeout_expiry = Counter()
+        self.list_sizes = {list_name: Counter() for list_name in EXCLUSION_LISTS}
+        self.list_size_totals = Counter()
+        self.list_size_maxes = Counter()
+
+    def add(self, item: Dict[Text, Any]) -> None:
+        self.total += 1
+        if item.get('newbie'):
+            self.newbies += 1
+
+        self.by_state[item.get('state')] += 1
+        self.by_native[item.get('native')] += 1
+        self.by_teleg_lang_code[item.get('teleg_lang_code')] += 1
+
+        activity_timestamp = int(item.get('activity_timestamp') or 0)
+        self.activity_age['never active' if not activity_timestamp else _bucket(
+            self.now_ts - activity_timestamp, AGE_BUCKETS,
+        )] += 1
+
+        state_timeout_ts = int(item.get('state_timeout_ts') or 0)
+        if not state_timeout_ts:
+            self.timeout_expiry['no timeout'] += 1
+        elif state_timeout_ts <= self.now_ts:
+            self.timeout_expiry['expired'] += 1
+        else:
+            self.timeout_expiry['expires in ' + _bucket(state_timeout_ts - self.now_ts, AGE_BUCKETS)] += 1
+
+        for list_name in EXCLUSION_LISTS:
+            list_size = len(item.get(list_name) or [])
+            self.list_sizes[list_name][_bucket(list_size, LIST_SIZE_BUCKETS)] += 1
+            self.list_size_totals[list_name] += list_size
+            self.list_size_maxes[list_name] = max(self.list_size_maxes[list_name], list_size)
+
+    def add_all(self, items: Iterable[Dict[Text, Any]]) -> 'PopulationStats':
+        for item in items:
+            self.add(item)
+        return self
+
+    def to_dict(self) -> Dict[Text, Any]:
+        def ordered(counter: Counter, buckets: List[Tuple[float, Text]] = None) -> Dict[Text, int]:
+            if buckets is None:
+                return {str(key): count for key, count in counter.most_common()}
+            labels = [label for _, label in buckets]
+            return {label: counter[label] for label in labels if counter[label]}
+
+        return {
+            'total': self.total,
+            'newbie_ratio': round(self.newbies / self.total, 4) if self.total else None,
+            'by_state': ordered(self.by_state),
+            'by_native': ordered(self.by_native),
+            'by_teleg_lang_code': ordered(self.by_teleg_lang_code),
+            'activity_age': {
+                **ordered(self.activity_age, AGE_BUCKETS),
+                **({'never active': self.activity_age['never active']} if self.activity_age['never active'] else {}),
+            },
+            'timeout_expiry': ordered(self.timeout_expiry),
+            'exclusion_lists': {
+                list_name: {
+                    'mean': round(self.list_size_totals[list_name] / self.total, 2) if self.total else None,
+                    'max': self.list_size_maxes[list_name],
+                    'sizes': ordered(self.list_sizes[list_name], LIST_SIZE_BUCKETS),
+                }
+                for list_name in EXCLUSION_LISTS
+            },
+        }
+
+    def to_json(self) -> Text:
+        return json.dumps(self.to_dict(), indent=2, ensure_ascii=False)
+
+    def to_table(self) -> Text:
+        lines = []
+
+        def add_section(title: Text, rows: Dict[Text, Any]) -> None:
+            lines.append('')
+            lines.append(title.upper())
+            for key, value in rows.items():
+                lines.append(f"  {key:<32} {value:>10}")
+
+        stats_dict = self.to_dict()
+        add_section('population', {'total': stats_dict['total'], 'newbie ratio': stats_dict['newbie_ratio']})
+        add_section('by state', stats_dict['by_state'])
+        add_section('by native', stats_dict['by_native'])
+        add_section('by teleg_lang_code', stats_dict['by_teleg_lang_code'])
+        add_section('activity age', stats_dict['activity_age'])
+        add_section('timeout expiry', stats_dict['timeout_expiry'])
+        for list_name, list_stats in stats_dict['exclusion_lists'].items():
+            add_section(f"{list_name} (mean {list_stats['mean']}, max {list_stats['max']})", list_stats['sizes'])
+        return '\n'.join(lines)
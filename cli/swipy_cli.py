@@ -1,10 +1,10 @@
 import asyncio
 import os
 import sys
-import time
+import threading
+from collections import Counter
 from dataclasses import asdict
-from pprint import pprint
-from typing import Text, Any
+from typing import Text, Any, Dict, Callable, Optional
 
 import boto3
 import click
@@ -13,43 +13,82 @@ from click import prompt
 sys.path.insert(0, os.getcwd())
 
 from actions.user_state_machine import UserState, UserStateMachine
+from cli import bulk, broadcast, table_dump, migrations
+from cli import stats as population_stats
 
 AWS_REGION = os.environ['AWS_REGION']
 
 dynamodb = boto3.resource('dynamodb', AWS_REGION)
 
 
-def _prompt_ddb_table() -> Any:
+SKIPPED_STATES = [
+    UserState.DO_NOT_DISTURB,
+    UserState.BOT_BLOCKED,
+    UserState.USER_BANNED,
+]
+
+
+def _prompt_ddb_table_name() -> Text:
     user_state_machine_table_name = prompt('Please enter the name of UserStateMachine DDB table')
     if prompt('Once again please') != user_state_machine_table_name:
         raise ValueError('DDB table name differs')
-
-    user_state_machine_table = dynamodb.Table(user_state_machine_table_name)
-    return user_state_machine_table
+    return user_state_machine_table_name
 
 
-def _set_everyones_state(state: Text) -> None:
-    user_state_machine_table = _prompt_ddb_table()
+def _prompt_ddb_table() -> Any:
+    user_state_machine_table = dynamodb.Table(_prompt_ddb_table_name())
+    return user_state_machine_table
 
-    counter = 0
-    for item in user_state_machine_table.scan()['Items']:
-        if item.get('state') in [
-            UserState.DO_NOT_DISTURB,
-            UserState.BOT_BLOCKED,
-            UserState.USER_BANNED,
-        ]:
-            continue
 
-        user_state_machine_table.update_item(
-            Key={'user_id': item['user_id']},
-            UpdateExpression='set #state=:state',
-            ExpressionAttributeNames={'#state': 'state'},
-            ExpressionAttributeValues={':state': state},
-        )
-        counter += 1
-        if counter % 10 == 0:
-            print(counter)
-    print('DONE FOR', counter, 'ITEMS')
+def bulk_options(command: Callable) -> Callable:
+    command = click.option('--segments', default=bulk.BULK_TOTAL_SEGMENTS, show_default=True,
+                           help='Number of parallel scan segments')(command)
+    command = click.option('--workers', default=bulk.BULK_MAX_WORKERS, show_default=True,
+                           help='Number of threads that write to the table')(command)
+    command = click.option('--max-writes-per-sec', default=bulk.BULK_MAX_WRITES_PER_SEC, show_default=True,
+                           help='Throughput limit (0 means unlimited)')(command)
+    return command
+
+
+def _set_everyones_state(
+        trigger: Text,
+        segments: int,
+        workers: int,
+        max_writes_per_sec: float,
+        prepare_user: Optional[Callable[[UserStateMachine], None]] = None,
+) -> None:
+    """
+    Goes through the state machine (see UserVault.bulk_transition), but with the parallel scan, the write throttling
+    and the progress output of bulk_process. prepare_user changes the user before the transition (saved only along
+    with it).
+    """
+    table_name = _prompt_ddb_table_name()
+    # aws_resources reads the table name from the env var when imported
+    os.environ['USER_STATE_MACHINE_DDB_TABLE'] = table_name
+    from actions.user_vault import UserVault, NaiveDdbUserVault, BULK_TRANSITIONED
+
+    user_vault = UserVault()
+    outcomes = Counter()
+    outcomes_lock = threading.Lock()
+
+    def process_item(table: Any, item: Dict[Text, Any]) -> bool:
+        # noinspection PyProtectedMember
+        user = NaiveDdbUserVault._user_from_dict(item)
+        if prepare_user:
+            prepare_user(user)
+        outcome = user_vault.transition_user(user, trigger, lambda u: u.state not in SKIPPED_STATES, table=table)
+        with outcomes_lock:
+            outcomes[outcome] += 1
+        return outcome == BULK_TRANSITIONED
+
+    bulk.bulk_process(
+        table_name,
+        process_item,
+        total_segments=segments,
+        max_workers=workers,
+        max_writes_per_sec=max_writes_per_sec,
+    )
+    print('OUTCOMES -', dict(outcomes))
 
 
 @click.group()
@@ -58,69 +97,75 @@ def swipy() -> None:
 
 
 @swipy.command()
-def make_everyone_available_to_everyone() -> None:
-    user_state_machine_table = _prompt_ddb_table()
-
-    counter = 0
-    for item in user_state_machine_table.scan()['Items']:
-        if item.get('state') in [
-            UserState.DO_NOT_DISTURB,
-            UserState.BOT_BLOCKED,
-            UserState.USER_BANNED,
-        ]:
-            continue
-
-        user_state_machine_table.update_item(
-            Key={'user_id': item['user_id']},
-            UpdateExpression='SET #state=:state REMOVE #roomed, #rejected, #seen',  # , #room_name',
-            ExpressionAttributeNames={
-                # '#room_name': 'latest_room_name',
-                '#roomed': 'roomed_partner_ids',
-                '#rejected': 'rejected_partner_ids',
-                '#seen': 'seen_partner_ids',
-                '#state': 'state',
-            },
-            ExpressionAttributeValues={':state': UserState.OK_TO_CHITCHAT},
-        )
-        counter += 1
-        if counter % 10 == 0:
-            print(counter)
-    print('DONE FOR', counter, 'ITEMS')
+@bulk_options
+def make_everyone_available_to_everyone(**bulk_kwargs: Any) -> None:
+    def forget_partners(user: UserStateMachine) -> None:
+        user.roomed_partner_ids = []
+        user.rejected_partner_ids = []
+        user.seen_partner_ids = []
+
+    _set_everyones_state('become_ok_to_chitchat', prepare_user=forget_partners, **bulk_kwargs)
 
 
 @swipy.command()
-def remove_obsolete_attributes() -> None:
-    user_state_machine_table = _prompt_ddb_table()
-
-    counter = 0
-    for item in user_state_machine_table.scan()['Items']:
-        user_state_machine_table.update_item(
-            Key={'user_id': item['user_id']},
-            UpdateExpression='REMOVE #blahblah, #exclude_list',
-            ExpressionAttributeNames={
-                '#blahblah': 'blahblah',  # just testing removal of a non-existent dummy attribute
-                '#exclude_list': 'exclude_partner_ids',
-            },
-        )
-        counter += 1
-        if counter % 10 == 0:
-            print(counter)
-    print('DONE FOR', counter, 'ITEMS')
+@click.argument('migration_name', type=click.Choice(sorted(migrations.MIGRATIONS)))
+@click.option('--dry-run', is_flag=True, help='Only count the items that would be migrated')
+@click.option('--checkpoint-file', default=None,
+              help='Progress file to resume from [default: MIGRATION_NAME.migration.json]')
+@click.option('--segments', default=bulk.BULK_TOTAL_SEGMENTS, show_default=True,
+              help='Number of parallel scan segments (should not change between resumptions)')
+@click.option('--workers', default=bulk.BULK_MAX_WORKERS, show_default=True,
+              help='Number of threads that write to the table')
+@click.option('--max-writes-per-sec', default=bulk.BULK_MAX_WRITES_PER_SEC, show_default=True,
+              help='Throughput limit (0 means unlimited), lowered automatically when throughput is exceeded')
+def migrate(
+        migration_name: Text,
+        dry_run: bool,
+        checkpoint_file: Optional[Text],
+        segments: int,
+        workers: int,
+        max_writes_per_sec: float,
+) -> None:
+    """Apply a registered migration to UserStateMachine table (an interrupted migration resumes where it stopped)."""
+    migrations.run_migration(
+        _prompt_ddb_table_name(),
+        migration_name,
+        checkpoint_file or f"{migration_name}.migration.json",
+        dry_run=dry_run,
+        total_segments=segments,
+        max_writes_per_sec=max_writes_per_sec,
+        max_workers=workers,
+    )
 
 
 @swipy.command()
-def make_everyone_do_not_disturb() -> None:  # TODO oleksandr: replace with make_everyone_take_a_break
-    _set_everyones_state(UserState.DO_NOT_DISTURB)
+@click.pass_context
+def remove_obsolete_attributes(ctx: click.Context) -> None:
+    ctx.invoke(migrate, migration_name='remove_obsolete_attributes')
 
 
 @swipy.command()
-def make_everyone_ok_to_chitchat() -> None:
-    _set_everyones_state(UserState.OK_TO_CHITCHAT)
+@bulk_options
+def make_everyone_do_not_disturb(**bulk_kwargs: Any) -> None:  # TODO oleksandr: replace with make_everyone_take_a_break
+    _set_everyones_state('become_do_not_disturb', **bulk_kwargs)
 
 
 @swipy.command()
-def start_everyone() -> None:
-    user_state_machine_table = _prompt_ddb_table()
+@bulk_options
+def make_everyone_ok_to_chitchat(**bulk_kwargs: Any) -> None:
+    _set_everyones_state('become_ok_to_chitchat', **bulk_kwargs)
+
+
+@swipy.command()
+@click.option('--concurrency', default=broadcast.BROADCAST_CONCURRENCY, show_default=True,
+              help='Max number of callbacks in flight')
+@click.option('--max-per-sec', default=broadcast.BROADCAST_MAX_PER_SEC, show_default=True,
+              help='Max number of callbacks started per second')
+@click.option('--checkpoint-file', default='start_everyone.checkpoint', show_default=True,
+              help='Users recorded in this file as delivered are skipped (use it to resume an interrupted run)')
+def start_everyone(concurrency: int, max_per_sec: float, checkpoint_file: Text) -> None:
+    user_state_machine_table_name = _prompt_ddb_table_name()
+    user_state_machine_table = dynamodb.Table(user_state_machine_table_name)
 
     class DummyUserVault:
         def save(self, user: UserStateMachine) -> None:
@@ -136,33 +181,85 @@ def start_everyone() -> None:
 
     from actions import rasa_callbacks
 
-    async def do_callbacks():
-        counter = 0
-        for item in user_state_machine_table.scan()['Items']:
-            if item.get('state') in [
-                UserState.DO_NOT_DISTURB,
-                UserState.BOT_BLOCKED,
-                UserState.USER_BANNED,
-            ]:
-                continue
-
-            print(item.get('user_id'))
-            pprint(item.get('telegram_from'))
-
-            # noinspection PyProtectedMember,PyTypeChecker
-            await rasa_callbacks._trigger_external_rasa_intent(
-                'script',
-                UserStateMachine(**item, user_vault=dummy_user_vault),
-                'start',  # TODO oleksandr: support another, special "start" intent that does not update activity_ts
-                {},
-                True,
-            )
-            counter += 1
-            print()
-            time.sleep(1.1)
-        print('DONE FOR', counter, 'ITEMS')
-
-    asyncio.run(do_callbacks())
+    def item_to_user(item: Dict[Text, Any]) -> Optional[UserStateMachine]:
+        if item.get('state') in SKIPPED_STATES:
+            return None
+        # noinspection PyTypeChecker
+        return UserStateMachine(**item, user_vault=dummy_user_vault)
+
+    async def send_to_user(user: UserStateMachine) -> None:
+        # noinspection PyProtectedMember
+        await rasa_callbacks._trigger_external_rasa_intent(
+            'script',
+            user,
+            'start',  # TODO oleksandr: support another, special "start" intent that does not update activity_ts
+            {},
+            False,  # errors should reach the broadcast report
+        )
+
+    asyncio.run(broadcast.broadcast(
+        bulk.parallel_scan(user_state_machine_table_name),
+        item_to_user,
+        send_to_user,
+        checkpoint_path=checkpoint_file,
+        concurrency=concurrency,
+        max_per_sec=max_per_sec,
+    ))
+
+
+@swipy.command()
+@click.argument('path')
+@click.option('--segments', default=bulk.BULK_TOTAL_SEGMENTS, show_default=True,
+              help='Number of parallel scan segments')
+def export_users(path: Text, segments: int) -> None:
+    """Export UserStateMachine table into a JSONL file (gzipped if PATH ends with .gz)."""
+    table_dump.export_table(_prompt_ddb_table_name(), path, total_segments=segments)
+
+
+@swipy.command()
+@click.argument('path')
+@click.option('--workers', default=bulk.BULK_MAX_WORKERS, show_default=True,
+              help='Number of threads that write to the table')
+@click.option('--max-writes-per-sec', default=bulk.BULK_MAX_WRITES_PER_SEC, show_default=True,
+              help='Throughput limit (0 means unlimited)')
+def import_users(path: Text, workers: int, max_writes_per_sec: float) -> None:
+    """Import users from a JSONL file produced by export-users (users with the same ids are overwritten)."""
+    table_dump.import_table(path, _prompt_ddb_table_name(), max_workers=workers, max_writes_per_sec=max_writes_per_sec)
+
+
+@swipy.command()
+@click.option('--output-format', type=click.Choice(['table', 'json']), default='table', show_default=True)
+@click.option('--segments', default=bulk.BULK_TOTAL_SEGMENTS, show_default=True,
+              help='Number of parallel scan segments')
+def stats(output_format: Text, segments: int) -> None:
+    """Population statistics computed in one pass over UserStateMachine table."""
+    projected_attributes = [
+        'state',
+        'native',
+        'teleg_lang_code',
+        'newbie',
+        'activity_timestamp',
+        'state_timeout_ts',
+        *population_stats.EXCLUSION_LISTS,
+    ]
+    items = bulk.parallel_scan(
+        _prompt_ddb_table_name(),
+        total_segments=segments,
+        # don't fetch attributes we don't need (telegram_from, notes etc.)
+        ProjectionExpression=', '.join(f"#a{idx}" for idx in range(len(projected_attributes))),
+        ExpressionAttributeNames={f"#a{idx}": attr for idx, attr in enumerate(projected_attributes)},
+    )
+    population = population_stats.PopulationStats().add_all(items)
+    print(population.to_json() if output_format == 'json' else population.to_table())
+
+
+@swipy.command()
+def generate_keyboard_intents() -> None:
+    from actions.actions import generate_keyboard_intents_module, KEYBOARD_INTENTS_MODULE_PATH
+
+    with open(KEYBOARD_INTENTS_MODULE_PATH, 'w', encoding='utf-8') as f:
+        f.write(generate_keyboard_intents_module())
+    print('GENERATED', KEYBOARD_INTENTS_MODULE_PATH)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,104 @@
+import gzip
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+from decimal import Decimal
+from typing import Text, Any, Dict, List, IO, Optional
+
+from actions.user_state_machine import UserModel
+from actions.user_vault import NaiveDdbUserVault
+from cli import bulk
+
+IMPORT_CHUNK_SIZE = int(os.getenv('IMPORT_CHUNK_SIZE', '500'))
+
+
+def _open(path: Text, mode: Text) -> IO:
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, Decimal):  # numbers nested in telegram_from etc.
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def item_to_json_line(item: Dict[Text, Any]) -> Text:
+    # noinspection PyProtectedMember,PyDataclass
+    user_dict = asdict(NaiveDdbUserVault._user_from_dict(item, UserModel))
+    return json.dumps(user_dict, ensure_ascii=False, default=_json_default) + '\n'
+
+
+def json_line_to_item(line: Text) -> Dict[Text, Any]:
+    # DDB doesn't accept floats
+    user_dict = json.loads(line, parse_float=Decimal)
+    # noinspection PyProtectedMember,PyDataclass
+    return asdict(NaiveDdbUserVault._user_from_dict(user_dict, UserModel))
+
+
+def export_table(table_name: Text, path: Text, total_segments: int = bulk.BULK_TOTAL_SEGMENTS) -> int:
+    """
+    Stream all users into a JSONL file (gzipped if path ends with .gz). Only a bounded number of items is held in
+    memory at any given moment.
+    """
+    counter = 0
+    with _open(path, 'w') as f:
+        for item in bulk.parallel_scan(table_name, total_segments=total_segments):
+            f.write(item_to_json_line(item))
+            counter += 1
+            if counter % 1000 == 0:
+                print(counter)
+    print('EXPORTED', counter, 'ITEMS')
+    return counter
+
+
+def import_table(
+        path: Text,
+        table_name: Text,
+        max_workers: int = bulk.BULK_MAX_WORKERS,
+        max_writes_per_sec: Optional[float] = bulk.BULK_MAX_WRITES_PER_SEC,
+) -> bulk.BulkStats:
+    """
+    Stream users from a JSONL file into the table. Items are written with batch writers from a pool of threads
+    (existing users with the same user_id are overwritten).
+    """
+    stats = bulk.BulkStats()
+    throttle = bulk.ThreadSafeThrottle(max_writes_per_sec)
+    in_flight = threading.BoundedSemaphore(max_workers * 2)
+
+    def write_chunk(lines: List[Text]) -> None:
+        try:
+            with bulk.get_thread_table(table_name).batch_writer() as batch:
+                for line in lines:
+                    throttle.wait()
+                    batch.put_item(Item=json_line_to_item(line))
+            stats.add(processed=len(lines))
+        except Exception as e:
+            stats.add(failed=len(lines))
+            print('FAILED TO WRITE A CHUNK OF', len(lines), 'ITEMS -', repr(e))
+        finally:
+            in_flight.release()
+
+    def submit(lines: List[Text]) -> None:
+        in_flight.acquire()
+        executor.submit(write_chunk, lines)
+        print(stats)
+
+    with _open(path, 'r') as f, ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='import') as executor:
+        chunk = []
+        for line in f:
+            if not line.strip():
+                continue
+            stats.add(scanned=1)
+            chunk.append(line)
+            if len(chunk) >= IMPORT_CHUNK_SIZE:
+                submit(chunk)
+                chunk = []
+        if chunk:
+            submit(chunk)
+
+    print('DONE -', stats)
+    return stats
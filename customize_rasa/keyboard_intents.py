@@ -0,0 +1,15 @@
+# GENERATED FROM THE *_MARKUP CONSTANTS OF actions/actions.py - DO NOT EDIT MANUALLY !
+# (run `python cli/swipy_cli.py generate-keyboard-intents` to regenerate)
+KEYBOARD_INTENTS = {
+    'Call another person': 'someone_else',
+    'Cancel': 'stop',
+    'Share my contact info': 'share_contact',
+    'Connect me with someone else': 'someone_else',
+    'No, thanks': 'deny',
+    '❌ Stop the call': 'stop',
+    'Yes, connect me': 'videochat',
+    'How does it work?': 'help',
+    'Yes': 'affirm',
+    'No': 'deny',
+    'Not now': 'another_time',
+}
@@ -1,17 +1,152 @@
+import asyncio
+import logging
 import os
-from typing import Callable, Awaitable, Any, Optional, Dict, Text
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from functools import wraps
+from typing import Callable, Awaitable, Any, Optional, Dict, Text, Set
 
-import ujson
 from rasa.core.channels import TelegramInput, UserMessage
 from rasa.core.channels.telegram import TelegramOutput
-from sanic import Blueprint
+from rasa.shared.nlu.constants import INTENT_MESSAGE_PREFIX
+from sanic import Blueprint, response
 from sanic.request import Request
 
+from customize_rasa.keyboard_intents import KEYBOARD_INTENTS
+
+logger = logging.getLogger(__name__)
+
 SWIPY_TELEGRAM_WEBHOOK_SECRET = os.environ['SWIPY_TELEGRAM_WEBHOOK_SECRET']
+SWIPY_UPDATE_DEDUP_CACHE_SIZE = int(os.getenv('SWIPY_UPDATE_DEDUP_CACHE_SIZE', '10000'))
+# if set, recent update ids are also shared across Rasa replicas through this DDB table (hash key: update_id, type N)
+SWIPY_UPDATE_DEDUP_DDB_TABLE = os.getenv('SWIPY_UPDATE_DEDUP_DDB_TABLE')
+SWIPY_UPDATE_DEDUP_TTL_SEC = int(os.getenv('SWIPY_UPDATE_DEDUP_TTL_SEC', '86400'))  # Telegram keeps updates for 24h
 START_DEEPLINK_PREFIX = '/start '
 
+WEBHOOK_ROUTE_URI = '/webhook'
+
+
+class IUpdateIdStore(ABC):
+    @abstractmethod
+    async def remember(self, update_id: int) -> bool:
+        """
+        Remember update_id and return True if it is new or False if it was seen before.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    async def forget(self, update_id: int) -> None:
+        """
+        Forget update_id, so the next delivery of the update is processed (processing of the update failed).
+        """
+        raise NotImplementedError()
+
+
+class InMemoryUpdateIdStore(IUpdateIdStore):
+    def __init__(self, max_size: int = SWIPY_UPDATE_DEDUP_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        self._update_ids = OrderedDict()
+
+    async def remember(self, update_id: int) -> bool:
+        if update_id in self._update_ids:
+            return False
+
+        self._update_ids[update_id] = None
+        while len(self._update_ids) > self.max_size:
+            self._update_ids.popitem(last=False)
+        return True
+
+    async def forget(self, update_id: int) -> None:
+        self._update_ids.pop(update_id, None)
+
+
+class DdbUpdateIdStore(IUpdateIdStore):
+    def __init__(self, table_name: Text, ttl_sec: int = SWIPY_UPDATE_DEDUP_TTL_SEC) -> None:
+        import boto3  # Rasa depends on boto3 anyway, but let's not import it if it's not needed
+
+        self.ttl_sec = ttl_sec
+        self._table = boto3.resource('dynamodb', os.environ['AWS_REGION']).Table(table_name)
+
+    def _remember(self, update_id: int) -> bool:
+        from botocore.exceptions import ClientError
+
+        try:
+            self._table.put_item(
+                Item={
+                    'update_id': update_id,
+                    'expires_at': int(time.time()) + self.ttl_sec,  # should be configured as TTL attribute of the table
+                },
+                ConditionExpression='attribute_not_exists(update_id)',
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+
+    async def remember(self, update_id: int) -> bool:
+        return await asyncio.get_event_loop().run_in_executor(None, self._remember, update_id)
+
+    def _forget(self, update_id: int) -> None:
+        self._table.delete_item(Key={'update_id': update_id})
+
+    async def forget(self, update_id: int) -> None:
+        await asyncio.get_event_loop().run_in_executor(None, self._forget, update_id)
+
+
+class LayeredUpdateIdStore(IUpdateIdStore):
+    """
+    Consults the (fast) local store first and only then the shared one.
+    """
+
+    def __init__(self, local_store: IUpdateIdStore, shared_store: IUpdateIdStore) -> None:
+        self.local_store = local_store
+        self.shared_store = shared_store
+
+    async def remember(self, update_id: int) -> bool:
+        if not await self.local_store.remember(update_id):
+            return False
+
+        # noinspection PyBroadException
+        try:
+            return await self.shared_store.remember(update_id)
+        except Exception:
+            # better process a duplicate than lose an update
+            logger.exception('failed to check update_id %r against the shared store', update_id)
+            return True
+
+    async def forget(self, update_id: int) -> None:
+        await self.local_store.forget(update_id)
+
+        # noinspection PyBroadException
+        try:
+            await self.shared_store.forget(update_id)
+        except Exception:
+            logger.exception('failed to forget update_id %r in the shared store', update_id)
+
+
+def create_update_id_store() -> IUpdateIdStore:
+    update_id_store = InMemoryUpdateIdStore()
+    if SWIPY_UPDATE_DEDUP_DDB_TABLE:
+        update_id_store = LayeredUpdateIdStore(update_id_store, DdbUpdateIdStore(SWIPY_UPDATE_DEDUP_DDB_TABLE))
+    return update_id_store
+
+
+def _get_text_filled_forms(forms: Dict[Text, Any]) -> Set[Text]:
+    text_filled_forms = set()
+    for form_name, form in forms.items():
+        for slot_mappings in ((form or {}).get('required_slots') or {}).values():
+            if any(mapping.get('type') == 'from_text' for mapping in slot_mappings or []):
+                text_filled_forms.add(form_name)
+    return text_filled_forms
+
 
 class SwiperTelegramInput(TelegramInput):
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.update_id_store = create_update_id_store()
+
     def url_prefix(self) -> Text:
         return self.name() + SWIPY_TELEGRAM_WEBHOOK_SECRET
 
@@ -27,26 +162,98 @@ class SwiperTelegramInput(TelegramInput):
                     message.metadata = message.metadata or {}
                     message.metadata['deeplink_data'] = deeplink_data
 
+            elif message.metadata and message.metadata.get('keyboard_button_text') == message.text:
+                # a keyboard button was pressed - an exact match doesn't need NLU (Rasa parses "/intent" messages
+                # with RegexInterpreter, which yields the intent with full confidence)
+                message.text = INTENT_MESSAGE_PREFIX + KEYBOARD_INTENTS[message.text]
+
             res = await on_new_message(message)
             return res
 
-        return super().blueprint(handler)
+        telegram_webhook = super().blueprint(handler)
 
-    def get_metadata(self, request: Request) -> Optional[Dict[Text, Any]]:
-        if request.method == "POST":
-            # TODO oleksandr: go back to request.json when telebot fixes the problem they created
-            #  https://github.com/eternnoir/pyTelegramBotAPI/issues/1219
-            # request_dict = request.json  # new version of telebot ruins this dict by injecting its objects into it
-            request_dict = ujson.loads(request.body)
-
-            # TODO oleksandr: account for other types of updates too (not all of them have 'message') ?
-            telegram_message = request_dict.get('message') or {}
-            telegram_from = telegram_message.get('from')
-            if telegram_from:
-                return {'telegram_from': telegram_from}
+        for route_idx, route in enumerate(telegram_webhook.routes):
+            if route.uri == WEBHOOK_ROUTE_URI:
+                telegram_webhook.routes[route_idx] = route._replace(handler=self._wrap_webhook(route.handler))
+
+        return telegram_webhook
+
+    def _wrap_webhook(
+            self, webhook_handler: Callable[[Request], Awaitable[Any]],
+    ) -> Callable[[Request], Awaitable[Any]]:
+        @wraps(webhook_handler)
+        async def webhook(request: Request) -> Any:
+            if request.method == 'POST':
+                # sanic parses the body only once and caches the result
+                telegram_update = request.json or {}
 
+                telegram_message = telegram_update.get('message')
+                if not telegram_message:
+                    # edited messages, channel posts, callback queries etc. are of no interest to us => don't waste
+                    # NLU and tracker store on them
+                    return response.text('success')
+
+                update_id = telegram_update.get('update_id')
+                if update_id is not None and not await self.update_id_store.remember(update_id):
+                    # Telegram re-delivers updates when we are slow to respond - acknowledge the retry without
+                    # processing the same message twice
+                    logger.info('IGNORING DUPLICATE TELEGRAM UPDATE (update_id = %r)', update_id)
+                    return response.text('success')
+
+                # extract the metadata before the parent handler passes the update to telebot (new versions of
+                # telebot ruin the dict by injecting their objects into it -
+                # https://github.com/eternnoir/pyTelegramBotAPI/issues/1219)
+                request.ctx.swiper_metadata = self._extract_metadata(telegram_message)
+
+                text = telegram_message.get('text')
+                if text in KEYBOARD_INTENTS and not await self._is_text_form_active(request, telegram_message):
+                    # the original text stays in the tracker (as metadata of the user event)
+                    request.ctx.swiper_metadata = request.ctx.swiper_metadata or {}
+                    request.ctx.swiper_metadata['keyboard_button_text'] = text
+
+                try:
+                    return await webhook_handler(request)
+                except Exception:
+                    # the update is marked as seen before processing (so a retry that arrives while the original
+                    # delivery is still being processed is suppressed) - a failed update should not stay marked
+                    if update_id is not None:
+                        await self.update_id_store.forget(update_id)
+                    raise
+
+            return await webhook_handler(request)
+
+        return webhook
+
+    @staticmethod
+    async def _is_text_form_active(request: Request, telegram_message: Dict[Text, Any]) -> bool:
+        """
+        A form that fills its slots from free text (give_feedback_form) should get "Yes" or "Cancel" as text, not as
+        /affirm or /stop.
+        """
+        agent = getattr(request.app, 'agent', None)
+        if agent is None or agent.tracker_store is None:
+            return False
+
+        # noinspection PyBroadException
+        try:
+            sender_id = str(telegram_message['chat']['id'])
+            tracker = await asyncio.get_event_loop().run_in_executor(None, agent.tracker_store.retrieve, sender_id)
+            return tracker is not None and tracker.active_loop_name in _get_text_filled_forms(agent.domain.forms)
+        except Exception:
+            # NLU will take care of the message then
+            logger.exception('failed to check whether a text filled form is active')
+            return True
+
+    @staticmethod
+    def _extract_metadata(telegram_message: Dict[Text, Any]) -> Optional[Dict[Text, Any]]:
+        telegram_from = telegram_message.get('from')
+        if telegram_from:
+            return {'telegram_from': dict(telegram_from)}
         return None
 
+    def get_metadata(self, request: Request) -> Optional[Dict[Text, Any]]:
+        return getattr(request.ctx, 'swiper_metadata', None)
+
     def get_output_channel(self) -> TelegramOutput:
         channel = super().get_output_channel()
         raw_get_me = channel.get_me
@@ -1,5 +1,4 @@
 import json
-import os
 import random
 import traceback
 from datetime import datetime
@@ -7,15 +6,22 @@ from typing import List, Text
 from unittest.mock import MagicMock, patch
 
 import pytest
-from boto3.resources.base import ServiceResource
 from rasa.shared.core.domain import Domain
 from rasa_sdk import Tracker
 from rasa_sdk.executor import CollectingDispatcher
 from rasa_sdk.types import DomainDict
 
+from actions.rate_limiter import RateGovernor
 from actions.utils import datetime_now
 
 
+@pytest.fixture(autouse=True)
+def fresh_rate_governor() -> RateGovernor:
+    """make sure outgoing rate limits consumed by one test don't slow down the other ones"""
+    with patch('actions.rate_limiter.rate_governor', RateGovernor()) as rate_governor:
+        yield rate_governor
+
+
 @pytest.fixture
 def wrap_actions_datetime_now() -> MagicMock:
     _original_datetime_now = datetime_now
@@ -83,71 +89,3 @@ def domain() -> DomainDict:
     """Load the domain and return it as a dictionary"""
     domain = Domain.load("domain.yml")
     return domain.as_dict()
-
-
-@pytest.fixture
-def create_user_state_machine_table(mock_ddb: ServiceResource) -> None:
-    user_state_machine_ddb_table_name = os.environ['USER_STATE_MACHINE_DDB_TABLE']
-    # noinspection PyUnresolvedReferences
-    mock_ddb.create_table(
-        TableName=user_state_machine_ddb_table_name,
-        AttributeDefinitions=[
-            {
-                'AttributeName': 'user_id',
-                'AttributeType': 'S',
-            },
-            {
-                'AttributeName': 'state',
-                'AttributeType': 'S',
-            },
-            {
-                'AttributeName': 'state_timeout_ts',
-                'AttributeType': 'N',
-            },
-            {
-                'AttributeName': 'activity_timestamp',
-                'AttributeType': 'N',
-            },
-        ],
-        KeySchema=[
-            {
-                'AttributeName': 'user_id',
-                'KeyType': 'HASH',
-            },
-        ],
-        GlobalSecondaryIndexes=[
-            {
-                'IndexName': 'by_state_and_timeout_ts',
-                'KeySchema': [
-                    {
-                        'AttributeName': 'state',
-                        'KeyType': 'HASH',
-                    },
-                    {
-                        'AttributeName': 'state_timeout_ts',
-                        'KeyType': 'RANGE',
-                    },
-                ],
-                'Projection': {
-                    'ProjectionType': 'ALL',
-                },
-            },
-            {
-                'IndexName': 'by_state_and_activity_ts',
-                'KeySchema': [
-                    {
-                        'AttributeName': 'state',
-                        'KeyType': 'HASH',
-                    },
-                    {
-                        'AttributeName': 'activity_timestamp',
-                        'KeyType': 'RANGE',
-                    },
-                ],
-                'Projection': {
-                    'ProjectionType': 'ALL',
-                },
-            },
-        ],
-        BillingMode='PAY_PER_REQUEST',
-    )
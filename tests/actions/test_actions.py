@@ -9,13 +9,15 @@ import pytest
 from aioresponses import aioresponses
 from aioresponses.core import RequestCall
 from rasa_sdk import Tracker
-from rasa_sdk.events import SessionStarted, ActionExecuted, SlotSet, EventType, UserUtteranceReverted, FollowupAction
+from rasa_sdk.events import SessionStarted, ActionExecuted, SlotSet, EventType, UserUtteranceReverted, FollowupAction, \
+    ReminderCancelled
 from rasa_sdk.executor import CollectingDispatcher
 from yarl import URL
 
-from actions import actions, daily_co
+from actions import actions, daily_co, outbox
 from actions.user_state_machine import UserStateMachine, UserState
 from actions.user_vault import UserVault, IUserVault
+from actions.utils import SwiperError
 
 UTTER_ERROR_TEXT = 'Ouch! Something went wrong 🤖'
 
@@ -640,11 +642,11 @@ async def test_action_find_partner(
     assert action.name() == 'action_find_partner'
 
     actual_events = await action.run(dispatcher, tracker, domain)
+    await outbox.wait_for_pending_side_effects()  # rasa_callbacks.ask_to_join() is deferred till after the response
 
     if expect_dry_run:
         assert actual_events == [
-            UserUtteranceReverted(),
-            SlotSet('swiper_state', source_swiper_state),
+            UserUtteranceReverted(),  # the slots and the reminders are not touched either
         ]
 
         mock_get_random_available_partner_dict.assert_not_called()
@@ -834,6 +836,108 @@ async def test_action_find_partner_no_one(
     )
 
 
+@pytest.mark.asyncio
+@pytest.mark.usefixtures('ddb_unit_test_user', 'wrap_actions_datetime_now')
+@patch('time.time', Mock(return_value=1619945501))
+@patch.object(actions, 'SEARCH_TICKS_IN_PROCESS', True)
+@patch.object(UserVault, '_get_random_available_partner_dict', Mock(return_value=None))
+async def test_action_find_partner_ticks_in_process(
+        tracker: Tracker,
+        dispatcher: CollectingDispatcher,
+        domain: Dict[Text, Any],
+) -> None:
+    with patch.object(actions.timer_wheel, 'timer_wheel', MagicMock()) as mock_timer_wheel:
+        actual_events = await actions.ActionFindPartner().run(dispatcher, tracker, domain)
+
+    assert actual_events == [
+        SlotSet('swiper_action_result', 'success'),
+        SlotSet('partner_search_start_ts', '1619945501'),
+        {
+            'date_time': '2021-05-25T00:01:57',  # Rasa is only reminded when the search times out
+            'entities': None,
+            'event': 'reminder',
+            'intent': 'EXTERNAL_find_partner',
+            'kill_on_user_msg': False,
+            'name': 'unit_test_userEXTERNAL_find_partner',
+            'timestamp': None,
+        },
+        SlotSet('swiper_state', 'wants_chitchat'),
+    ]
+    mock_timer_wheel.schedule.assert_called_once_with(
+        'unit_test_user',
+        3,
+        actions.ActionFindPartner.run_search_tick,
+        'unit_test_user',
+        1619945501,
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures('ddb_unit_test_user', 'wrap_actions_datetime_now')
+@patch('time.time', Mock(return_value=1619945501))
+@patch.object(actions, 'MATCHMAKER_ENABLED', True)
+@patch.object(actions, 'SEARCH_TICKS_IN_PROCESS', True)
+@patch.object(UserVault, '_get_random_available_partner_dict')
+async def test_action_find_partner_matchmaker_enabled(
+        mock_get_random_available_partner_dict: MagicMock,
+        tracker: Tracker,
+        dispatcher: CollectingDispatcher,
+        domain: Dict[Text, Any],
+) -> None:
+    with patch.object(actions.timer_wheel, 'timer_wheel', MagicMock()) as mock_timer_wheel:
+        actual_events = await actions.ActionFindPartner().run(dispatcher, tracker, domain)
+
+    assert actual_events[2]['date_time'] == '2021-05-25T00:01:57'  # Rasa is only reminded when the search times out
+    mock_get_random_available_partner_dict.assert_not_called()  # the matchmaker asks partners to join instead
+    mock_timer_wheel.schedule.assert_not_called()
+
+
+@pytest.mark.parametrize('partner_found, search_start_ts, expected_delays', [
+    (False, 1619945501, [3, 6, 12, 24, 30]),
+    (True, 1619945501, [3, 3, 3, 3, 3]),
+    (False, 1619945501 - 100, [3, 6, 12, 17, 17]),  # only 16 seconds are left till the end of the search
+])
+@patch('time.time', Mock(return_value=1619945501))
+@patch.object(actions, 'ADAPTIVE_SEARCH_TICKS', True)
+def test_action_find_partner_search_tick_delay(
+        partner_found: bool,
+        search_start_ts: int,
+        expected_delays: List[float],
+) -> None:
+    scheduler = actions.tick_scheduler.AdaptiveTickScheduler(3, max_delay_sec=30)
+    with patch.object(actions, 'search_tick_scheduler', scheduler):
+        actual_delays = [
+            actions.ActionFindPartner.get_search_tick_delay('unit_test_user', partner_found, search_start_ts)
+            for _ in expected_delays
+        ]
+    assert actual_delays == expected_delays
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures('create_user_state_machine_table')
+@pytest.mark.parametrize('state, search_start_ts, expect_search, expect_next_tick', [
+    ('wants_chitchat', 1619945501, True, True),
+    ('wants_chitchat', 1619945501 - 116, True, False),  # the search timed out
+    ('ok_to_chitchat', 1619945501, False, False),  # the user is not searching anymore
+])
+@patch('time.time', Mock(return_value=1619945501))
+@patch.object(actions.ActionFindPartner, 'ask_random_partner_to_join')
+async def test_action_find_partner_search_tick(
+        mock_ask_random_partner_to_join: MagicMock,
+        state: Text,
+        search_start_ts: int,
+        expect_search: bool,
+        expect_next_tick: bool,
+) -> None:
+    UserVault().save(UserStateMachine(user_id='unit_test_user', state=state))
+
+    with patch.object(actions.timer_wheel, 'timer_wheel', MagicMock()) as mock_timer_wheel:
+        await actions.ActionFindPartner.run_search_tick('unit_test_user', search_start_ts)
+
+    assert mock_ask_random_partner_to_join.called == expect_search
+    assert mock_timer_wheel.schedule.called == expect_next_tick
+
+
 @pytest.mark.asyncio
 @pytest.mark.usefixtures('create_user_state_machine_table', 'wrap_traceback_format_exception')
 @patch('time.time', Mock(return_value=1619945501))
@@ -1896,8 +2000,6 @@ async def test_action_expire_partner_confirmation(
         # action is NOT expected to have had an effect
         assert actual_events == [
             UserUtteranceReverted(),
-            SlotSet('swiper_state', source_swiper_state),
-            SlotSet('partner_id', 'some_partner_id'),
         ]
         assert dispatcher.messages == []
 
@@ -1911,3 +2013,116 @@ async def test_action_expire_partner_confirmation(
         seen_partner_ids=['seen_partner1', 'seen_partner2', 'seen_partner3'],
         newbie=True,
     )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('action_class, latest_message, slots, source_swiper_state', [
+    (actions.ActionFindPartner, {'intent': {'name': 'EXTERNAL_find_partner'}}, {}, 'asked_to_join'),
+    (actions.ActionExpirePartnerConfirmation, {}, {}, 'roomed'),
+    (actions.ActionRoomDisposalReport, {}, {'disposed_room_name': 'another_room'}, 'roomed'),
+    (actions.ActionRoomExpirationReport, {}, {'disposed_room_name': 'some_room'}, 'ok_to_chitchat'),
+])
+@pytest.mark.usefixtures('create_user_state_machine_table')
+async def test_precondition_not_satisfied(
+        tracker: Tracker,
+        dispatcher: CollectingDispatcher,
+        domain: Dict[Text, Any],
+        action_class: Type[actions.BaseSwiperAction],
+        latest_message: Dict[Text, Any],
+        slots: Dict[Text, Any],
+        source_swiper_state: Text,
+) -> None:
+    tracker.latest_message = latest_message
+    tracker.slots.update(slots)
+
+    UserVault().save(UserStateMachine(
+        user_id='unit_test_user',
+        state=source_swiper_state,
+        partner_id='some_partner_id',
+        latest_room_name='some_room',
+    ))
+
+    action = action_class()
+    with patch.object(UserVault, 'save') as mock_save, \
+            patch.object(action_class, 'swipy_run', new_callable=AsyncMock) as mock_swipy_run:
+        actual_events = await action.run(dispatcher, tracker, domain)
+
+    assert actual_events == [
+        UserUtteranceReverted(),  # the slots and the reminders are not touched either
+    ]
+    assert dispatcher.messages == []
+    mock_save.assert_not_called()  # nothing to do => nothing to write
+    mock_swipy_run.assert_not_called()
+
+
+def _reminder_event(intent_name: Text) -> Dict[Text, Any]:
+    return {'event': 'reminder', 'name': 'unit_test_user' + intent_name, 'intent': intent_name}
+
+
+def _user_event(intent_name: Text) -> Dict[Text, Any]:
+    return {'event': 'user', 'parse_data': {'intent': {'name': intent_name}}}
+
+
+@pytest.mark.parametrize('tracker_events, user_state, returned_events, expected_cancellations', [
+    ([], 'ok_to_chitchat', [], []),
+    (
+            [_reminder_event('EXTERNAL_find_partner')],
+            'ok_to_chitchat',
+            [],
+            [ReminderCancelled(name='unit_test_userEXTERNAL_find_partner', intent_name='EXTERNAL_find_partner')],
+    ),
+    ([_reminder_event('EXTERNAL_find_partner')], 'wants_chitchat', [], []),  # still relevant
+    ([_reminder_event('EXTERNAL_find_partner'), _user_event('EXTERNAL_find_partner')], 'ok_to_chitchat', [], []),
+    (
+            [
+                _reminder_event('EXTERNAL_find_partner'),
+                {'event': 'cancel_reminder', 'name': 'unit_test_userEXTERNAL_find_partner'},
+            ],
+            'ok_to_chitchat',
+            [],
+            [],
+    ),
+    (
+            [_reminder_event('EXTERNAL_find_partner')],
+            'ok_to_chitchat',
+            [_reminder_event('EXTERNAL_find_partner')],  # rescheduled by the action itself
+            [],
+    ),
+    (
+            [
+                _reminder_event('EXTERNAL_room_disposal_report'),
+                _reminder_event('EXTERNAL_room_expiration_report'),
+                _reminder_event('EXTERNAL_expire_partner_confirmation'),
+                _user_event('stop'),
+            ],
+            'roomed',
+            [],
+            [ReminderCancelled(
+                name='unit_test_userEXTERNAL_expire_partner_confirmation',
+                intent_name='EXTERNAL_expire_partner_confirmation',
+            )],
+    ),
+])
+def test_cancel_obsolete_reminders(
+        tracker: Tracker,
+        tracker_events: List[Dict[Text, Any]],
+        user_state: Text,
+        returned_events: List[Dict[Text, Any]],
+        expected_cancellations: List[Dict[Text, Any]],
+) -> None:
+    tracker.events.extend(tracker_events)
+    current_user = UserStateMachine(user_id='unit_test_user', state=user_state)
+
+    assert actions.cancel_obsolete_reminders(tracker, current_user, returned_events) == expected_cancellations
+
+
+def test_keyboard_intents_module_is_up_to_date() -> None:
+    with open(actions.KEYBOARD_INTENTS_MODULE_PATH, encoding='utf-8') as f:
+        assert f.read() == actions.generate_keyboard_intents_module(), \
+            'please run `python cli/swipy_cli.py generate-keyboard-intents`'
+
+
+@patch.dict(actions.KEYBOARD_BUTTON_INTENTS, clear=True)
+def test_keyboard_button_without_intent() -> None:
+    with pytest.raises(SwiperError):
+        actions.generate_keyboard_intents_module()
@@ -0,0 +1,302 @@
+from dataclasses import asdict
+from typing import Text, List, Dict
+from unittest.mock import patch, Mock
+
+import pytest
+
+from actions import candidate_snapshot
+from actions.candidate_snapshot import CandidateSnapshot
+from actions.user_state_machine import UserModel, UserState, UserStateMachine
+from actions.user_vault import UserVault
+
+
+@pytest.fixture(autouse=True)
+def fresh_snapshot() -> None:
+    candidate_snapshot.reset_snapshot()
+    yield
+    candidate_snapshot.reset_snapshot()
+
+
+@pytest.fixture
+def snapshot() -> CandidateSnapshot:
+    return CandidateSnapshot([
+        UserModel('recent', state=UserState.OK_TO_CHITCHAT, activity_timestamp=1619945500, native='en'),
+        UserModel('less_recent', state=UserState.WANTS_CHITCHAT, activity_timestamp=1619945000, native='uk'),
+        UserModel('old', state=UserState.OK_TO_CHITCHAT, activity_timestamp=1619900000, native='uk', newbie=False),
+        UserModel('timed_out', state=UserState.ROOMED, state_timeout_ts=1619945500, activity_timestamp=1619944000),
+        UserModel('not_timed_out', state=UserState.ROOMED, state_timeout_ts=1619945502, activity_timestamp=1619945501),
+        UserModel('do_not_disturb', state=UserState.DO_NOT_DISTURB, activity_timestamp=1619945501),
+        UserModel('excludes_searcher', state=UserState.OK_TO_CHITCHAT, activity_timestamp=1619945501,
+                  rejected_partner_ids=['searcher']),
+        UserModel('has_seen_searcher', state=UserState.OK_TO_CHITCHAT, activity_timestamp=1619945501,
+                  seen_partner_ids=['searcher']),
+    ])
+
+
+@pytest.mark.parametrize('searcher, scorer_weights, exclude_user_ids, limit, expected_user_ids', [
+    (
+            UserModel('searcher'),
+            {'recency': 1},
+            [],
+            10,
+            ['recent', 'less_recent', 'timed_out', 'old'],
+    ),
+    (
+            UserModel('searcher'),
+            {'recency': 1},
+            ['searcher', 'recent'],
+            2,
+            ['less_recent', 'timed_out'],
+    ),
+    (
+            UserModel('searcher', native='uk'),
+            {'recency': 1, 'same_native': 2},
+            [],
+            10,
+            ['less_recent', 'old', 'recent', 'timed_out'],
+    ),
+    (
+            UserModel('searcher', newbie=True),
+            {'newbie_veteran': 1},
+            [],
+            1,
+            ['old'],
+    ),
+])
+def test_rank(
+        snapshot: CandidateSnapshot,
+        searcher: UserModel,
+        scorer_weights: Dict[Text, float],
+        exclude_user_ids: List[Text],
+        limit: int,
+        expected_user_ids: List[Text],
+) -> None:
+    assert snapshot.rank(
+        searcher,
+        UserState.offerable_states,
+        exclude_user_ids,
+        scorer_weights,
+        limit,
+        1619945501,
+    ) == expected_user_ids
+
+
+def test_rank_empty_snapshot() -> None:
+    assert CandidateSnapshot([]).rank(
+        UserModel('searcher'),
+        UserState.offerable_states,
+        [],
+        {'recency': 1},
+        5,
+        1619945501,
+    ) == []
+
+
+def test_parse_scorer_weights() -> None:
+    assert candidate_snapshot.parse_scorer_weights('recency:1, same_native:0.5,newbie_veteran') == {
+        'recency': 1.0,
+        'same_native': 0.5,
+        'newbie_veteran': 1.0,
+    }
+    with pytest.raises(ValueError):
+        candidate_snapshot.parse_scorer_weights('recency:1,unknown_scorer:1')
+
+
+@pytest.mark.usefixtures('create_user_state_machine_table')
+@patch('time.time', Mock(return_value=1619945501))
+@patch('actions.user_vault.CANDIDATE_SNAPSHOT_ENABLED', True)
+def test_get_random_available_partner_from_snapshot() -> None:
+    from actions.aws_resources import user_state_machine_table
+
+    for user in [
+        UserStateMachine('searcher', state=UserState.WANTS_CHITCHAT, activity_timestamp=1619945501),
+        UserStateMachine('most_recent', state=UserState.OK_TO_CHITCHAT, activity_timestamp=1619945500),
+        UserStateMachine('less_recent', state=UserState.OK_TO_CHITCHAT, activity_timestamp=1619945400),
+    ]:
+        # noinspection PyDataclass
+        user_state_machine_table.put_item(Item=asdict(user))
+
+    user_vault = UserVault()
+    searcher = user_vault.get_user('searcher')
+    assert user_vault.get_random_available_partner(searcher).user_id == 'most_recent'
+
+    # the snapshot is not rebuilt yet, but the candidate is re-read before being offered
+    most_recent = UserVault().get_user('most_recent')
+    most_recent.become_do_not_disturb()
+    most_recent.save()
+    user_state_machine_table.delete_item(Key={'user_id': 'less_recent'})
+    assert UserVault().get_random_available_partner(searcher) is None
+
+    # what the re-reads found out went into the snapshot
+    snapshot = candidate_snapshot.get_snapshot(Mock())
+    assert snapshot.state[snapshot.rows['most_recent']] == candidate_snapshot.STATE_CODES[UserState.DO_NOT_DISTURB]
+    assert snapshot.rank(searcher, UserState.offerable_states, ['searcher'], {'recency': 1}, 10, 1619945501) == []
+
+
+def test_snapshot_upsert(snapshot: CandidateSnapshot) -> None:
+    searcher = UserModel('searcher')
+    states = [UserState.OK_TO_CHITCHAT, UserState.WANTS_CHITCHAT]
+    snapshot.upsert([
+        UserModel('old', state=UserState.OK_TO_CHITCHAT, activity_timestamp=1619945501, native='uk'),
+        UserModel('recent', state=UserState.DO_NOT_DISTURB, activity_timestamp=1619945501),
+        UserModel('brand_new', state=UserState.WANTS_CHITCHAT, activity_timestamp=1619945400, native='de',
+                  rejected_partner_ids=['searcher2']),
+    ])
+
+    assert snapshot.rank(searcher, states, [], {'recency': 1}, 10, 1619945501) == [
+        'old',
+        'brand_new',
+        'less_recent',
+    ]
+    assert 'brand_new' not in snapshot.rank(
+        UserModel('searcher2'), states, [], {'recency': 1}, 10, 1619945501,
+    )
+    assert len(snapshot) == 9
+
+
+def test_snapshot_upsert_exclusions(snapshot: CandidateSnapshot, tmp_path) -> None:
+    snapshot_file = str(tmp_path / 'candidates.npy')
+    snapshot.save(snapshot_file)
+
+    for snapshot in [snapshot, CandidateSnapshot.load(snapshot_file)]:
+        snapshot.upsert([
+            UserModel('excludes_searcher', state=UserState.OK_TO_CHITCHAT, activity_timestamp=1619945501,
+                      rejected_partner_ids=['searcher2']),  # not excluding searcher anymore
+        ])
+        assert 'excludes_searcher' in snapshot.rank(
+            UserModel('searcher'), UserState.offerable_states, [], {'recency': 1}, 10, 1619945501,
+        )
+        assert 'excludes_searcher' not in snapshot.rank(
+            UserModel('searcher2'), UserState.offerable_states, [], {'recency': 1}, 10, 1619945501,
+        )
+        assert 'has_seen_searcher' not in snapshot.rank(
+            UserModel('searcher'), UserState.offerable_states, [], {'recency': 1}, 10, 1619945501,
+        )
+
+
+def test_snapshot_save_and_load(snapshot: CandidateSnapshot, tmp_path) -> None:
+    snapshot_file = str(tmp_path / 'candidates.npy')
+    snapshot.watermark_ts = 1619945000
+    snapshot.save(snapshot_file)
+
+    loaded = CandidateSnapshot.load(snapshot_file)
+    assert loaded.watermark_ts == 1619945000
+    assert loaded.user_ids == snapshot.user_ids
+    for searcher in [UserModel('searcher', native='uk'), UserModel('excludes_searcher')]:
+        assert loaded.rank(
+            searcher, UserState.offerable_states, [], {'recency': 1, 'same_native': 1}, 10, 1619945501,
+        ) == snapshot.rank(
+            searcher, UserState.offerable_states, [], {'recency': 1, 'same_native': 1}, 10, 1619945501,
+        )
+
+    # upserts are applied in memory only
+    loaded.upsert([UserModel('recent', state=UserState.DO_NOT_DISTURB)])
+    assert 'recent' in CandidateSnapshot.load(snapshot_file).rank(
+        UserModel('searcher'), UserState.offerable_states, [], {'recency': 1}, 10, 1619945501,
+    )
+
+    # the json file belongs to another save
+    CandidateSnapshot([UserModel('someone_else')]).save(str(tmp_path / 'other.npy'))
+    (tmp_path / 'other.npy.json').replace(tmp_path / 'candidates.npy.json')
+    assert CandidateSnapshot.load(snapshot_file) is None
+
+    assert CandidateSnapshot.load(str(tmp_path / 'missing.npy')) is None
+
+
+@patch('actions.candidate_snapshot.current_timestamp_int')
+def test_get_snapshot_from_file(mock_current_timestamp_int: Mock, tmp_path) -> None:
+    snapshot_file = str(tmp_path / 'candidates.npy')
+    mock_current_timestamp_int.return_value = 1619945000
+    list_users = Mock(return_value=[UserModel('user1', state=UserState.OK_TO_CHITCHAT, activity_timestamp=1619944000)])
+
+    candidate_snapshot.get_snapshot(list_users, snapshot_file=snapshot_file)
+    list_users.assert_called_once_with()
+
+    # no change feed - the snapshot catches up on the changes every CANDIDATE_SNAPSHOT_TTL_SEC instead of a rebuild
+    mock_current_timestamp_int.return_value = 1619945005
+    with patch('actions.candidate_snapshot.CANDIDATE_SNAPSHOT_TTL_SEC', 0):
+        candidate_snapshot.get_snapshot(list_users, snapshot_file=snapshot_file)
+    list_users.assert_called_with(changed_since_ts=1619945000)
+    assert list_users.call_count == 2
+
+    # a restart of the action server
+    candidate_snapshot.reset_snapshot()
+    mock_current_timestamp_int.return_value = 1619945501
+    list_users = Mock(return_value=[UserModel('user2', state=UserState.OK_TO_CHITCHAT, activity_timestamp=1619945100)])
+
+    snapshot = candidate_snapshot.get_snapshot(list_users, snapshot_file=snapshot_file)
+    list_users.assert_called_once_with(changed_since_ts=1619945000)  # only the changes after the watermark
+    assert snapshot.watermark_ts == 1619945501
+    assert snapshot.rank(
+        UserModel('searcher'), UserState.offerable_states, [], {'recency': 1}, 10, 1619945501,
+    ) == ['user2', 'user1']
+
+    # the file is too old to be useful
+    candidate_snapshot.reset_snapshot()
+    mock_current_timestamp_int.return_value = 1619945000 + candidate_snapshot.CANDIDATE_SNAPSHOT_FILE_MAX_AGE_SEC + 1
+    list_users = Mock(return_value=[])
+
+    candidate_snapshot.get_snapshot(list_users, snapshot_file=snapshot_file)
+    list_users.assert_called_once_with()
+
+
+@patch('actions.candidate_snapshot.current_timestamp_int', Mock(return_value=1619945501))
+@patch('actions.candidate_snapshot.time.monotonic')
+def test_get_snapshot_fed_by_change_feed(mock_monotonic: Mock) -> None:
+    list_users = Mock(return_value=[UserModel('user1', state=UserState.OK_TO_CHITCHAT)])
+    ttl_sec = candidate_snapshot.CANDIDATE_SNAPSHOT_TTL_SEC
+
+    mock_monotonic.return_value = 1000
+    snapshot = candidate_snapshot.get_snapshot(list_users)
+    list_users.assert_called_once_with()
+
+    # the feed started after the snapshot was built - the snapshot catches up instead of being rebuilt
+    mock_monotonic.return_value += 1
+    candidate_snapshot.mark_fed_by_change_feed(1619945400)
+    list_users.return_value = [UserModel('user2', state=UserState.OK_TO_CHITCHAT)]
+    assert candidate_snapshot.get_snapshot(list_users) is snapshot
+    list_users.assert_called_with(changed_since_ts=1619945501)
+    assert snapshot.user_ids == ['user1', 'user2']
+
+    # the feed keeps the snapshot fresh - no more listings
+    for _ in range(3):
+        mock_monotonic.return_value += ttl_sec
+        candidate_snapshot.mark_fed_by_change_feed(1619945600)
+        assert candidate_snapshot.get_snapshot(list_users) is snapshot
+    assert list_users.call_count == 2
+    assert snapshot.watermark_ts == 1619945600
+
+    # the feed is down - back to catching up every CANDIDATE_SNAPSHOT_TTL_SEC
+    mock_monotonic.return_value += candidate_snapshot.CANDIDATE_SNAPSHOT_FEED_STALE_SEC
+    assert candidate_snapshot.get_snapshot(list_users) is snapshot
+    assert list_users.call_count == 3
+    list_users.assert_called_with(changed_since_ts=1619945600)
+
+
+@patch('actions.candidate_snapshot.current_timestamp_int')
+@patch('actions.candidate_snapshot.time.monotonic')
+def test_get_snapshot_from_file_with_change_feed(
+        mock_monotonic: Mock,
+        mock_current_timestamp_int: Mock,
+        tmp_path,
+) -> None:
+    snapshot_file = str(tmp_path / 'candidates.npy')
+    mock_monotonic.return_value = 1000
+    mock_current_timestamp_int.return_value = 1619945000
+    CandidateSnapshot([UserModel('user1', state=UserState.OK_TO_CHITCHAT)], watermark_ts=1619944000).save(snapshot_file)
+
+    candidate_snapshot.mark_fed_by_change_feed(1619944990)
+    list_users = Mock(return_value=[])
+    snapshot = candidate_snapshot.get_snapshot(list_users, snapshot_file=snapshot_file)
+    list_users.assert_called_once_with(changed_since_ts=1619944000)  # the catch-up on load, nothing else
+
+    # the loaded snapshot stays for as long as the feed is healthy
+    while mock_monotonic.return_value < 1000 + candidate_snapshot.CANDIDATE_SNAPSHOT_SAVE_INTERVAL_SEC:
+        mock_monotonic.return_value += 1
+        mock_current_timestamp_int.return_value += 1
+        candidate_snapshot.mark_fed_by_change_feed(mock_current_timestamp_int.return_value - 5)
+        assert candidate_snapshot.get_snapshot(list_users, snapshot_file=snapshot_file) is snapshot
+    list_users.assert_called_once()
+
+    # it is saved with the watermark of the feed (a restart catches up only from there)
+    assert CandidateSnapshot.load(snapshot_file).watermark_ts == mock_current_timestamp_int.return_value - 5
@@ -0,0 +1,265 @@
+import time
+from typing import Text, Dict, Any
+from unittest.mock import patch, MagicMock, Mock
+
+import pytest
+from botocore.exceptions import ClientError
+
+from actions import candidate_snapshot
+from actions import user_vault
+from actions.change_feed import LocalChangeFeed, DdbStreamChangeFeed, VaultCachesConsumer, UserChange, \
+    ChangeFeedPump, create_change_feed_pump, CHANGE_FEED_MAX_LAG_SEC, IncompleteChangeFeedReadError
+from actions.user_state_machine import UserStateMachine, UserState, UserModel
+from actions.user_vault import UserVault
+
+
+@pytest.fixture
+def local_change_feed() -> LocalChangeFeed:
+    feed = LocalChangeFeed()
+    with patch.object(user_vault, 'save_listeners', [feed.on_user_saved]):
+        yield feed
+
+
+@pytest.mark.usefixtures('create_user_state_machine_table')
+def test_local_change_feed(local_change_feed: LocalChangeFeed) -> None:
+    UserVault().save(UserStateMachine('user1', state=UserState.OK_TO_CHITCHAT))
+    UserVault().save(UserStateMachine('user2', state=UserState.OK_TO_CHITCHAT))
+
+    user1 = UserVault().get_user('user1')
+    user1.request_chitchat()
+    user1.save()
+    user1.save()  # the state didn't change - still a change (activity etc.)
+
+    changes = local_change_feed.read_changes()
+    assert [(c.user_id, c.old_state, c.new_state) for c in changes] == [
+        ('user1', None, 'ok_to_chitchat'),
+        ('user2', None, 'ok_to_chitchat'),
+        ('user1', 'ok_to_chitchat', 'wants_chitchat'),
+        ('user1', 'wants_chitchat', 'wants_chitchat'),
+    ]
+    assert local_change_feed.read_changes() == []
+
+
+def test_local_change_feed_overflow() -> None:
+    feed = LocalChangeFeed(max_changes=2)
+    for user_id in ['user1', 'user2', 'user3']:
+        feed.on_user_saved(UserStateMachine(user_id, state=UserState.OK_TO_CHITCHAT), None)
+
+    with pytest.raises(IncompleteChangeFeedReadError) as exc_info:
+        feed.read_changes()
+    assert exc_info.value.changes_lost
+    assert [c.user_id for c in exc_info.value.changes] == ['user2', 'user3']
+
+    assert feed.read_changes() == []
+
+
+def test_ddb_stream_change_feed() -> None:
+    streams_client = MagicMock()
+    streams_client.describe_stream.side_effect = [
+        {'StreamDescription': {'Shards': [{'ShardId': 'shard1'}], 'LastEvaluatedShardId': 'shard1'}},
+        {'StreamDescription': {'Shards': [{'ShardId': 'shard2'}]}},
+        {'StreamDescription': {'Shards': [{'ShardId': 'shard2'}, {'ShardId': 'shard3'}]}},
+    ]
+    streams_client.get_shard_iterator.side_effect = lambda **kwargs: {
+        'ShardIterator': f"{kwargs['ShardId']}:{kwargs['ShardIteratorType']}",
+    }
+    streams_client.get_records.side_effect = [
+        {
+            'Records': [{'dynamodb': {
+                'SequenceNumber': '100',
+                'Keys': {'user_id': {'S': 'user1'}},
+                'OldImage': {'user_id': {'S': 'user1'}, 'state': {'S': 'new'}},
+                'NewImage': {'user_id': {'S': 'user1'}, 'state': {'S': 'ok_to_chitchat'},
+                             'activity_timestamp': {'N': '1619945501'}},
+            }}],
+            # shard1 is closed and fully read now (no NextShardIterator)
+        },
+        {
+            'Records': [{'dynamodb': {
+                'SequenceNumber': '200',
+                'Keys': {'user_id': {'S': 'user2'}},
+                'OldImage': {'user_id': {'S': 'user2'}, 'state': {'S': 'wants_chitchat'}},
+            }}],
+            'NextShardIterator': 'shard2:next',
+        },
+        {'Records': [], 'NextShardIterator': 'shard2:next2'},
+        {'Records': [], 'NextShardIterator': 'shard3:next'},
+    ]
+
+    feed = DdbStreamChangeFeed(stream_arn='arn:stream', streams_client=streams_client, shard_refresh_sec=0)
+
+    changes = feed.read_changes()
+    assert [(c.user_id, c.old_state, c.new_state) for c in changes] == [
+        ('user1', 'new', 'ok_to_chitchat'),
+        ('user2', 'wants_chitchat', None),
+    ]
+    assert changes[0].new_user() == UserModel('user1', state='ok_to_chitchat', activity_timestamp=1619945501)
+    assert changes[1].new_user() is None
+
+    assert feed.read_changes() == []
+
+    assert [(c.kwargs['ShardId'], c.kwargs['ShardIteratorType']) for c in
+            streams_client.get_shard_iterator.call_args_list] == [
+        ('shard1', 'LATEST'),
+        ('shard2', 'LATEST'),
+        ('shard3', 'TRIM_HORIZON'),  # a shard that appeared later is read from the beginning
+    ]
+    assert [c.kwargs['ShardIterator'] for c in streams_client.get_records.call_args_list] == [
+        'shard1:LATEST',
+        'shard2:LATEST',
+        'shard2:next',
+        'shard3:TRIM_HORIZON',
+    ]
+    assert 'shard1' not in feed._shard_iterators  # finished and gone from the stream
+
+
+def _stream_record(sequence_number: Text, user_id: Text, state: Text) -> Dict[Text, Any]:
+    return {'dynamodb': {
+        'SequenceNumber': sequence_number,
+        'Keys': {'user_id': {'S': user_id}},
+        'NewImage': {'user_id': {'S': user_id}, 'state': {'S': state}},
+    }}
+
+
+def test_ddb_stream_change_feed_shard_errors() -> None:
+    def client_error(code: Text) -> ClientError:
+        return ClientError({'Error': {'Code': code}}, 'GetRecords')
+
+    streams_client = MagicMock()
+    streams_client.describe_stream.return_value = {
+        'StreamDescription': {'Shards': [{'ShardId': 'shard1'}, {'ShardId': 'shard2'}]},
+    }
+    streams_client.get_shard_iterator.side_effect = lambda **kwargs: {
+        'ShardIterator': f"{kwargs['ShardId']}:{kwargs['ShardIteratorType']}:{kwargs.get('SequenceNumber')}",
+    }
+    get_records_responses = {
+        'shard1:LATEST:None': [
+            {'Records': [_stream_record('101', 'user1', 'ok_to_chitchat')], 'NextShardIterator': 'shard1:next'},
+        ],
+        'shard1:next': [client_error('ExpiredIteratorException')],
+        'shard1:AFTER_SEQUENCE_NUMBER:101': [
+            {'Records': [_stream_record('102', 'user1', 'wants_chitchat')], 'NextShardIterator': 'shard1:next2'},
+        ],
+        'shard1:next2': [client_error('InternalServerError'), client_error('InternalServerError')],
+        'shard2:LATEST:None': [{'Records': [], 'NextShardIterator': 'shard2:next'}],
+        'shard2:next': [
+            client_error('TrimmedDataAccessException'),
+            client_error('InternalServerError'),
+            {'Records': [_stream_record('202', 'user2', 'do_not_disturb')], 'NextShardIterator': 'shard2:next'},
+        ],
+        'shard2:TRIM_HORIZON:None': [
+            {'Records': [_stream_record('201', 'user2', 'roomed')], 'NextShardIterator': 'shard2:next'},
+        ],
+    }
+
+    def get_records(ShardIterator: Text) -> Dict[Text, Any]:
+        response = get_records_responses[ShardIterator].pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    streams_client.get_records.side_effect = get_records
+    feed = DdbStreamChangeFeed(stream_arn='arn:stream', streams_client=streams_client)
+
+    assert [(c.user_id, c.new_state) for c in feed.read_changes()] == [('user1', 'ok_to_chitchat')]
+    # the expired iterator is re-acquired after the last record read, the trimmed one - from the oldest record (the
+    # records in between are lost)
+    with pytest.raises(IncompleteChangeFeedReadError) as exc_info:
+        feed.read_changes()
+    assert exc_info.value.changes_lost
+    assert [(c.user_id, c.new_state) for c in exc_info.value.changes] == [
+        ('user1', 'wants_chitchat'),
+        ('user2', 'roomed'),
+    ]
+    with pytest.raises(ClientError):
+        feed.read_changes()  # every shard failed
+    assert feed._shard_iterators == {'shard1': 'shard1:next2', 'shard2': 'shard2:next'}  # tried again next time
+
+    # one shard failed - its records are not lost, they are read next time
+    with pytest.raises(IncompleteChangeFeedReadError) as exc_info:
+        feed.read_changes()
+    assert not exc_info.value.changes_lost
+    assert [(c.user_id, c.new_state) for c in exc_info.value.changes] == [('user2', 'do_not_disturb')]
+
+
+def test_vault_caches_consumer() -> None:
+    candidate_snapshot.reset_snapshot()
+    snapshot = candidate_snapshot.get_snapshot(lambda: [UserModel('user1', state=UserState.DO_NOT_DISTURB)])
+    pool_version = user_vault.get_offerable_pool_version()
+
+    VaultCachesConsumer().apply([
+        UserChange('user1', {'user_id': 'user1', 'state': 'new'}, {'user_id': 'user1', 'state': 'do_not_disturb'}),
+    ])
+    assert user_vault.get_offerable_pool_version() == pool_version  # not offerable
+
+    VaultCachesConsumer().apply([
+        UserChange('user1', {'user_id': 'user1', 'state': 'do_not_disturb'},
+                   {'user_id': 'user1', 'state': 'ok_to_chitchat', 'activity_timestamp': 1619945501}),
+        UserChange('user2', None, {'user_id': 'user2', 'state': 'wants_chitchat'}),
+    ])
+    assert user_vault.get_offerable_pool_version() == pool_version + 1
+    assert snapshot.rank(
+        UserModel('searcher'), UserState.offerable_states, [], {'recency': 1}, 10, 1619945502,
+    ) == ['user1', 'user2']
+
+    VaultCachesConsumer().caught_up(1619945501)
+    assert candidate_snapshot._is_fed(time.monotonic())
+    with patch('time.time', Mock(return_value=1619945000)):  # the catch-up of the snapshot was earlier than the read
+        snapshot = candidate_snapshot.get_snapshot(Mock(return_value=[]))
+    assert snapshot.watermark_ts == 1619945501 - CHANGE_FEED_MAX_LAG_SEC
+
+    VaultCachesConsumer().changes_lost()
+    assert not candidate_snapshot._is_fed(time.monotonic())  # catches up on the lost changes from the db
+
+    candidate_snapshot.reset_snapshot()
+
+
+def test_change_feed_pump_consumer_failure() -> None:
+    failing_consumer = MagicMock()
+    failing_consumer.apply.side_effect = RuntimeError('oops')
+    consumer = MagicMock()
+    pump = ChangeFeedPump(LocalChangeFeed(), [failing_consumer, consumer])
+
+    changes = [UserChange('user1', {'user_id': 'user1', 'state': 'new'}, {'user_id': 'user1', 'state': 'roomed'})]
+    pump.apply(changes)
+    consumer.apply.assert_called_once_with(changes)
+
+    failing_consumer.caught_up.side_effect = RuntimeError('oops')
+    pump.caught_up(1619945501)  # doesn't raise
+    consumer.caught_up.assert_called_once_with(1619945501)
+
+
+@pytest.mark.asyncio
+@patch('time.time', Mock(return_value=1619945501))
+async def test_change_feed_pump_incomplete_read() -> None:
+    feed = MagicMock()
+    consumer = MagicMock()
+    pump = ChangeFeedPump(feed, [consumer])
+    changes = [UserChange('user1', None, {'user_id': 'user1', 'state': 'ok_to_chitchat'})]
+
+    feed.read_changes.side_effect = IncompleteChangeFeedReadError(changes, changes_lost=False)
+    await pump.pump_once()
+    consumer.apply.assert_called_once_with(changes)
+    consumer.caught_up.assert_not_called()  # the watermark doesn't move past the failed shards
+    consumer.changes_lost.assert_not_called()
+
+    feed.read_changes.side_effect = IncompleteChangeFeedReadError([], changes_lost=True)
+    await pump.pump_once()
+    consumer.caught_up.assert_not_called()
+    consumer.changes_lost.assert_called_once_with()
+
+    feed.read_changes.side_effect = None
+    feed.read_changes.return_value = []
+    await pump.pump_once()
+    consumer.caught_up.assert_called_once_with(1619945501)
+
+
+def test_create_change_feed_pump() -> None:
+    assert create_change_feed_pump('none') is None
+
+    with patch.object(user_vault, 'save_listeners', []):
+        pump = create_change_feed_pump('local')
+        assert user_vault.save_listeners == [pump.feed.on_user_saved]
+
+    with pytest.raises(ValueError):
+        create_change_feed_pump('kafka')
@@ -0,0 +1,147 @@
+from dataclasses import asdict
+from typing import List, Text, Optional
+from unittest.mock import patch, Mock, AsyncMock, MagicMock
+
+import pytest
+
+from actions import candidate_snapshot
+from actions import matchmaker
+from actions.user_state_machine import UserStateMachine, UserState
+
+
+def _user(
+        user_id: Text,
+        state: Text = UserState.WANTS_CHITCHAT,
+        activity_timestamp: int = 1619945000,
+        state_timestamp: int = 1619945000,
+        roomed_partner_ids: Optional[List[Text]] = None,
+        rejected_partner_ids: Optional[List[Text]] = None,
+        seen_partner_ids: Optional[List[Text]] = None,
+) -> UserStateMachine:
+    return UserStateMachine(
+        user_id=user_id,
+        state=state,
+        activity_timestamp=activity_timestamp,
+        state_timestamp=state_timestamp,
+        roomed_partner_ids=roomed_partner_ids or [],
+        rejected_partner_ids=rejected_partner_ids or [],
+        seen_partner_ids=seen_partner_ids or [],
+    )
+
+
+@pytest.mark.parametrize('searcher, partner, expected', [
+    (_user('searcher'), _user('partner'), True),
+    (_user('searcher'), _user('searcher'), False),
+    (_user('searcher', roomed_partner_ids=['partner']), _user('partner'), False),
+    (_user('searcher', rejected_partner_ids=['partner']), _user('partner'), False),
+    (_user('searcher', seen_partner_ids=['partner']), _user('partner'), True),  # seen partners are discoverable
+    (_user('searcher'), _user('partner', roomed_partner_ids=['searcher']), False),
+    (_user('searcher'), _user('partner', rejected_partner_ids=['searcher']), False),
+    (_user('searcher'), _user('partner', seen_partner_ids=['searcher']), False),
+])
+def test_are_compatible(searcher: UserStateMachine, partner: UserStateMachine, expected: bool) -> None:
+    assert matchmaker.are_compatible(searcher, partner) == expected
+
+
+def test_compute_pairing() -> None:
+    # picky searcher has only one option while the flexible one (who has been searching longer) has two
+    picky = _user('picky', state_timestamp=1619945400, rejected_partner_ids=['most_recent'])
+    flexible = _user('flexible', state_timestamp=1619945100)
+    most_recent = _user('most_recent', state=UserState.OK_TO_CHITCHAT, activity_timestamp=1619945500)
+    less_recent = _user('less_recent', state=UserState.OK_TO_CHITCHAT, activity_timestamp=1619945300)
+    lonely = _user('lonely', rejected_partner_ids=['picky', 'flexible', 'most_recent', 'less_recent'])
+
+    pairs = matchmaker.compute_pairing(
+        [flexible, picky, lonely],
+        [[flexible, picky, lonely, less_recent, most_recent]],
+    )
+    assert [(searcher.user_id, partner.user_id) for searcher, partner in pairs] == [
+        ('picky', 'less_recent'),  # the most constrained searcher chooses first
+        ('flexible', 'most_recent'),
+        # nobody is left for the lonely searcher
+    ]
+
+
+def test_compute_pairing_prefers_higher_tiers() -> None:
+    pairs = matchmaker.compute_pairing(
+        [_user('searcher', activity_timestamp=1619945500)],
+        [[_user('tier1', state=UserState.OK_TO_CHITCHAT)], [_user('tier2', activity_timestamp=1619945500)]],
+    )
+    assert [(searcher.user_id, partner.user_id) for searcher, partner in pairs] == [('searcher', 'tier1')]
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures('create_user_state_machine_table')
+@patch('time.time', Mock(return_value=1619945501))
+@patch('actions.telegram_helpers.get_user_profile_photo_file_id', Mock(return_value='photo_file_id'))
+@patch('actions.rasa_callbacks.ask_to_join', new_callable=AsyncMock)
+async def test_match_once(mock_ask_to_join: MagicMock) -> None:
+    from actions.aws_resources import user_state_machine_table
+
+    for user in [
+        _user('searcher1', state_timestamp=1619945100),
+        _user('searcher2', state_timestamp=1619945200, roomed_partner_ids=['ok_user']),
+        _user('ok_user', state=UserState.OK_TO_CHITCHAT, activity_timestamp=1619945400),
+        _user('do_not_disturb', state=UserState.DO_NOT_DISTURB, activity_timestamp=1619945500),
+    ]:
+        # noinspection PyDataclass
+        user_state_machine_table.put_item(Item=asdict(user))
+
+    candidate_snapshot.reset_snapshot()
+    pairs = await matchmaker.match_once()
+    assert [(searcher.user_id, partner.user_id) for searcher, partner in pairs] == [('searcher2', 'searcher1')]
+
+    mock_ask_to_join.assert_awaited_once()
+    args, kwargs = mock_ask_to_join.call_args
+    assert args[0] == 'searcher2'
+    assert args[1].user_id == 'searcher1'
+    assert args[2:] == ('photo_file_id', None)
+    assert kwargs == {'suppress_callback_errors': True}
+
+
+@pytest.mark.usefixtures('create_user_state_machine_table')
+@patch('time.time', Mock(return_value=1619945501))
+def test_shortlist() -> None:
+    from actions.aws_resources import user_state_machine_table
+    from actions.user_vault import UserVault
+
+    for user in [
+        _user('searcher1', activity_timestamp=1619945100),
+        _user('searcher2', activity_timestamp=1619945200),
+        _user('searcher3', activity_timestamp=1619945300),  # searches the shortest - waits for the next pass
+        _user('ok_user1', state=UserState.OK_TO_CHITCHAT, activity_timestamp=1619945400),
+        _user('ok_user2', state=UserState.OK_TO_CHITCHAT, activity_timestamp=1619945350),
+        _user('ok_user3', state=UserState.OK_TO_CHITCHAT, activity_timestamp=1619945000, roomed_partner_ids=[
+            'searcher1', 'searcher2',
+        ]),
+    ]:
+        # noinspection PyDataclass
+        user_state_machine_table.put_item(Item=asdict(user))
+
+    candidate_snapshot.reset_snapshot()
+    user_vault = UserVault()
+    snapshot = user_vault.get_candidate_snapshot()
+    # the snapshot is outdated - ok_user2 is not available anymore
+    user_state_machine_table.update_item(
+        Key={'user_id': 'ok_user2'},
+        UpdateExpression='SET #state = :state',
+        ExpressionAttributeNames={'#state': 'state'},
+        ExpressionAttributeValues={':state': UserState.DO_NOT_DISTURB},
+    )
+
+    with patch.object(user_vault, 'get_existing_user', wraps=user_vault.get_existing_user) as mock_get_existing_user:
+        searchers, candidate_tiers = matchmaker.shortlist(
+            user_vault, 1619945501, max_searchers=2, candidates_per_searcher=2,
+        )
+    assert [searcher.user_id for searcher in searchers] == ['searcher1', 'searcher2']
+    # the searchers and the best two of every searcher (ok_user3 excludes both of them) except the one that is not
+    # available anymore
+    assert [sorted(user.user_id for user in tier) for tier in candidate_tiers] == [
+        ['ok_user1', 'searcher1', 'searcher2'],
+    ]
+    assert sorted(call.args[0] for call in mock_get_existing_user.call_args_list) == [
+        'ok_user1', 'ok_user2', 'searcher1', 'searcher2',
+    ]
+    assert snapshot.state[snapshot.rows['ok_user2']] == candidate_snapshot.STATE_CODES[UserState.DO_NOT_DISTURB]
+
+    candidate_snapshot.reset_snapshot()
@@ -0,0 +1,77 @@
+import asyncio
+from typing import List, Text
+from unittest.mock import AsyncMock, patch
+
+import pytest
+
+from actions import outbox
+from actions.utils import SwiperError
+
+
+@pytest.mark.asyncio
+async def test_side_effects_are_executed_only_after_flush() -> None:
+    side_effect = AsyncMock()
+
+    side_effect_outbox = outbox.SideEffectOutbox('some_action')
+    with side_effect_outbox:
+        outbox.defer(side_effect, 'arg1', kwarg1='kwarg_value1')
+        outbox.defer(side_effect, 'arg2')
+
+    await asyncio.sleep(0)
+    side_effect.assert_not_called()
+
+    assert side_effect_outbox.flush() is not None
+    assert side_effect_outbox.flush() is None  # nothing left to flush
+
+    await outbox.wait_for_pending_side_effects()
+    assert side_effect.await_count == 2
+    side_effect.assert_any_await('arg1', kwarg1='kwarg_value1')
+    side_effect.assert_any_await('arg2')
+
+
+@pytest.mark.asyncio
+async def test_failing_side_effect_does_not_affect_others() -> None:
+    executed: List[Text] = []
+
+    async def failing_side_effect() -> None:
+        raise ValueError('something got out of hand')
+
+    async def successful_side_effect(name: Text) -> None:
+        executed.append(name)
+
+    side_effect_outbox = outbox.SideEffectOutbox('some_action')
+    side_effect_outbox.defer(failing_side_effect)
+    side_effect_outbox.defer(successful_side_effect, 'side_effect2')
+    side_effect_outbox.flush()
+
+    await outbox.wait_for_pending_side_effects()
+    assert executed == ['side_effect2']
+
+
+@pytest.mark.asyncio
+@patch.object(outbox, 'OUTBOX_MAX_CONCURRENCY', 2)
+@patch.object(outbox, '_semaphore', None)
+async def test_side_effect_concurrency_is_bounded() -> None:
+    running = 0
+    max_running = 0
+
+    async def side_effect() -> None:
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    for _ in range(3):
+        side_effect_outbox = outbox.SideEffectOutbox('some_action')
+        side_effect_outbox.defer(side_effect)
+        side_effect_outbox.defer(side_effect)
+        side_effect_outbox.flush()
+
+    await outbox.wait_for_pending_side_effects()
+    assert max_running == 2
+
+
+def test_defer_outside_of_outbox_context() -> None:
+    with pytest.raises(SwiperError):
+        outbox.defer(AsyncMock())
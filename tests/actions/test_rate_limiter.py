@@ -0,0 +1,110 @@
+from unittest.mock import patch, MagicMock, AsyncMock
+
+import pytest
+
+from actions import rate_limiter
+from actions.rate_limiter import TokenBucket, RateGovernor
+from actions.utils import SwiperRateLimitError
+
+
+@patch('time.monotonic')
+def test_token_bucket_reserve(mock_monotonic: MagicMock) -> None:
+    mock_monotonic.return_value = 1000.0
+    bucket = TokenBucket(2, burst=2)
+
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(0.5)  # borrowed from the future
+    assert bucket.reserve() == pytest.approx(1.0)
+
+    mock_monotonic.return_value = 1001.0  # two tokens were refilled, but both were borrowed already
+    assert bucket.reserve() == pytest.approx(0.5)
+
+    mock_monotonic.return_value = 1100.0  # the bucket never holds more than its burst
+    assert bucket.is_idle()
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(0.5)
+
+
+@patch('time.monotonic')
+def test_token_bucket_max_delay(mock_monotonic: MagicMock) -> None:
+    mock_monotonic.return_value = 1000.0
+    bucket = TokenBucket(1)
+
+    assert bucket.reserve(max_delay_sec=1.5) == 0
+    assert bucket.reserve(max_delay_sec=1.5) == pytest.approx(1.0)
+    assert bucket.reserve(max_delay_sec=1.5) is None  # 2 seconds would be too long
+    assert bucket.reserve(max_delay_sec=1.5) is None  # the refusal above did not consume a token
+
+    bucket.refund()
+    assert bucket.reserve(max_delay_sec=1.5) == pytest.approx(1.0)
+
+
+def test_token_bucket_invalid_args() -> None:
+    with pytest.raises(ValueError):
+        TokenBucket(0)
+    with pytest.raises(ValueError):
+        TokenBucket(1, burst=0)
+
+
+@pytest.mark.asyncio
+@patch('time.monotonic', MagicMock(return_value=1000.0))
+@patch('asyncio.sleep', new_callable=AsyncMock)
+async def test_telegram_per_chat_budget(mock_sleep: AsyncMock) -> None:
+    governor = RateGovernor()
+
+    for _ in range(rate_limiter.TELEGRAM_PER_CHAT_MSG_BURST):
+        await governor.telegram_message('chat1')
+    mock_sleep.assert_not_called()
+
+    await governor.telegram_message('another_chat')  # other chats are not affected
+    mock_sleep.assert_not_called()
+
+    await governor.telegram_message('chat1')
+    mock_sleep.assert_called_once_with(pytest.approx(1.0))
+
+
+@pytest.mark.asyncio
+@patch('time.monotonic', MagicMock(return_value=1000.0))
+@patch('asyncio.sleep', new_callable=AsyncMock)
+async def test_telegram_queue_too_long(mock_sleep: AsyncMock) -> None:
+    governor = RateGovernor()
+
+    let_through = rate_limiter.TELEGRAM_PER_CHAT_MSG_BURST + int(rate_limiter.RATE_LIMIT_MAX_QUEUE_SEC)
+    for _ in range(let_through):
+        await governor.telegram_message('chat1')
+    assert mock_sleep.call_count == let_through - rate_limiter.TELEGRAM_PER_CHAT_MSG_BURST
+
+    with pytest.raises(SwiperRateLimitError):
+        await governor.telegram_message('chat1')
+
+    # the refused message should not have consumed any of the global budget
+    for chat_num in range(int(rate_limiter.TELEGRAM_GLOBAL_MSG_PER_SEC) - let_through):
+        await governor.telegram_message(f"other_chat{chat_num}")
+    assert mock_sleep.call_count == let_through - rate_limiter.TELEGRAM_PER_CHAT_MSG_BURST
+
+    await governor.telegram_message('yet_another_chat')  # but now the global budget is exhausted
+    assert mock_sleep.call_count == let_through - rate_limiter.TELEGRAM_PER_CHAT_MSG_BURST + 1
+
+
+@pytest.mark.asyncio
+@patch('time.monotonic', MagicMock(return_value=1000.0))
+@patch('asyncio.sleep', new_callable=AsyncMock)
+async def test_daily_co_room_creation_budget(mock_sleep: AsyncMock) -> None:
+    governor = RateGovernor()
+
+    for _ in range(rate_limiter.DAILY_CO_ROOMS_BURST):
+        await governor.daily_co_room_creation()
+    mock_sleep.assert_not_called()
+
+    await governor.daily_co_room_creation()
+    mock_sleep.assert_called_once_with(pytest.approx(1 / rate_limiter.DAILY_CO_ROOMS_PER_SEC))
+
+
+def test_global_budgets_split_between_workers() -> None:
+    governor = RateGovernor(worker_count=5)
+
+    assert governor.telegram_global_bucket.rate_per_sec == pytest.approx(rate_limiter.TELEGRAM_GLOBAL_MSG_PER_SEC / 5)
+    assert governor.daily_co_rooms_bucket.rate_per_sec == pytest.approx(rate_limiter.DAILY_CO_ROOMS_PER_SEC / 5)
+    assert governor.daily_co_rooms_bucket.burst == 1
@@ -0,0 +1,102 @@
+import json
+import sys
+from collections import Counter
+from unittest.mock import patch
+
+import pytest
+from aiohttp import web, ClientSession
+from aiohttp.test_utils import TestServer
+
+from actions.sharded_server import ConsistentHashRing, extract_sender_id, create_router_app, WorkerPool
+
+
+def test_consistent_hash_ring() -> None:
+    user_ids = [f"user{idx}" for idx in range(10000)]
+    ring = ConsistentHashRing(['worker0', 'worker1', 'worker2', 'worker3'])
+
+    owners = {user_id: ring.get_node(user_id) for user_id in user_ids}
+    assert owners == {user_id: ring.get_node(user_id) for user_id in user_ids}  # stable
+    assert all(1500 < count < 3500 for count in Counter(owners.values()).values())  # roughly even
+
+    bigger_ring = ConsistentHashRing(['worker0', 'worker1', 'worker2', 'worker3', 'worker4'])
+    moved_user_ids = [user_id for user_id in user_ids if bigger_ring.get_node(user_id) != owners[user_id]]
+    assert all(bigger_ring.get_node(user_id) == 'worker4' for user_id in moved_user_ids)  # only to the new worker
+    assert 1000 < len(moved_user_ids) < 3000
+
+
+@pytest.mark.parametrize('body, expected_sender_id', [
+    (b'{"next_action": "action_find_partner", "sender_id": "12345", "tracker": {"sender_id": "12345"}}', '12345'),
+    (b'{"tracker": {"sender_id" : "12345", "slots": {}}, "sender_id": "12345"}', '12345'),
+    (b'{"sender_id": "with \\"quotes\\""}', 'with \\"quotes\\"'),
+    (b'{"next_action": "action_find_partner"}', ''),
+])
+def test_extract_sender_id(body: bytes, expected_sender_id: str) -> None:
+    assert extract_sender_id(body) == expected_sender_id
+
+
+@pytest.mark.asyncio
+async def test_router_app() -> None:
+    def create_worker_app(worker_name: str) -> web.Application:
+        async def handle_webhook(request: web.Request) -> web.Response:
+            return web.json_response({'worker': worker_name, 'sender_id': (await request.json())['sender_id']})
+
+        async def handle_health(_request: web.Request) -> web.Response:
+            return web.json_response({'status': 'ok', 'worker': worker_name})
+
+        worker_app = web.Application()
+        worker_app.router.add_post('/webhook', handle_webhook)
+        worker_app.router.add_get('/health', handle_health)
+        return worker_app
+
+    workers = [TestServer(create_worker_app(f"worker{idx}")) for idx in range(3)]
+    for worker in workers:
+        await worker.start_server()
+    worker_urls = [str(worker.make_url('')).rstrip('/') for worker in workers]
+    ring = ConsistentHashRing(worker_urls)
+
+    router = TestServer(create_router_app(worker_urls))
+    await router.start_server()
+    try:
+        async with ClientSession() as session:
+            for user_idx in range(20):
+                sender_id = f"user{user_idx}"
+                async with session.post(
+                        router.make_url('/webhook'),
+                        data=json.dumps({'next_action': 'action_find_partner', 'sender_id': sender_id}),
+                        headers={'Content-Type': 'application/json'},
+                ) as response:
+                    assert response.status == 200
+                    assert await response.json() == {
+                        'worker': f"worker{worker_urls.index(ring.get_node(sender_id))}",
+                        'sender_id': sender_id,
+                    }
+
+            async with session.get(router.make_url('/health')) as response:
+                assert await response.json() == {'status': 'ok', 'worker': 'worker0'}
+
+            await workers[1].close()
+            unavailable_sender_id = next(
+                f"user{idx}" for idx in range(1000) if ring.get_node(f"user{idx}") == worker_urls[1]
+            )
+            async with session.post(
+                    router.make_url('/webhook'),
+                    data=json.dumps({'sender_id': unavailable_sender_id}),
+            ) as response:
+                assert response.status == 502
+    finally:
+        await router.close()
+        for worker in workers:
+            await worker.close()
+
+
+@patch('subprocess.Popen')
+def test_worker_pool_start(mock_popen) -> None:
+    WorkerPool(workers=3, base_port=5100, actions_module='actions').start()
+
+    assert [call.args[0] for call in mock_popen.call_args_list] == [
+        [sys.executable, '-m', 'rasa_sdk', '--actions', 'actions', '--port', str(port)] for port in [5100, 5101, 5102]
+    ]
+    assert [
+        (call.kwargs['env']['ACTION_SERVER_WORKER_INDEX'], call.kwargs['env']['ACTION_SERVER_WORKER_COUNT'])
+        for call in mock_popen.call_args_list
+    ] == [('0', '3'), ('1', '3'), ('2', '3')]
@@ -0,0 +1,32 @@
+from unittest.mock import patch, Mock
+
+from actions.tick_scheduler import AdaptiveTickScheduler
+
+
+@patch('time.monotonic', Mock(return_value=1000))
+def test_backoff_while_pool_is_empty() -> None:
+    scheduler = AdaptiveTickScheduler(base_delay_sec=3, max_delay_sec=20, backoff_factor=2)
+
+    assert scheduler.next_delay('user1', partner_found=False, pool_version=1) == 3  # first tick of the search
+    assert scheduler.next_delay('user1', partner_found=False, pool_version=1) == 6
+    assert scheduler.next_delay('user1', partner_found=False, pool_version=1) == 12
+    assert scheduler.next_delay('user1', partner_found=False, pool_version=1) == 20  # capped
+    assert scheduler.next_delay('user2', partner_found=False, pool_version=1) == 3  # every searcher has their own
+
+    assert scheduler.next_delay('user1', partner_found=False, pool_version=2) == 3  # somebody became offerable
+    assert scheduler.next_delay('user1', partner_found=False, pool_version=2) == 6
+    assert scheduler.next_delay('user1', partner_found=True, pool_version=2) == 3  # partner was found
+
+
+def test_ticks_per_sec_budget() -> None:
+    scheduler = AdaptiveTickScheduler(base_delay_sec=3, max_delay_sec=20, ticks_per_sec_budget=1)
+
+    with patch('time.monotonic', Mock(return_value=1000)):
+        for user_idx in range(3):
+            assert scheduler.next_delay(f"user{user_idx}", partner_found=True, pool_version=1) == 3
+        assert scheduler.next_delay('user3', partner_found=True, pool_version=1) == 4  # 4 searchers, 1 tick/sec
+        assert scheduler.next_delay('user4', partner_found=True, pool_version=1) == 5
+
+    with patch('time.monotonic', Mock(return_value=1100)):
+        # the searchers that stopped ticking long ago don't take the budget anymore
+        assert scheduler.next_delay('user5', partner_found=True, pool_version=1) == 3
@@ -0,0 +1,67 @@
+import asyncio
+from typing import List, Text, Tuple
+
+import pytest
+
+from actions.timer_wheel import HashedTimerWheel
+
+
+@pytest.mark.asyncio
+async def test_timers_fire_in_order() -> None:
+    fired: List[Text] = []
+
+    async def callback(name: Text) -> None:
+        fired.append(name)
+
+    wheel = HashedTimerWheel(tick_sec=0.01, wheel_size=8)
+    wheel.schedule('late', 0.05, callback, 'late')
+    wheel.schedule('early', 0.02, callback, 'early')
+    wheel.schedule('multi_round', 0.12, callback, 'multi_round')  # more ticks than there are slots in the wheel
+    assert len(wheel) == 3
+    assert 'early' in wheel
+
+    await asyncio.sleep(0.08)
+    assert fired == ['early', 'late']
+    assert len(wheel) == 1
+
+    await asyncio.sleep(0.08)
+    assert fired == ['early', 'late', 'multi_round']
+    assert len(wheel) == 0
+
+
+@pytest.mark.asyncio
+async def test_timer_cancel_and_replace() -> None:
+    fired: List[Tuple[Text, Text]] = []
+
+    async def callback(key: Text, value: Text) -> None:
+        fired.append((key, value))
+
+    wheel = HashedTimerWheel(tick_sec=0.01, wheel_size=8)
+    wheel.schedule('cancelled', 0.02, callback, 'cancelled', 'value1')
+    wheel.schedule('replaced', 0.02, callback, 'replaced', 'value1')
+    wheel.schedule('replaced', 0.04, callback, 'replaced', 'value2')
+
+    assert wheel.cancel('cancelled') is True
+    assert wheel.cancel('cancelled') is False
+    assert 'cancelled' not in wheel
+
+    await asyncio.sleep(0.1)
+    assert fired == [('replaced', 'value2')]
+
+
+@pytest.mark.asyncio
+async def test_failing_timer_does_not_stop_the_wheel() -> None:
+    fired: List[Text] = []
+
+    async def failing_callback() -> None:
+        raise ValueError('something got out of hand')
+
+    async def callback() -> None:
+        fired.append('fired')
+
+    wheel = HashedTimerWheel(tick_sec=0.01, wheel_size=8)
+    wheel.schedule('failing', 0.01, failing_callback)
+    wheel.schedule('successful', 0.03, callback)
+
+    await asyncio.sleep(0.08)
+    assert fired == ['fired']
@@ -107,6 +107,20 @@ expected_more_narrow_transitions = [
     ('reject_invitation', 'do_not_disturb', None, 'previous_partner_id', 'previous_partner_id'),
     ('reject_invitation', 'bot_blocked', None, 'previous_partner_id', 'previous_partner_id'),
     ('reject_invitation', 'user_banned', None, 'previous_partner_id', 'previous_partner_id'),
+
+    ('time_out', 'new', None, 'previous_partner_id', 'previous_partner_id'),
+    ('time_out', 'wants_chitchat', None, 'previous_partner_id', 'previous_partner_id'),
+    ('time_out', 'ok_to_chitchat', None, 'previous_partner_id', 'previous_partner_id'),
+    ('time_out', 'take_a_break', 'ok_to_chitchat', 'previous_partner_id', 'previous_partner_id'),
+    ('time_out', 'waiting_partner_confirm', 'ok_to_chitchat', 'previous_partner_id', 'previous_partner_id'),
+    ('time_out', 'asked_to_join', 'ok_to_chitchat', 'previous_partner_id', 'previous_partner_id'),
+    ('time_out', 'asked_to_confirm', 'ok_to_chitchat', 'previous_partner_id', 'previous_partner_id'),
+    ('time_out', 'roomed', 'ok_to_chitchat', 'previous_partner_id', 'previous_partner_id'),
+    ('time_out', 'rejected_join', 'ok_to_chitchat', 'previous_partner_id', 'previous_partner_id'),
+    ('time_out', 'rejected_confirm', 'ok_to_chitchat', 'previous_partner_id', 'previous_partner_id'),
+    ('time_out', 'do_not_disturb', None, 'previous_partner_id', 'previous_partner_id'),
+    ('time_out', 'bot_blocked', None, 'previous_partner_id', 'previous_partner_id'),
+    ('time_out', 'user_banned', None, 'previous_partner_id', 'previous_partner_id'),
 ]
 
 
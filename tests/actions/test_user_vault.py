@@ -6,6 +6,7 @@ from unittest.mock import patch, MagicMock, call, Mock
 import pytest
 
 from actions.user_state_machine import UserStateMachine, UserState
+from actions import user_vault
 from actions.user_vault import UserVault, NaiveDdbUserVault
 
 
@@ -554,3 +555,448 @@ def test_ddb_get_nonexistent_user() -> None:
     user_vault = UserVault()
     assert user_vault._get_user('there_is_no_such_user') is None
     assert len(user_state_machine_table.scan()['Items']) == 3
+
+
+@pytest.mark.usefixtures('ddb_user1', 'ddb_user2', 'ddb_user3', 'ddb_user4')
+@patch('time.time', Mock(return_value=1619945501))
+def test_ddb_bulk_transition() -> None:
+    user_vault = UserVault()
+    outcomes = user_vault.bulk_transition(
+        'become_ok_to_chitchat',
+        lambda u: u.state != UserState.WAITING_PARTNER_CONFIRM,
+    )
+    assert outcomes == {'transitioned': 3, 'not_matched': 1}
+
+    user_vault = UserVault()  # create new instance to avoid hitting cache
+    for user_id in ['existing_user_id2', 'existing_user_id3', 'existing_user_id4']:
+        user = user_vault.get_user(user_id)
+        assert user.state == UserState.OK_TO_CHITCHAT
+        assert user.partner_id is None
+        assert user.state_timestamp == 1619945501
+        assert user.state_timestamp_str == '2021-05-02 08:51:41 Z'
+        assert user.state_timeout_ts == 0
+        assert user.state_timeout_ts_str is None
+
+    assert user_vault.get_user('existing_user_id1').state == UserState.WAITING_PARTNER_CONFIRM
+
+
+@pytest.mark.usefixtures('ddb_user1', 'ddb_user2', 'ddb_user3')
+@patch('time.time', Mock(return_value=1619945501))
+def test_ddb_bulk_transition_not_allowed() -> None:
+    user_vault = UserVault()
+    outcomes = user_vault.bulk_transition('reject_invitation', lambda u: True)
+    assert outcomes == {'transitioned': 2, 'not_allowed': 1}  # existing_user_id3 is new - nothing to reject
+
+    user_vault = UserVault()  # create new instance to avoid hitting cache
+    assert user_vault.get_user('existing_user_id1').state == UserState.REJECTED_JOIN
+    assert user_vault.get_user('existing_user_id1').state_timeout_ts > 1619945501
+    assert user_vault.get_user('existing_user_id2').state == UserState.REJECTED_JOIN
+    assert user_vault.get_user('existing_user_id3').state == UserState.NEW
+
+
+@pytest.mark.usefixtures('ddb_user1', 'ddb_user2', 'ddb_user3')
+@patch('time.time', Mock(return_value=1619945501))
+def test_ddb_bulk_transition_conflict() -> None:
+    def predicate(user: UserStateMachine) -> bool:
+        if user.user_id == 'existing_user_id3':
+            # someone else changes the user right after the user was read
+            concurrent_user = UserVault().get_user('existing_user_id3')
+            concurrent_user.request_chitchat()
+            concurrent_user.state_timestamp = 1619945000
+            concurrent_user.save()
+        return True
+
+    user_vault = UserVault()
+    outcomes = user_vault.bulk_transition('become_do_not_disturb', predicate)
+    assert outcomes == {'transitioned': 2, 'conflict': 1}
+
+    user_vault = UserVault()  # create new instance to avoid hitting cache
+    assert user_vault.get_user('existing_user_id1').state == UserState.DO_NOT_DISTURB
+    assert user_vault.get_user('existing_user_id2').state == UserState.DO_NOT_DISTURB
+    assert user_vault.get_user('existing_user_id3').state == UserState.WANTS_CHITCHAT  # the concurrent change wins
+
+
+@pytest.mark.usefixtures('create_user_state_machine_table')
+@patch('time.time', Mock(return_value=1619945501))
+@patch('actions.user_vault.BULK_TRANSITION_MAX_WORKERS', 2)
+def test_ddb_bulk_transition_many_users() -> None:
+    from actions.aws_resources import user_state_machine_table
+
+    with user_state_machine_table.batch_writer() as batch:
+        for idx in range(50):
+            # noinspection PyDataclass
+            batch.put_item(Item=asdict(UserStateMachine(user_id=f"user{idx}", state=UserState.OK_TO_CHITCHAT)))
+
+    user_vault = UserVault()
+    saved_user_ids = []
+    users_in_flight = []
+    original_save_user_if_state_unchanged = user_vault._save_user_if_state_unchanged
+
+    def save_user_if_state_unchanged(*args: Any, **kwargs: Any) -> bool:
+        result = original_save_user_if_state_unchanged(*args, **kwargs)
+        saved_user_ids.append(args[0].user_id)
+        return result
+
+    def predicate(_user: UserStateMachine) -> bool:
+        users_in_flight.append(len(users_in_flight) - len(saved_user_ids))
+        return True
+
+    with patch.object(user_vault, '_save_user_if_state_unchanged', save_user_if_state_unchanged):
+        outcomes = user_vault.bulk_transition('become_do_not_disturb', predicate)
+    assert outcomes == {'transitioned': 50}
+    assert sorted(saved_user_ids) == sorted(f"user{idx}" for idx in range(50))
+    assert max(users_in_flight) <= 2 * 4  # the listing doesn't run ahead of the saving threads
+
+    user_vault = UserVault()  # create new instance to avoid hitting cache
+    assert all(user_vault.get_user(f"user{idx}").state == UserState.DO_NOT_DISTURB for idx in range(50))
+
+
+@pytest.mark.usefixtures('create_user_state_machine_table')
+@patch('time.time', Mock(return_value=1619945501))
+def test_ddb_sweep_timed_out_users() -> None:
+    from actions.aws_resources import user_state_machine_table
+
+    for user_id, state, state_timeout_ts in [
+        ('timed_out_roomed', UserState.ROOMED, 1619945500),
+        ('timed_out_rejected', UserState.REJECTED_JOIN, 1619945000),
+        ('timed_out_waiting', UserState.WAITING_PARTNER_CONFIRM, 1619945000),  # expired by a reminder instead
+        ('not_timed_out_yet', UserState.ASKED_TO_JOIN, 1619945502),
+        ('no_timeout', UserState.WANTS_CHITCHAT, 0),
+    ]:
+        # noinspection PyDataclass
+        user_state_machine_table.put_item(Item=asdict(UserStateMachine(
+            user_id=user_id,
+            state=state,
+            partner_id='some_partner',
+            state_timestamp=1619940000,
+            state_timeout_ts=state_timeout_ts,
+        )))
+
+    assert UserVault().sweep_timed_out_users() == {'transitioned': 2}
+
+    user_vault = UserVault()  # create new instance to avoid hitting cache
+    for user_id in ['timed_out_roomed', 'timed_out_rejected']:
+        user = user_vault.get_user(user_id)
+        assert user.state == UserState.OK_TO_CHITCHAT
+        assert user.partner_id == 'some_partner'  # partner_id is kept
+        assert user.state_timestamp == 1619945501
+        assert user.state_timeout_ts == 0
+
+    assert user_vault.get_user('timed_out_waiting').state == UserState.WAITING_PARTNER_CONFIRM
+    assert user_vault.get_user('not_timed_out_yet').state == UserState.ASKED_TO_JOIN
+    assert user_vault.get_user('no_timeout').state == UserState.WANTS_CHITCHAT
+
+
+@patch('actions.user_vault.TIMEOUT_SWEEPER_ENABLED', True)
+@patch.object(UserVault, '_get_random_available_partner', return_value=None)
+def test_get_random_available_partner_with_sweeper(mock_get_random_available_partner: MagicMock) -> None:
+    assert UserVault().get_random_available_partner(UserStateMachine('some_user')) is None
+
+    mock_get_random_available_partner.assert_called_once_with(
+        # the other states with timeouts are taken care of by the sweeper
+        ['wants_chitchat', 'ok_to_chitchat', 'waiting_partner_confirm'],
+        'some_user',
+        ['some_user'],
+    )
+
+
+@pytest.mark.usefixtures('create_user_state_machine_table')
+@patch('time.time', Mock(return_value=1619945501))
+def test_ddb_list_available_users() -> None:
+    from actions.aws_resources import user_state_machine_table
+
+    for user_id, state, state_timeout_ts in [
+        ('timed_out_roomed', UserState.ROOMED, 1619945500),
+        ('not_timed_out_yet', UserState.ASKED_TO_JOIN, 1619945502),
+        ('wants_chitchat', UserState.WANTS_CHITCHAT, 0),
+        ('do_not_disturb', UserState.DO_NOT_DISTURB, 0),
+    ]:
+        # noinspection PyDataclass
+        user_state_machine_table.put_item(Item=asdict(UserStateMachine(
+            user_id=user_id,
+            state=state,
+            state_timeout_ts=state_timeout_ts,
+            activity_timestamp=1619940000,
+        )))
+
+    users = list(UserVault().list_available_users(UserState.offerable_states))
+    assert sorted(user.user_id for user in users) == ['timed_out_roomed', 'wants_chitchat']
+    assert all(isinstance(user.activity_timestamp, int) for user in users)
+
+
+@pytest.mark.usefixtures('create_user_state_machine_table')
+@patch('time.time', Mock(return_value=1619945600))
+def test_ddb_list_offerable_users_changed_since() -> None:
+    from actions.aws_resources import user_state_machine_table
+
+    for user_id, state, state_timestamp, state_timeout_ts, activity_timestamp in [
+        ('active_after', UserState.OK_TO_CHITCHAT, 1619945000, 0, 1619945501),
+        ('active_before', UserState.OK_TO_CHITCHAT, 1619945000, 0, 1619945000),
+        # entered by a callback, not by an activity
+        ('asked_to_join_after', UserState.ASKED_TO_JOIN, 1619945501, 1619959901, 1619945000),
+        ('asked_to_join_before', UserState.ASKED_TO_JOIN, 1619931000, 1619945400, 1619931000),
+        # not changed since, but not timed out yet either (with the shortest and with the longest timeout)
+        ('asked_to_join_unchanged', UserState.ASKED_TO_JOIN, 1619945000, 1619959400, 1619945000),
+        ('asked_to_join_unchanged_long', UserState.ASKED_TO_JOIN, 1619945000, 1620099800, 1619945000),
+        ('roomed_and_active_after', UserState.ROOMED, 1619945000, 1619959901, 1619945501),
+        ('do_not_disturb', UserState.DO_NOT_DISTURB, 1619945000, 0, 1619945501),
+    ]:
+        # noinspection PyDataclass
+        user_state_machine_table.put_item(Item=asdict(UserStateMachine(
+            user_id=user_id,
+            state=state,
+            state_timestamp=state_timestamp,
+            state_timeout_ts=state_timeout_ts,
+            activity_timestamp=activity_timestamp,
+        )))
+
+    users = list(UserVault()._list_offerable_users(changed_since_ts=1619945500))
+    assert sorted(user.user_id for user in users) == ['active_after', 'asked_to_join_after', 'roomed_and_active_after']
+    assert len(list(UserVault()._list_offerable_users())) == 7
+
+
+@pytest.mark.usefixtures('create_user_state_machine_table')
+@pytest.mark.parametrize('strategy, expected_candidate_ids', [
+    ('most_recent', ['ok_id5']),
+    ('random_top_k', ['ok_id5', 'ok_id4', 'roomed_id3']),  # top 3 of all the states together
+    ('power_of_two', ['ok_id5', 'ok_id4', 'roomed_id3']),
+])
+@patch('time.time', Mock(return_value=1619945501))
+@patch('actions.user_vault.PARTNER_SELECTION_TOP_K', 3)
+def test_ddb_get_random_available_partner_dict_strategies(strategy: Text, expected_candidate_ids: List[Text]) -> None:
+    from actions.aws_resources import user_state_machine_table
+
+    for user_id, state, activity_timestamp in [
+        ('ok_id1', UserState.OK_TO_CHITCHAT, 1619945001),
+        ('ok_id2', UserState.OK_TO_CHITCHAT, 1619945002),
+        ('roomed_id3', UserState.ROOMED, 1619945003),
+        ('ok_id4', UserState.OK_TO_CHITCHAT, 1619945004),
+        ('ok_id5', UserState.OK_TO_CHITCHAT, 1619945005),
+    ]:
+        # noinspection PyDataclass
+        user_state_machine_table.put_item(Item=asdict(UserStateMachine(
+            user_id=user_id,
+            state=state,
+            state_timeout_ts=1619945000,
+            activity_timestamp=activity_timestamp,
+        )))
+
+    candidate_ids = []
+
+    def _record_candidates(population: List[Dict[Text, Any]], *args) -> Any:
+        candidate_ids.extend(item['user_id'] for item in population)
+        return population[:args[0]] if args else population[0]
+
+    with patch('actions.user_vault.PARTNER_SELECTION_STRATEGY', strategy), \
+            patch('actions.user_vault.random') as mock_random:
+        mock_random.choice.side_effect = _record_candidates
+        mock_random.sample.side_effect = _record_candidates
+        partner_dict = UserVault()._get_random_available_partner_dict(
+            ('ok_to_chitchat', 'roomed'),
+            'current_user_id',
+            ['current_user_id'],
+        )
+
+    assert partner_dict['user_id'] == 'ok_id5'
+    if strategy != 'most_recent':
+        assert candidate_ids == expected_candidate_ids
+
+
+@patch('actions.user_vault.pending_invitations', user_vault.PendingInvitations(ttl_sec=60))
+def test_select_power_of_two() -> None:
+    items = [
+        {'user_id': 'most_recent', 'activity_timestamp': 1619945005},
+        {'user_id': 'less_recent', 'activity_timestamp': 1619945004},
+    ]
+    with patch('actions.user_vault.random') as mock_random:
+        mock_random.sample.side_effect = lambda population, k: population[:k]
+        assert user_vault._select_power_of_two(items)['user_id'] == 'most_recent'  # a tie => more recent one wins
+
+        user_vault.pending_invitations.add('most_recent')
+        assert user_vault._select_power_of_two(items)['user_id'] == 'less_recent'  # less popular one wins
+
+        assert user_vault._select_power_of_two(items[:1])['user_id'] == 'most_recent'
+        assert user_vault._select_power_of_two([]) is None
+
+
+def test_pending_invitations_expire() -> None:
+    pending_invitations = user_vault.PendingInvitations(ttl_sec=60)
+    with patch('time.monotonic', Mock(return_value=1000)):
+        pending_invitations.add('user_id1')
+        pending_invitations.add('user_id1')
+    with patch('time.monotonic', Mock(return_value=1030)):
+        pending_invitations.add('user_id1')
+        assert pending_invitations.count('user_id1') == 3
+        assert pending_invitations.count('user_id2') == 0
+    with patch('time.monotonic', Mock(return_value=1070)):
+        assert pending_invitations.count('user_id1') == 1
+    with patch('time.monotonic', Mock(return_value=1100)):
+        assert pending_invitations.count('user_id1') == 0
+
+
+@pytest.mark.usefixtures('create_user_state_machine_table')
+@patch('actions.user_vault.PARTNER_LEASE_SEC', 5)
+def test_ddb_partner_lease() -> None:
+    from actions.aws_resources import user_state_machine_table
+
+    for user_id, state, activity_timestamp in [
+        ('searcher1', UserState.WANTS_CHITCHAT, 1619945000),
+        ('searcher2', UserState.WANTS_CHITCHAT, 1619945000),
+        ('partner1', UserState.OK_TO_CHITCHAT, 1619945400),
+        ('partner2', UserState.OK_TO_CHITCHAT, 1619945300),
+    ]:
+        # noinspection PyDataclass
+        user_state_machine_table.put_item(Item=asdict(UserStateMachine(
+            user_id=user_id,
+            state=state,
+            activity_timestamp=activity_timestamp,
+        )))
+
+    def find_partner(searcher_id: Text) -> Text:
+        user_vault = UserVault()
+        return user_vault.get_random_available_partner(user_vault.get_user(searcher_id)).user_id
+
+    with patch('time.time', Mock(return_value=1619945501)):
+        assert find_partner('searcher1') == 'partner1'
+        assert find_partner('searcher2') == 'partner2'  # partner1 is claimed by searcher1
+        assert find_partner('searcher1') == 'partner1'  # the owner of the lease is not stopped by it
+
+        # leases are not part of the model
+        assert UserVault().get_user('partner1').user_id == 'partner1'
+
+    with patch('time.time', Mock(return_value=1619945507)):
+        assert find_partner('searcher2') == 'partner1'  # the lease of searcher1 has expired
+
+    with patch('time.time', Mock(return_value=1619945508)):
+        partner1 = UserVault().get_user('partner1')
+        partner1.save()  # the invitation was resolved - saving the partner releases the lease
+        assert find_partner('searcher1') == 'partner1'
+
+
+@patch('actions.user_vault.PARTNER_LEASE_SEC', 5)
+@patch.object(UserVault, '_lease_user', side_effect=[False, True])
+@patch.object(UserVault, '_get_random_available_partner')
+def test_get_random_available_partner_already_leased(
+        mock_get_random_available_partner: MagicMock,
+        mock_lease_user: MagicMock,
+) -> None:
+    mock_get_random_available_partner.side_effect = [UserStateMachine('partner1'), UserStateMachine('partner2')]
+
+    assert UserVault().get_random_available_partner(UserStateMachine('some_user')).user_id == 'partner2'
+
+    assert mock_lease_user.mock_calls == [
+        call('partner1', 'some_user', 5),
+        call('partner2', 'some_user', 5),
+    ]
+    assert mock_get_random_available_partner.mock_calls[1] == call(
+        UserState.offerable_states,
+        'some_user',
+        ['some_user', 'partner1'],  # the partner that was leased by someone else is excluded
+    )
+
+
+@pytest.mark.usefixtures('create_user_state_machine_table')
+@patch('actions.user_vault.empty_pool_cache', user_vault.EmptyPoolCache(ttl_sec=10))
+@patch.object(UserVault, '_get_random_available_partner', return_value=None)
+def test_get_random_available_partner_empty_pool_cache(mock_get_random_available_partner: MagicMock) -> None:
+    searcher = UserStateMachine('searcher', state=UserState.WANTS_CHITCHAT)
+
+    with patch('time.monotonic', Mock(return_value=1000)):
+        assert UserVault().get_random_available_partner(searcher) is None
+    with patch('time.monotonic', Mock(return_value=1009)):
+        assert UserVault().get_random_available_partner(searcher) is None
+    assert mock_get_random_available_partner.call_count == 1  # the second search was skipped
+
+    with patch('time.monotonic', Mock(return_value=1009)):
+        UserVault().save(UserStateMachine('not_offerable', state=UserState.DO_NOT_DISTURB))
+        assert UserVault().get_random_available_partner(searcher) is None
+    assert mock_get_random_available_partner.call_count == 1
+
+    with patch('time.monotonic', Mock(return_value=1009)):
+        UserVault().save(UserStateMachine('offerable', state=UserState.OK_TO_CHITCHAT))  # invalidates the cache
+        assert UserVault().get_random_available_partner(searcher) is None
+    assert mock_get_random_available_partner.call_count == 2
+
+    with patch('time.monotonic', Mock(return_value=1019)):
+        assert UserVault().get_random_available_partner(searcher) is None  # the ttl is over
+        assert UserVault().get_random_available_partner(UserStateMachine('another_searcher')) is None
+    assert mock_get_random_available_partner.call_count == 4
+
+
+def test_empty_pool_cache_max_size() -> None:
+    empty_pool_cache = user_vault.EmptyPoolCache(ttl_sec=10, max_size=2)
+    with patch('time.monotonic', Mock(return_value=1000)):
+        empty_pool_cache.mark_empty('searcher1', ['ok_to_chitchat'], [])
+    with patch('time.monotonic', Mock(return_value=1005)):
+        empty_pool_cache.mark_empty('searcher2', ['ok_to_chitchat'], [])
+    with patch('time.monotonic', Mock(return_value=1011)):
+        empty_pool_cache.mark_empty('searcher3', ['ok_to_chitchat'], [])  # expired searcher1 makes room
+
+        assert not empty_pool_cache.is_empty('searcher1', ['ok_to_chitchat'], [])
+        assert empty_pool_cache.is_empty('searcher2', ['ok_to_chitchat'], [])
+        assert empty_pool_cache.is_empty('searcher3', ['ok_to_chitchat'], [])
+        assert not empty_pool_cache.is_empty('searcher3', ['ok_to_chitchat'], ['someone_rejected'])
+
+
+@pytest.mark.usefixtures('create_user_state_machine_table')
+@patch('actions.user_vault.SEARCH_CURSOR_ENABLED', True)
+@patch.dict('actions.user_vault._search_cursors', clear=True)
+def test_ddb_search_cursor() -> None:
+    from actions.aws_resources import user_state_machine_table
+
+    def put_user(user_id: Text, state: Text, activity_timestamp: int) -> None:
+        # noinspection PyDataclass
+        user_state_machine_table.put_item(Item=asdict(UserStateMachine(
+            user_id=user_id,
+            state=state,
+            state_timestamp=1619945000,
+            activity_timestamp=activity_timestamp,
+        )))
+
+    put_user('searcher', UserState.WANTS_CHITCHAT, 1619945000)
+    put_user('partner1', UserState.OK_TO_CHITCHAT, 1619945400)
+    put_user('partner2', UserState.OK_TO_CHITCHAT, 1619945300)
+    put_user('partner3', UserState.OK_TO_CHITCHAT, 1619945200)
+
+    user_vault = UserVault()
+    searcher = user_vault.get_user('searcher')
+
+    with patch.object(UserVault, '_list_offerable_users', wraps=user_vault._list_offerable_users) as mock_list_users, \
+            patch('time.time', Mock(return_value=1619945501)):
+        assert user_vault.get_random_available_partner(searcher).user_id == 'partner1'
+        assert user_vault.get_random_available_partner(searcher).user_id == 'partner2'  # partner1 was offered already
+
+        put_user('partner3', UserState.DO_NOT_DISTURB, 1619945500)  # becomes unavailable
+        put_user('partner4', UserState.OK_TO_CHITCHAT, 1619945501)  # becomes active after the cursor was created
+        assert user_vault.get_random_available_partner(searcher).user_id == 'partner4'
+        assert user_vault.get_random_available_partner(searcher) is None
+
+    assert mock_list_users.mock_calls == [
+        call(),  # full list only at the beginning of the search
+        call(changed_since_ts=1619945501),
+        call(changed_since_ts=1619945501),
+        call(changed_since_ts=1619945501),
+    ]
+
+    with patch('time.time', Mock(return_value=1619945600)):
+        searcher.request_chitchat()  # new search session starts from scratch
+        assert user_vault.get_random_available_partner(searcher).user_id == 'partner4'
+
+
+@pytest.mark.usefixtures('create_user_state_machine_table')
+def test_offerable_pool_version() -> None:
+    pool_version = user_vault.get_offerable_pool_version()
+
+    UserVault().save(UserStateMachine('do_not_disturb', state=UserState.DO_NOT_DISTURB))
+    assert user_vault.get_offerable_pool_version() == pool_version
+
+    UserVault().save(UserStateMachine('ok_to_chitchat', state=UserState.OK_TO_CHITCHAT))
+    assert user_vault.get_offerable_pool_version() == pool_version + 1
+
+    user = UserVault().get_user('ok_to_chitchat')
+    user.save()  # nothing changed - still the same "offerable event"
+    assert user_vault.get_offerable_pool_version() == pool_version + 1
+
+    user.request_chitchat()
+    user.save()
+    assert user_vault.get_offerable_pool_version() == pool_version + 2
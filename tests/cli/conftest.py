@@ -0,0 +1,29 @@
+import zlib
+from typing import Text, Any, Dict, Iterator, Optional
+from unittest.mock import patch
+
+import pytest
+
+from cli import bulk
+
+
+@pytest.fixture(autouse=True)
+def moto_scan_segments() -> None:
+    """moto ignores Segment and TotalSegments of a scan (every segment gets the whole table) - emulate DDB here"""
+    original_scan_pages = bulk._scan_pages
+
+    def _scan_pages(
+            table_name: Text,
+            segment: int,
+            total_segments: int,
+            scan_kwargs: Dict[Text, Any],
+            exclusive_start_key: Optional[Dict[Text, Any]] = None,
+    ) -> Iterator[bulk.ScanPage]:
+        for _, items, last_evaluated_key in original_scan_pages(
+                table_name, segment, total_segments, scan_kwargs, exclusive_start_key,
+        ):
+            items = [item for item in items if zlib.crc32(item['user_id'].encode('utf-8')) % total_segments == segment]
+            yield segment, items, last_evaluated_key
+
+    with patch('cli.bulk._scan_pages', _scan_pages):
+        yield
@@ -0,0 +1,93 @@
+import asyncio
+import os
+from typing import Any, Dict, Text, Optional, List
+from unittest.mock import AsyncMock
+
+import pytest
+
+from actions.user_state_machine import UserStateMachine, UserState
+from cli import broadcast
+from cli import bulk
+
+TABLE_NAME = os.environ['USER_STATE_MACHINE_DDB_TABLE']
+
+
+@pytest.fixture
+def user_items() -> List[Dict[Text, Any]]:
+    from actions.aws_resources import user_state_machine_table
+
+    items = [{'user_id': f"user{idx}", 'state': UserState.OK_TO_CHITCHAT} for idx in range(30)]
+    items[0]['state'] = items[1]['state'] = UserState.BOT_BLOCKED
+    with user_state_machine_table.batch_writer() as batch:
+        for item in items:
+            batch.put_item(Item=item)
+    return items
+
+
+def item_to_user(item: Dict[Text, Any]) -> Optional[UserStateMachine]:
+    if item['state'] == UserState.BOT_BLOCKED:
+        return None
+    return UserStateMachine(**item)
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures('create_user_state_machine_table', 'user_items')
+async def test_broadcast_skip_and_resume(tmp_path) -> None:
+    checkpoint_path = str(tmp_path / 'broadcast.checkpoint')
+
+    async def send_to_user(user: UserStateMachine) -> None:
+        if user.user_id in ['user2', 'user3']:
+            raise RuntimeError('telegram is down')
+
+    send_to_user = AsyncMock(side_effect=send_to_user)
+    report = await broadcast.broadcast(
+        bulk.parallel_scan(TABLE_NAME, total_segments=4),
+        item_to_user,
+        send_to_user,
+        checkpoint_path=checkpoint_path,
+        concurrency=5,
+        max_per_sec=1000,
+    )
+    assert report == {'delivered': 26, 'failed': 2, 'skipped': 2}
+    assert send_to_user.await_count == 28
+
+    # resume - only the failed ones are retried
+    send_to_user = AsyncMock()
+    report = await broadcast.broadcast(
+        bulk.parallel_scan(TABLE_NAME, total_segments=4),
+        item_to_user,
+        send_to_user,
+        checkpoint_path=checkpoint_path,
+        concurrency=5,
+        max_per_sec=1000,
+    )
+    assert report == {'delivered': 2, 'already_delivered': 26, 'skipped': 2}
+    assert sorted(call.args[0].user_id for call in send_to_user.await_args_list) == ['user2', 'user3']
+
+    with open(checkpoint_path, encoding='utf-8') as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 30
+    assert lines.count('user2\tfailed') == lines.count('user2\tdelivered') == 1
+
+
+@pytest.mark.asyncio
+async def test_broadcast_concurrency() -> None:
+    in_flight = 0
+    max_in_flight = 0
+
+    async def send_to_user(_user: UserStateMachine) -> None:
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+
+    report = await broadcast.broadcast(
+        iter([{'user_id': f"user{idx}", 'state': UserState.OK_TO_CHITCHAT} for idx in range(20)]),
+        item_to_user,
+        send_to_user,
+        concurrency=3,
+        max_per_sec=1000,
+    )
+    assert report == {'delivered': 20}
+    assert max_in_flight == 3
@@ -0,0 +1,112 @@
+import os
+from typing import Any, Dict, Text
+from unittest.mock import patch, MagicMock
+
+import pytest
+from botocore.exceptions import ClientError
+
+from cli import bulk
+
+TABLE_NAME = os.environ['USER_STATE_MACHINE_DDB_TABLE']
+
+
+@pytest.fixture
+def user_items() -> Dict[Text, Dict[Text, Any]]:
+    from actions.aws_resources import user_state_machine_table
+
+    items = {f"user{idx}": {'user_id': f"user{idx}", 'state': 'ok_to_chitchat'} for idx in range(120)}
+    for idx in range(0, 120, 3):
+        items[f"user{idx}"]['state'] = 'do_not_disturb'
+    with user_state_machine_table.batch_writer() as batch:
+        for item in items.values():
+            batch.put_item(Item=item)
+    return items
+
+
+@pytest.mark.usefixtures('create_user_state_machine_table')
+@pytest.mark.parametrize('total_segments', [1, 4])
+def test_parallel_scan(user_items: Dict[Text, Dict[Text, Any]], total_segments: int) -> None:
+    scanned_user_ids = [item['user_id'] for item in bulk.parallel_scan(TABLE_NAME, total_segments=total_segments)]
+
+    assert sorted(scanned_user_ids) == sorted(user_items)  # every item exactly once
+
+
+@pytest.mark.usefixtures('create_user_state_machine_table', 'user_items')
+@patch('cli.bulk.BULK_SCAN_QUEUE_SIZE', 1)
+def test_parallel_scan_stops_when_consumer_stops() -> None:
+    items = bulk.parallel_scan(TABLE_NAME, total_segments=4)
+    assert next(items)['user_id']
+    items.close()  # would hang forever if the scanning threads kept waiting for space in the queue
+
+    with pytest.raises(RuntimeError):
+        for _ in bulk.parallel_scan(TABLE_NAME, total_segments=4):
+            raise RuntimeError('the consumer failed')
+
+
+@pytest.mark.usefixtures('create_user_state_machine_table', 'user_items')
+def test_parallel_scan_segment_failure() -> None:
+    original_scan_pages = bulk._scan_pages
+
+    def _scan_pages(table_name: Text, segment: int, *args: Any, **kwargs: Any) -> Any:
+        if segment == 1:
+            raise RuntimeError('segment failed')
+        return original_scan_pages(table_name, segment, *args, **kwargs)
+
+    with patch('cli.bulk._scan_pages', _scan_pages), pytest.raises(RuntimeError):
+        list(bulk.parallel_scan(TABLE_NAME, total_segments=4))
+
+
+@pytest.mark.usefixtures('create_user_state_machine_table')
+@patch('cli.bulk.ThreadSafeThrottle')
+def test_bulk_process(mock_throttle_class: MagicMock, user_items: Dict[Text, Dict[Text, Any]]) -> None:
+    from actions.aws_resources import user_state_machine_table
+
+    def process_item(table: Any, item: Dict[Text, Any]) -> bool:
+        if item['state'] == 'do_not_disturb':
+            return False
+        if item['user_id'] == 'user1':
+            raise RuntimeError('oops')
+        table.update_item(
+            Key={'user_id': item['user_id']},
+            UpdateExpression='SET #state=:state',
+            ExpressionAttributeNames={'#state': 'state'},
+            ExpressionAttributeValues={':state': 'wants_chitchat'},
+        )
+        return True
+
+    stats = bulk.bulk_process(TABLE_NAME, process_item, total_segments=4, max_workers=4)
+
+    assert (stats.scanned, stats.processed, stats.skipped, stats.failed) == (120, 79, 40, 1)
+    assert mock_throttle_class.return_value.wait.call_count == 79  # skipped items don't consume the write budget
+    assert user_state_machine_table.get_item(Key={'user_id': 'user2'})['Item']['state'] == 'wants_chitchat'
+    assert user_state_machine_table.get_item(Key={'user_id': 'user3'})['Item']['state'] == 'do_not_disturb'
+
+
+def test_adaptive_throttle_unlimited() -> None:
+    throttle = bulk.AdaptiveThrottle(0)
+
+    throttle.wait()
+    throttle.on_throttled()
+    throttle.on_success()
+    assert throttle.rate_per_sec is None
+
+
+@patch('cli.bulk.BULK_RETRY_BASE_DELAY_SEC', 0)
+def test_call_with_retries() -> None:
+    throughput_exceeded = ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException'}}, 'Scan')
+    call = MagicMock(side_effect=[throughput_exceeded, throughput_exceeded, 'page'])
+    throttle = MagicMock()
+
+    assert bulk.call_with_retries(call, throttle) == 'page'
+    assert throttle.on_throttled.call_count == 2
+    throttle.on_success.assert_called_once()
+
+    call = MagicMock(side_effect=throughput_exceeded)
+    with pytest.raises(ClientError):
+        bulk.call_with_retries(call, max_retries=3)
+    assert call.call_count == 3
+
+    call = MagicMock(side_effect=RuntimeError('not a throttling error'))
+    with pytest.raises(RuntimeError):
+        bulk.call_with_retries(call)
+    call.assert_called_once()
@@ -0,0 +1,106 @@
+import json
+import os
+import zlib
+from typing import Any, Dict, Text, Set
+from unittest.mock import patch
+
+import pytest
+from botocore.exceptions import ClientError
+
+from cli import migrations
+
+TABLE_NAME = os.environ['USER_STATE_MACHINE_DDB_TABLE']
+
+
+@pytest.fixture
+def user_items() -> Dict[Text, Dict[Text, Any]]:
+    from actions.aws_resources import user_state_machine_table
+
+    items = {f"user{idx}": {'user_id': f"user{idx}", 'state': 'ok_to_chitchat'} for idx in range(60)}
+    for idx in range(0, 60, 2):
+        items[f"user{idx}"]['exclude_partner_ids'] = ['some_partner']
+    with user_state_machine_table.batch_writer() as batch:
+        for item in items.values():
+            batch.put_item(Item=item)
+    return items
+
+
+def _obsolete_user_ids() -> Set[Text]:
+    from actions.aws_resources import user_state_machine_table
+
+    return {item['user_id'] for item in user_state_machine_table.scan()['Items'] if 'exclude_partner_ids' in item}
+
+
+@pytest.mark.usefixtures('create_user_state_machine_table', 'user_items')
+def test_run_migration(tmp_path: Any) -> None:
+    checkpoint_path = str(tmp_path / 'migration.json')
+
+    counters = migrations.run_migration(TABLE_NAME, 'remove_obsolete_attributes', checkpoint_path, total_segments=4)
+
+    assert counters == {'scanned': 60, 'migrated': 30, 'up_to_date': 30}
+    assert _obsolete_user_ids() == set()
+    with open(checkpoint_path, encoding='utf-8') as f:
+        assert all(progress['done'] for progress in json.load(f)['segments'].values())
+
+    # idempotent - a fresh run finds nothing to migrate
+    counters = migrations.run_migration(TABLE_NAME, 'remove_obsolete_attributes', None, total_segments=4)
+    assert counters == {'scanned': 60, 'migrated': 0, 'up_to_date': 60}
+
+
+@pytest.mark.usefixtures('create_user_state_machine_table', 'user_items')
+def test_run_migration_dry_run(tmp_path: Any) -> None:
+    checkpoint_path = str(tmp_path / 'migration.json')
+
+    counters = migrations.run_migration(
+        TABLE_NAME, 'remove_obsolete_attributes', checkpoint_path, dry_run=True, total_segments=4,
+    )
+
+    assert counters == {'scanned': 60, 'migrated': 30, 'up_to_date': 30}
+    assert len(_obsolete_user_ids()) == 30
+    assert not os.path.exists(checkpoint_path)
+
+
+@pytest.mark.usefixtures('create_user_state_machine_table')
+def test_run_migration_resumes_from_checkpoint(tmp_path: Any, user_items: Dict[Text, Dict[Text, Any]]) -> None:
+    checkpoint_path = str(tmp_path / 'migration.json')
+    failing_user_id = sorted(_obsolete_user_ids())[0]
+    original_remove_obsolete_attributes = migrations.MIGRATIONS['remove_obsolete_attributes']
+
+    def remove_obsolete_attributes(item: Dict[Text, Any]) -> Any:
+        update_kwargs = original_remove_obsolete_attributes(item)
+        if update_kwargs and item['user_id'] == failing_user_id:
+            return {**update_kwargs, 'ConditionExpression': 'attribute_not_exists(user_id)'}  # always fails
+        return update_kwargs
+
+    with patch.dict(migrations.MIGRATIONS, remove_obsolete_attributes=remove_obsolete_attributes):
+        with pytest.raises(ClientError, match='ConditionalCheckFailedException'):
+            migrations.run_migration(TABLE_NAME, 'remove_obsolete_attributes', checkpoint_path, total_segments=4)
+
+    with open(checkpoint_path, encoding='utf-8') as f:
+        checkpoint_dict = json.load(f)
+    assert sum(progress['done'] for progress in checkpoint_dict['segments'].values()) == 3  # the failed one isn't
+    assert _obsolete_user_ids() == {failing_user_id}
+
+    counters = migrations.run_migration(TABLE_NAME, 'remove_obsolete_attributes', checkpoint_path, total_segments=4)
+
+    # only the failed segment is scanned again, the rest of its items were migrated by the first run already
+    failed_segment = zlib.crc32(failing_user_id.encode('utf-8')) % 4
+    migrated_by_first_run = {
+        user_id for user_id in user_items
+        if 'exclude_partner_ids' in user_items[user_id] and zlib.crc32(user_id.encode('utf-8')) % 4 == failed_segment
+    } - {failing_user_id}
+    assert counters == {
+        'scanned': 60,
+        'migrated': 30 - len(migrated_by_first_run),
+        'up_to_date': 30 + len(migrated_by_first_run),
+    }
+    assert _obsolete_user_ids() == set()
+
+
+@pytest.mark.usefixtures('create_user_state_machine_table')
+def test_checkpoint_of_another_migration(tmp_path: Any) -> None:
+    checkpoint_path = str(tmp_path / 'migration.json')
+    migrations.MigrationCheckpoint.load(checkpoint_path, 'remove_obsolete_attributes', 4).page_done(0, None)
+
+    with pytest.raises(ValueError):
+        migrations.MigrationCheckpoint.load(checkpoint_path, 'remove_obsolete_attributes', 8)
@@ -0,0 +1,56 @@
+import os
+from unittest.mock import patch, Mock
+
+import pytest
+
+from actions.user_state_machine import UserState
+from cli import bulk
+from cli.stats import PopulationStats
+
+TABLE_NAME = os.environ['USER_STATE_MACHINE_DDB_TABLE']
+
+
+@patch('cli.stats.current_timestamp_int', Mock(return_value=1619945501))
+def test_population_stats() -> None:
+    population = PopulationStats().add_all([
+        {
+            'user_id': 'user1', 'state': UserState.OK_TO_CHITCHAT, 'native': 'en', 'newbie': True,
+            'activity_timestamp': 1619945501 - 30, 'seen_partner_ids': ['a', 'b', 'c', 'd', 'e', 'f', 'g'],
+        },
+        {
+            'user_id': 'user2', 'state': UserState.ROOMED, 'native': 'uk', 'activity_timestamp': 1619945501 - 7200,
+            'state_timeout_ts': 1619945501 + 30, 'roomed_partner_ids': ['user3'],
+        },
+        {'user_id': 'user3', 'state': UserState.ROOMED, 'native': 'uk', 'state_timeout_ts': 1619945500},
+    ])
+    stats_dict = population.to_dict()
+
+    assert stats_dict['total'] == 3
+    assert stats_dict['newbie_ratio'] == 0.3333
+    assert stats_dict['by_state'] == {'roomed': 2, 'ok_to_chitchat': 1}
+    assert stats_dict['by_native'] == {'uk': 2, 'en': 1}
+    assert stats_dict['activity_age'] == {'< 1 min': 1, '< 1 day': 1, 'never active': 1}
+    assert stats_dict['timeout_expiry'] == {'no timeout': 1, 'expires in < 1 min': 1, 'expired': 1}
+    assert stats_dict['exclusion_lists']['seen_partner_ids'] == {'mean': 2.33, 'max': 7, 'sizes': {'0': 2, '6-20': 1}}
+    assert 'BY STATE' in population.to_table()
+
+
+@pytest.mark.usefixtures('create_user_state_machine_table')
+def test_population_stats_from_scan() -> None:
+    from actions.aws_resources import user_state_machine_table
+
+    for idx in range(40):
+        user_state_machine_table.put_item(Item={
+            'user_id': f"user{idx}",
+            'state': UserState.OK_TO_CHITCHAT if idx % 4 else UserState.DO_NOT_DISTURB,
+            'telegram_from': {'id': idx},
+        })
+
+    population = PopulationStats().add_all(bulk.parallel_scan(
+        TABLE_NAME,
+        total_segments=4,
+        # user_id is only projected for the sake of the segment emulation of tests/cli/conftest.py
+        ProjectionExpression='#a0, #a1',
+        ExpressionAttributeNames={'#a0': 'state', '#a1': 'user_id'},
+    ))
+    assert population.to_dict()['by_state'] == {'ok_to_chitchat': 30, 'do_not_disturb': 10}
@@ -0,0 +1,41 @@
+import os
+
+import pytest
+from click.testing import CliRunner
+
+from actions.user_state_machine import UserState
+
+TABLE_NAME = os.environ['USER_STATE_MACHINE_DDB_TABLE']
+
+
+@pytest.mark.usefixtures('create_user_state_machine_table')
+def test_make_everyone_available_to_everyone() -> None:
+    from actions.aws_resources import user_state_machine_table
+    from cli import swipy_cli
+
+    with user_state_machine_table.batch_writer() as batch:
+        for idx in range(30):
+            batch.put_item(Item={
+                'user_id': f"user{idx}",
+                'state': UserState.DO_NOT_DISTURB if idx % 3 == 0 else UserState.ROOMED,
+                'state_timestamp': 1619945501,
+                'roomed_partner_ids': ['partner1'],
+                'rejected_partner_ids': ['partner2'],
+            })
+
+    result = CliRunner().invoke(
+        swipy_cli.swipy,
+        ['make-everyone-available-to-everyone', '--segments', '4', '--workers', '3', '--max-writes-per-sec', '0'],
+        input=f"{TABLE_NAME}\n{TABLE_NAME}\n",
+    )
+    assert result.exit_code == 0, result.output
+    assert 'processed: 20, skipped: 10, failed: 0' in result.output
+    assert "'transitioned': 20" in result.output and "'not_matched': 10" in result.output
+
+    items = {item['user_id']: item for item in user_state_machine_table.scan()['Items']}
+    assert items['user0']['state'] == UserState.DO_NOT_DISTURB
+    assert items['user0']['roomed_partner_ids'] == ['partner1']  # skipped users are not touched
+    assert items['user1']['state'] == UserState.OK_TO_CHITCHAT
+    assert items['user1']['state_timestamp'] > 1619945501  # went through the state machine
+    assert items['user1']['roomed_partner_ids'] == []
+    assert items['user1']['rejected_partner_ids'] == []
@@ -0,0 +1,65 @@
+import os
+from dataclasses import asdict
+from decimal import Decimal
+
+import pytest
+
+from actions.user_state_machine import UserStateMachine, UserState
+from cli import table_dump
+
+TABLE_NAME = os.environ['USER_STATE_MACHINE_DDB_TABLE']
+
+
+@pytest.mark.usefixtures('create_user_state_machine_table')
+@pytest.mark.parametrize('file_name', ['users.jsonl', 'users.jsonl.gz'])
+def test_export_import_round_trip(tmp_path, file_name: str) -> None:
+    from actions.aws_resources import user_state_machine_table
+
+    users = [
+        UserStateMachine(
+            f"user{idx}",
+            state=UserState.OK_TO_CHITCHAT,
+            activity_timestamp=1619945501 + idx,
+            roomed_partner_ids=['user0'],
+            telegram_from={'id': idx, 'first_name': 'Jäne', 'is_bot': False},
+        )
+        for idx in range(25)
+    ]
+    for user in users:
+        # noinspection PyDataclass
+        user_state_machine_table.put_item(Item=asdict(user))
+    # an attribute that is not part of the model anymore is not exported
+    user_state_machine_table.update_item(
+        Key={'user_id': 'user1'},
+        UpdateExpression='SET exclude_partner_ids = :ids',
+        ExpressionAttributeValues={':ids': ['user2']},
+    )
+
+    path = str(tmp_path / file_name)
+    assert table_dump.export_table(TABLE_NAME, path, total_segments=4) == 25
+
+    for user in users:
+        user_state_machine_table.delete_item(Key={'user_id': user.user_id})
+    stats = table_dump.import_table(path, TABLE_NAME, max_workers=2, max_writes_per_sec=0)
+    assert (stats.scanned, stats.processed, stats.failed) == (25, 25, 0)
+
+    user1 = user_state_machine_table.get_item(Key={'user_id': 'user1'})['Item']
+    assert 'exclude_partner_ids' not in user1
+    assert user1['activity_timestamp'] == 1619945502
+    assert user1['roomed_partner_ids'] == ['user0']
+    assert user1['telegram_from'] == {'id': Decimal(1), 'first_name': 'Jäne', 'is_bot': False}
+
+
+def test_json_line_round_trip() -> None:
+    item = {
+        'user_id': 'user1',
+        'state': UserState.OK_TO_CHITCHAT,
+        'activity_timestamp': Decimal(1619945501),
+        'telegram_from': {'id': Decimal(1), 'some_float': Decimal('1.5')},
+    }
+    line = table_dump.item_to_json_line(item)
+    assert line.endswith('\n')
+
+    restored_item = table_dump.json_line_to_item(line)
+    assert restored_item['activity_timestamp'] == 1619945501
+    assert restored_item['telegram_from'] == {'id': 1, 'some_float': Decimal('1.5')}
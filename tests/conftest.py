@@ -53,3 +53,71 @@ def mock_aioresponses() -> aioresponses:
 def mock_ddb() -> ServiceResource:
     with mock_dynamodb2():
         yield boto3.resource('dynamodb', os.environ['AWS_REGION'])
+
+
+@pytest.fixture
+def create_user_state_machine_table(mock_ddb: ServiceResource) -> None:
+    user_state_machine_ddb_table_name = os.environ['USER_STATE_MACHINE_DDB_TABLE']
+    # noinspection PyUnresolvedReferences
+    mock_ddb.create_table(
+        TableName=user_state_machine_ddb_table_name,
+        AttributeDefinitions=[
+            {
+                'AttributeName': 'user_id',
+                'AttributeType': 'S',
+            },
+            {
+                'AttributeName': 'state',
+                'AttributeType': 'S',
+            },
+            {
+                'AttributeName': 'state_timeout_ts',
+                'AttributeType': 'N',
+            },
+            {
+                'AttributeName': 'activity_timestamp',
+                'AttributeType': 'N',
+            },
+        ],
+        KeySchema=[
+            {
+                'AttributeName': 'user_id',
+                'KeyType': 'HASH',
+            },
+        ],
+        GlobalSecondaryIndexes=[
+            {
+                'IndexName': 'by_state_and_timeout_ts',
+                'KeySchema': [
+                    {
+                        'AttributeName': 'state',
+                        'KeyType': 'HASH',
+                    },
+                    {
+                        'AttributeName': 'state_timeout_ts',
+                        'KeyType': 'RANGE',
+                    },
+                ],
+                'Projection': {
+                    'ProjectionType': 'ALL',
+                },
+            },
+            {
+                'IndexName': 'by_state_and_activity_ts',
+                'KeySchema': [
+                    {
+                        'AttributeName': 'state',
+                        'KeyType': 'HASH',
+                    },
+                    {
+                        'AttributeName': 'activity_timestamp',
+                        'KeyType': 'RANGE',
+                    },
+                ],
+                'Projection': {
+                    'ProjectionType': 'ALL',
+                },
+            },
+        ],
+        BillingMode='PAY_PER_REQUEST',
+    )
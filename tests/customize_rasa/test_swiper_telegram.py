@@ -0,0 +1,174 @@
+from types import SimpleNamespace
+from typing import Dict, Text, Any, Optional
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from boto3.resources.base import ServiceResource
+
+from customize_rasa.swiper_telegram import InMemoryUpdateIdStore, DdbUpdateIdStore, LayeredUpdateIdStore, \
+    SwiperTelegramInput, IUpdateIdStore
+
+
+def _telegram_input(update_id_store: IUpdateIdStore) -> SwiperTelegramInput:
+    # the constructor of TelegramInput wants a bot token etc. - none of that is needed to test the webhook wrapper
+    telegram_input = SwiperTelegramInput.__new__(SwiperTelegramInput)
+    telegram_input.update_id_store = update_id_store
+    return telegram_input
+
+
+def _request(
+        telegram_update: Optional[Dict[Text, Any]],
+        method: Text = 'POST',
+        active_loop_name: Optional[Text] = None,
+) -> MagicMock:
+    tracker_store = MagicMock()
+    tracker_store.retrieve.return_value = SimpleNamespace(active_loop_name=active_loop_name)
+    agent = SimpleNamespace(tracker_store=tracker_store, domain=SimpleNamespace(forms={
+        'give_feedback_form': {'required_slots': {'feedback_text': [{'type': 'from_text'}]}},
+        'some_intent_form': {'required_slots': {'some_slot': [{'type': 'from_intent', 'value': True}]}},
+    }))
+    return MagicMock(method=method, json=telegram_update, ctx=SimpleNamespace(), app=SimpleNamespace(agent=agent))
+
+
+def _telegram_update(update_id: int, text: Text = 'hi') -> Dict[Text, Any]:
+    return {
+        'update_id': update_id,
+        'message': {'message_id': 1, 'from': {'id': 123, 'first_name': 'Jane'}, 'chat': {'id': 123}, 'text': text},
+    }
+
+
+@pytest.fixture
+def create_update_dedup_table(mock_ddb: ServiceResource) -> None:
+    # noinspection PyUnresolvedReferences
+    mock_ddb.create_table(
+        TableName='UpdateDedup-unittest',
+        AttributeDefinitions=[{'AttributeName': 'update_id', 'AttributeType': 'N'}],
+        KeySchema=[{'AttributeName': 'update_id', 'KeyType': 'HASH'}],
+        BillingMode='PAY_PER_REQUEST',
+    )
+
+
+@pytest.mark.asyncio
+async def test_in_memory_update_id_store() -> None:
+    update_id_store = InMemoryUpdateIdStore(max_size=2)
+
+    assert await update_id_store.remember(1)
+    assert not await update_id_store.remember(1)
+    assert await update_id_store.remember(2)
+    assert await update_id_store.remember(3)
+    assert await update_id_store.remember(1)  # the oldest one was evicted
+
+    await update_id_store.forget(3)
+    assert await update_id_store.remember(3)
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures('create_update_dedup_table')
+async def test_ddb_update_id_store() -> None:
+    update_id_store = DdbUpdateIdStore('UpdateDedup-unittest')
+    another_replica_store = DdbUpdateIdStore('UpdateDedup-unittest')
+
+    assert await update_id_store.remember(1)
+    assert not await another_replica_store.remember(1)
+
+    await update_id_store.forget(1)
+    assert await another_replica_store.remember(1)
+
+
+@pytest.mark.asyncio
+async def test_layered_update_id_store() -> None:
+    shared_store = InMemoryUpdateIdStore()
+    replica1_store = LayeredUpdateIdStore(InMemoryUpdateIdStore(), shared_store)
+    replica2_store = LayeredUpdateIdStore(InMemoryUpdateIdStore(), shared_store)
+
+    assert await replica1_store.remember(1)
+    assert not await replica1_store.remember(1)  # answered by the local store
+    assert not await replica2_store.remember(1)  # falls through to the shared store
+
+    await replica1_store.forget(1)
+    assert await replica1_store.remember(1)
+
+
+@pytest.mark.asyncio
+async def test_layered_update_id_store_shared_store_failure() -> None:
+    shared_store = MagicMock()
+    shared_store.remember = AsyncMock(side_effect=RuntimeError('ddb is down'))
+    shared_store.forget = AsyncMock(side_effect=RuntimeError('ddb is down'))
+    update_id_store = LayeredUpdateIdStore(InMemoryUpdateIdStore(), shared_store)
+
+    assert await update_id_store.remember(1)  # better process a duplicate than lose an update
+    assert not await update_id_store.remember(1)  # the local store still works
+
+    await update_id_store.forget(1)
+    assert await update_id_store.remember(1)
+
+
+@pytest.mark.asyncio
+async def test_webhook_suppresses_duplicates() -> None:
+    webhook_handler = AsyncMock(return_value='processed')
+    webhook = _telegram_input(InMemoryUpdateIdStore())._wrap_webhook(webhook_handler)
+
+    request = _request(_telegram_update(1))
+    assert await webhook(request) == 'processed'
+    assert request.ctx.swiper_metadata == {'telegram_from': {'id': 123, 'first_name': 'Jane'}}
+
+    assert (await webhook(_request(_telegram_update(1)))).body == b'success'
+    assert await webhook(_request(_telegram_update(2))) == 'processed'
+    assert webhook_handler.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_webhook_forgets_failed_updates() -> None:
+    webhook_handler = AsyncMock(side_effect=[RuntimeError('tracker store is down'), 'processed'])
+    webhook = _telegram_input(InMemoryUpdateIdStore())._wrap_webhook(webhook_handler)
+
+    with pytest.raises(RuntimeError):
+        await webhook(_request(_telegram_update(1)))
+    assert await webhook(_request(_telegram_update(1))) == 'processed'  # the retry of Telegram is processed
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('telegram_update', [
+    {'update_id': 1, 'edited_message': {'message_id': 1, 'text': 'hi'}},
+    {'update_id': 1, 'callback_query': {'id': '1'}},
+    None,
+])
+async def test_webhook_ignores_non_messages(telegram_update: Optional[Dict[Text, Any]]) -> None:
+    update_id_store = InMemoryUpdateIdStore()
+    webhook_handler = AsyncMock()
+    webhook = _telegram_input(update_id_store)._wrap_webhook(webhook_handler)
+
+    assert (await webhook(_request(telegram_update))).body == b'success'
+    webhook_handler.assert_not_called()
+    assert await update_id_store.remember(1)  # not marked as seen
+
+
+@pytest.mark.asyncio
+async def test_webhook_passes_get_requests_through() -> None:
+    webhook_handler = AsyncMock(return_value='processed')
+    webhook = _telegram_input(InMemoryUpdateIdStore())._wrap_webhook(webhook_handler)
+
+    assert await webhook(_request(None, method='GET')) == 'processed'
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('text, active_loop_name, expect_keyboard_button', [
+    ('Yes', None, True),
+    ('Yes', 'some_intent_form', True),
+    ('Yes', 'give_feedback_form', False),  # the feedback is literally "Yes"
+    ('Yes, please', None, False),
+])
+async def test_webhook_keyboard_buttons(
+        text: Text,
+        active_loop_name: Optional[Text],
+        expect_keyboard_button: bool,
+) -> None:
+    webhook = _telegram_input(InMemoryUpdateIdStore())._wrap_webhook(AsyncMock())
+
+    request = _request(_telegram_update(1, text=text), active_loop_name=active_loop_name)
+    await webhook(request)
+
+    if expect_keyboard_button:
+        assert request.ctx.swiper_metadata['keyboard_button_text'] == text
+    else:
+        assert 'keyboard_button_text' not in request.ctx.swiper_metadata
@@ -27,4 +27,5 @@ all_expected_user_state_machine_triggers = [
     'reject_invitation',
     'become_do_not_disturb',
     'mark_as_bot_blocked',
+    'time_out',
 ]